@@ -12,8 +12,11 @@ __author__ = 'juliewe'
 # vectors are displayed via their most salient features
 
 import sys
+import os
 import math
 import ast
+import zlib
+import hashlib
 from operator import itemgetter
 
 import configparser
@@ -38,6 +41,17 @@ class Composition:
     filterfreq = 1000
     saliency = 0
     saliencyperpath = False
+    memorybudget = 0  # MB available for vectors in revectorise; 0 means load everything at once
+    memoryfactor = 12  # rough bytes of RAM needed per byte of vector file once loaded into dicts
+    lowmemory = False  # stream filter and normalise against entry-sorted files instead of loading totals dicts
+    sortbudget = 256  # MB used for in-memory runs when sorting files if memorybudget is not set
+    approxtotals = False  # find column totals above filterfreq with a count-min sketch before counting them exactly
+    sketchwidth = 1 << 22
+    sketchdepth = 4
+    spilltotals = False  # spill partial column totals to sorted run files and merge them into a sorted .ctot
+    bytesperfeature = 200  # rough bytes of RAM per distinct feature held in a totals dict
+    deltafile = ""  # raw APT vectors to fold into existing counts with the update option
+    updatetolerance = 0.0  # relative change in a column or type total above which update recomputes PPMI
 
     headPoS = {"nn": "N", "amod": "N", "mod": "N"}
     depPoS = {"nn": "N", "amod": "J", "mod": "J"}
@@ -143,9 +157,26 @@ class Composition:
         self.filterfreq = int(self.config.get('default', 'fthreshold'))
         self.comppairfile = self.config.get('default', 'comppairfile')
         self.filterfile = self.config.get('default', 'filterfile')
+        self.memorybudget = int(self.getoptional('memorybudget', Composition.memorybudget))
+        self.lowmemory = self.getoptional('lowmemory', str(Composition.lowmemory)) == "True"
+        self.approxtotals = self.getoptional('approxtotals', str(Composition.approxtotals)) == "True"
+        self.sketchwidth = int(self.getoptional('sketchwidth', Composition.sketchwidth))
+        self.sketchdepth = int(self.getoptional('sketchdepth', Composition.sketchdepth))
+        self.spilltotals = self.getoptional('spilltotals', str(Composition.spilltotals)) == "True"
+        self.deltafile = self.getoptional('deltafile', Composition.deltafile)
+        self.updatetolerance = float(self.getoptional('updatetolerance', Composition.updatetolerance))
 
         return
 
+    # ---
+    # read an option from the default section of the config file which older config files may not have
+    # ---
+    def getoptional(self, key, default):
+        try:
+            return self.config.get('default', key)
+        except configparser.NoOptionError:
+            return default
+
     # ----HELPER FUNCTIONS
 
     # -----
@@ -212,6 +243,54 @@ class Composition:
     def selectpos(self):
         return self.filesbypos.get(self.pos, self.filesbypos["N"])
 
+    # ---
+    # generate the file stem for .rtot and .ctot files at the current stage of the pipeline
+    # ---
+    def selecttotals(self):
+        infile = self.selectpos() + self.reducedstring
+        if self.normalised and not self.option == "normalise":
+            infile += ".filtered.norm"
+        return infile
+
+    # ---
+    # generate the suffix for weighted vector files according to normalisation, weighting, threshold and saliency
+    # ---
+    def weightingsuffix(self):
+        if self.normalised:
+            suffix = ".norm"
+        else:
+            suffix = ""
+        if self.pp_normal:
+            suffix += ".pnppmi"
+        elif self.gof_ppmi:
+            suffix += ".gof_ppmi"
+        elif self.smooth_ppmi:
+            suffix += ".smooth_ppmi"
+        else:
+            suffix += ".ppmi"
+        if self.ppmithreshold > 0:
+            suffix += "_" + str(self.ppmithreshold)
+        if self.saliency > 0:
+            if self.saliencyperpath:
+                suffix += ".spp_" + str(self.saliency)
+            else:
+                suffix += ".sal_" + str(self.saliency)
+        return suffix
+
+    # ---
+    # bytes of memory available to stages which work on disk: memorybudget if set, otherwise sortbudget
+    # ---
+    def budgetbytes(self):
+        if self.memorybudget > 0:
+            return self.memorybudget * 1024 * 1024
+        return Composition.sortbudget * 1024 * 1024
+
+    # ---
+    # number of bytes of lines to sort in memory at once when sorting files on disk
+    # ---
+    def runbytes(self):
+        return self.budgetbytes() // 4
+
     # ----
     # get the path prefix / dependency path of a given feature
     # self.getpathtype("amod:red") = amod
@@ -244,7 +323,7 @@ class Composition:
         if path == "":
             order = 0
         else:
-            fields = path.split("\xc2\xbb")
+            fields = path.split("»")
             order = len(fields)
 
         return order
@@ -262,13 +341,13 @@ class Composition:
         if path == "":
             return "", ""
         else:
-            fields = path.split("\xc2\xbb")
+            fields = path.split("»")
 
             if len(fields) > 1:
                 text = fields[1]
                 if len(fields) > 2:
                     for field in fields[2:]:
-                        text += "\xc2\xbb" + field
+                        text += "»" + field
                 return fields[0], text
             else:
                 return fields[0], ""
@@ -290,6 +369,20 @@ class Composition:
 
     # ----MAIN FUNCTIONS
 
+    # ----
+    # SORT
+    # sort the vectors for the current POS by entry, on disk
+    # generally used after SPLIT when lowmemory is set: all files derived from the sorted file keep its entry order
+    # so that filter and normalise can merge join vectors with row totals
+    # ----
+    def sortentries(self):
+        from src.tools import outofcore
+
+        infile = self.selectpos()
+        print("Sorting " + infile + " by entry")
+        outofcore.sortfile(infile, infile + ".sorted", self.runbytes())
+        os.rename(infile + ".sorted", infile)
+
     # ----
     # SPLIT
     # take the original file and split it by POS
@@ -333,6 +426,16 @@ class Composition:
         instream.close()
         return
 
+    # ---
+    # the POS file an entry belongs in, using the same rules as SPLIT
+    # ---
+    def entrypos(self, entry):
+        pos = entry.split("/")[-1].lower()
+        for key in ["N", "V", "J", "R"]:
+            if pos.startswith(key.lower()):
+                return key
+        return "F"
+
     # ----
     # REDUCEORDER
     # generally used after SPLIT
@@ -372,6 +475,10 @@ class Composition:
     # MAKETOTALS
     # calculate row and column totals
     # this is usually done before filtering and also after filtering and normalisation
+    # with approxtotals set (and counts not yet normalised) column totals are first estimated with a count-min sketch
+    # and only features whose estimate is above filterfreq are counted exactly and written to .ctot
+    # with spilltotals set partial column totals are written to sorted run files whenever the memory budget is reached
+    # and the runs are merged, so .ctot comes out sorted by feature
     # ------
 
     def maketotals(self):
@@ -387,6 +494,17 @@ class Composition:
         cols = open(coltotals, "w")
 
         featuretotals = {}
+        sketch = None
+        runs = []
+        if self.approxtotals and not self.normalised:
+            from src.tools import outofcore
+
+            sketch = outofcore.CountMinSketch(self.sketchwidth, self.sketchdepth)
+        elif self.spilltotals:
+            from src.tools import outofcore
+
+            spillsize = max(1, self.budgetbytes() // Composition.bytesperfeature)
+            print("Spilling column totals to disk every " + str(spillsize) + " features")
         with open(infile) as instream:
             lines = 0
             for line in instream:
@@ -411,13 +529,30 @@ class Composition:
                     try:
                         freq = float(freq)
                         rowtotal += freq
-                        current = featuretotals.get(feat, 0.0)
-                        featuretotals[feat] = current + freq
+                        if sketch is None:
+                            current = featuretotals.get(feat, 0.0)
+                            featuretotals[feat] = current + freq
+                        else:
+                            sketch.add(feat, freq)
                     except ValueError:
                         print("Error: " + str(index) + "\t" + feat + "\t" + str(freq) + "\n")
                         features = features + list(feat)
 
                 rows.write(entry + "\t" + str(rowtotal) + "\n")
+                if self.spilltotals and sketch is None and len(featuretotals) >= spillsize:
+                    runs.append(outofcore.writetotals(featuretotals, coltotals + ".run_" + str(len(runs))))
+                    featuretotals = {}
+
+        if sketch is not None:
+            featuretotals = self.heavyhitters(infile, sketch)
+        elif self.spilltotals:
+            runs.append(outofcore.writetotals(featuretotals, coltotals + ".run_" + str(len(runs))))
+            featuretotals = {}
+            rows.close()
+            cols.close()
+            print("Merging " + str(len(runs)) + " runs of column totals into " + coltotals)
+            outofcore.mergetotals(runs, coltotals)
+            return
 
         for feat in list(featuretotals.keys()):
             cols.write(feat + "\t" + str(featuretotals[feat]) + "\n")
@@ -425,14 +560,43 @@ class Composition:
         rows.close()
         cols.close()
 
+    # ---
+    # second pass of approximate MAKETOTALS
+    # count exactly only the features which the sketch estimates to be above filterfreq
+    # the sketch never underestimates so no feature above filterfreq is missed
+    # ---
+    def heavyhitters(self, infile, sketch):
+        featuretotals = {}
+        with open(infile) as instream:
+            for line_num, line in enumerate(instream):
+                if line_num % 1000 == 0:
+                    print("Counting candidate features, line " + str(line_num))
+                features = line.rstrip().split("\t")[1:]
+                while len(features) > 1:
+                    freq = features.pop()
+                    feat = features.pop()
+                    if feat in featuretotals:
+                        featuretotals[feat] += float(freq)
+                    elif sketch.estimate(feat) > self.filterfreq:
+                        featuretotals[feat] = float(freq)
+
+        candidates = len(featuretotals)
+        for feat in list(featuretotals.keys()):
+            if featuretotals[feat] <= self.filterfreq:
+                del featuretotals[feat]
+        print("Count-min sketch found " + str(candidates) + " candidate features, of which " +
+              str(candidates - len(featuretotals)) + " were at or below " + str(self.filterfreq) +
+              " once counted exactly (features the sketch alone would have misclassified)")
+        print("Sketch estimates exceed exact totals by at most " + str(sketch.errorbound()) +
+              " with probability " + str(sketch.confidence()))
+        return featuretotals
+
     # ---
     # subsequenct functions in pipeline can load pre-calcualated row totals using this function
     # ---
-    def load_rowtotals(self):
-        infile = self.selectpos() + self.reducedstring
-        if self.normalised and not self.option == "normalise":
-            infile += ".filtered.norm"
-        rowtotals = infile + ".rtot"
+    def load_rowtotals(self, rowtotals=""):
+        if rowtotals == "":
+            rowtotals = self.selecttotals() + ".rtot"
         totals = {}
         print("Loading entry totals from: " + rowtotals)
         with open(rowtotals) as instream:
@@ -449,10 +613,7 @@ class Composition:
     # subsequent functions in pipeline can load pre-calculated column totals using this function
     # ----
     def load_coltotals(self):
-        infile = self.selectpos() + self.reducedstring
-        if self.normalised and not self.option == "normalise":
-            infile += ".filtered.norm"
-        coltotals = infile + ".ctot"
+        coltotals = self.selecttotals() + ".ctot"
         totals = {}
         print("Loading feature totals from: " + coltotals)
         with open(coltotals) as instream:
@@ -475,22 +636,33 @@ class Composition:
         infile = self.selectpos() + self.reducedstring
         outfile = infile + ".filtered"
 
-        coltotals = self.load_coltotals()
         savereducedstring = self.reducedstring
-        self.reducedstring = ".reduce_1_1"  # always use same rowtotals for filtering whatever the reduction
-        rowtotals = self.load_rowtotals()
+        if self.lowmemory:
+            from src.tools import outofcore
+
+            coltotals = outofcore.FeatureSet(self.selecttotals() + ".ctot", self.filterfreq, self.runbytes())
+            self.reducedstring = ".reduce_1_1"  # always use same rowtotals for filtering whatever the reduction
+            rowtotals = outofcore.SortedTotals(self.selecttotals() + ".rtot", self.filterfreq)
+            todo = 0
+        else:
+            coltotals = self.load_coltotals()
+            self.reducedstring = ".reduce_1_1"  # always use same rowtotals for filtering whatever the reduction
+            rowtotals = self.load_rowtotals()
+            todo = len(rowtotals)
         self.reducedstring = savereducedstring
         outstream = open(outfile, "w")
         print("Filtering for words ", self.words)
         print("Filtering for frequency ", self.filterfreq)
-        todo = len(rowtotals)
         with open(infile) as instream:
             lines = 0
             for line in instream:
                 line = line.rstrip()
                 if lines % 1000 == 0:
-                    percent = lines * 100.0 / todo
-                    print("Processing line " + str(lines) + "(" + str(percent) + "%)")
+                    if todo > 0:
+                        percent = lines * 100.0 / todo
+                        print("Processing line " + str(lines) + "(" + str(percent) + "%)")
+                    else:
+                        print("Processing line " + str(lines))
                 lines += 1
                 fields = line.split("\t")
                 # entry=fields[0].lower()
@@ -505,10 +677,14 @@ class Composition:
                         freq = features.pop()
                         # feat=features.pop().lower()
                         feat = features.pop()
-                        feattot = float(coltotals.get(feat, 0))
+                        if self.lowmemory:
+                            keep = feat in coltotals
+                        else:
+                            feattot = float(coltotals.get(feat, 0))
+                            keep = feattot > self.filterfreq
                         # print feat+"\t"+str(feattot-self.filterfreq)
 
-                        if feattot > self.filterfreq:
+                        if keep:
                             outline += "\t" + feat + "\t" + freq
                             nofeats += 1
 
@@ -518,6 +694,9 @@ class Composition:
                     print("Ignoring " + entry + " with frequency " + str(entrytot))
 
         outstream.close()
+        if self.lowmemory:
+            coltotals.close()
+            rowtotals.close()
 
     # ----
     # NORMALISE
@@ -526,14 +705,23 @@ class Composition:
     # so necessary to call maketotals again after normalise
     # -----
     def normalise(self):
-        rowtotals = self.load_rowtotals()
+        if self.lowmemory:
+            from src.tools import outofcore
+
+            if self.normalised:
+                rowtotals = outofcore.SortedTotals(self.selecttotals() + ".rtot")
+            else:
+                rowtotals = outofcore.SortedTotals(self.selecttotals() + ".rtot", self.filterfreq)
+            todo = 0
+        else:
+            rowtotals = self.load_rowtotals()
+            todo = len(list(rowtotals.keys()))
         infile = self.selectpos() + self.reducedstring + ".filtered"
         outfile = infile + ".norm"
 
         print("Normalising counts => sum to 1")
         outstream = open(outfile, "w")
 
-        todo = len(list(rowtotals.keys()))
         print("Estimated total vectors to do = " + str(todo))
         with open(infile) as instream:
             lines = 0
@@ -553,10 +741,14 @@ class Composition:
                 outline += "\n"
                 outstream.write(outline)
                 lines += 1
-                if lines % 1000 == 0:
+                if lines % 1000 == 0 and todo > 0:
                     percent = lines * 100.0 / todo
                     print("Completed " + str(lines) + " vectors (" + str(percent) + "%)")
+                elif lines % 1000 == 0:
+                    print("Completed " + str(lines) + " vectors")
         outstream.close()
+        if self.lowmemory:
+            rowtotals.close()
         self.normalised = True
 
     # ---
@@ -613,27 +805,30 @@ class Composition:
         # write a set of vectors to file
         print("Writing vectors to output file: " + outfile)
         with open(outfile, "w") as outstream:
-            for entry in list(vectors.keys()):
-                vector = vectors[entry]
-                print(entry)
-                # print vector
-                if len(list(vector.keys())) > 0:
-                    outstring = entry
-                    ignored = 0
-                    nofeats = 0
-                    for feat in list(vector.keys()):
-                        forder = self.getorder(feat)
+            self.writevectors(vectors, outstream)
 
-                        if forder >= self.minorder and forder <= self.maxorder:
+    def writevectors(self, vectors, outstream):
+        for entry in list(vectors.keys()):
+            vector = vectors[entry]
+            print(entry)
+            # print vector
+            if len(list(vector.keys())) > 0:
+                outstring = entry
+                ignored = 0
+                nofeats = 0
+                for feat in list(vector.keys()):
+                    forder = self.getorder(feat)
 
-                            try:
-                                outstring += "\t" + feat + "\t" + str(vector[feat])
-                                nofeats += 1
-                            except:
-                                ignored += 1
-                    print("Ignored " + str(ignored) + " features")
-                    if nofeats > 0:
-                        outstream.write(outstring + "\n")
+                    if forder >= self.minorder and forder <= self.maxorder:
+
+                        try:
+                            outstring += "\t" + feat + "\t" + str(vector[feat])
+                            nofeats += 1
+                        except:
+                            ignored += 1
+                print("Ignored " + str(ignored) + " features")
+                if nofeats > 0:
+                    outstream.write(outstring + "\n")
 
     # ----SALIENCY FUNCTIONS
 
@@ -744,26 +939,10 @@ class Composition:
     # ------
     def revectorise(self):
 
-        if self.normalised:
-            suffix = ".norm"
-        else:
-            suffix = ""
-        if self.pp_normal:
-            suffix += ".pnppmi"
-        elif self.gof_ppmi:
-            suffix += ".gof_ppmi"
-        elif self.smooth_ppmi:
-            suffix += ".smooth_ppmi"
-        else:
-            suffix += ".ppmi"
-        if self.ppmithreshold > 0:
-            suffix += "_" + str(self.ppmithreshold)
-        if self.saliency > 0:
-            if self.saliencyperpath:
-                suffix += ".spp_" + str(self.saliency)
-            else:
-                suffix += ".sal_" + str(self.saliency)
-        outfile = self.selectpos() + self.reducedstring + ".filtered" + suffix
+        outfile = self.selectpos() + self.reducedstring + ".filtered" + self.weightingsuffix()
+        if self.memorybudget > 0:
+            self.revectorise_sharded(outfile)
+            return
         self.vecsbypos[self.pos] = self.load_vectors()
         self.feattotsbypos[self.pos] = self.load_coltotals()
         self.totsbypos[self.pos] = self.load_rowtotals()
@@ -775,6 +954,355 @@ class Composition:
                                     self.totsbypos[self.pos])
         self.output(ppmivecs, outfile)
 
+    # ----
+    # out-of-core version of REVECTORISE used when memorybudget is set
+    # vectors and row totals are partitioned by entry hash into shards small enough to fit the budget
+    # column totals and type totals are global so are loaded once and shared by every shard
+    # ----
+    def revectorise_sharded(self, outfile):
+        infile = self.selectpos() + self.reducedstring + ".filtered"
+        rowtotals = self.selectpos() + self.reducedstring
+        if self.normalised:
+            infile += ".norm"
+            rowtotals += ".filtered.norm"
+        rowtotals += ".rtot"
+
+        nshards = self.countshards(infile)
+        print("Revectorising " + infile + " in " + str(nshards) + " shards")
+        vecshards = self.shardfiles(infile, nshards)
+        totshards = self.shardfiles(rowtotals, nshards)
+
+        try:
+            self.partition(infile, nshards)
+            self.partition(rowtotals, nshards)
+            feattots = self.load_coltotals()
+            typetots = self.compute_typetotals(feattots)
+
+            print("Writing vectors to output file: " + outfile)
+            with open(outfile, "w") as outstream:
+                for shard in range(nshards):
+                    print("Processing shard " + str(shard + 1) + " of " + str(nshards))
+                    vecs = self.load_vectors(vecshards[shard])
+                    entrytots = self.load_rowtotals(totshards[shard])
+                    pathtots = self.compute_nounpathtotals(vecs)
+                    ppmivecs = self.computeppmi(vecs, pathtots, feattots, typetots, entrytots)
+                    self.writevectors(ppmivecs, outstream)
+        finally:
+            for shardfile in vecshards + totshards:
+                if os.path.exists(shardfile):
+                    os.remove(shardfile)
+
+    # ---
+    # number of entry-hash shards needed for the vectors in infile to fit within self.memorybudget
+    # ---
+    def countshards(self, infile):
+        needed = os.path.getsize(infile) * Composition.memoryfactor
+        return max(1, int(math.ceil(needed / (self.memorybudget * 1024.0 * 1024.0))))
+
+    # ---
+    # split a file whose lines start with an entry into nshards files by hash of the entry
+    # a stable hash is used so that vectors and row totals for an entry always land in the same shard
+    # ---
+    def partition(self, infile, nshards):
+        shardfiles = self.shardfiles(infile, nshards)
+        outstreams = []
+        try:
+            for shardfile in shardfiles:
+                outstreams.append(open(shardfile, "w"))
+            with open(infile) as instream:
+                for line_num, line in enumerate(instream):
+                    if line_num % 100000 == 0:
+                        print("Partitioning line " + str(line_num))
+                    entry = line.split("\t", 1)[0].rstrip()
+                    outstreams[zlib.crc32(entry.encode("utf-8")) % nshards].write(line)
+        finally:
+            for outstream in outstreams:
+                outstream.close()
+        return shardfiles
+
+    # ---
+    # names of the nshards files which partition splits infile into
+    # ---
+    def shardfiles(self, infile, nshards):
+        return [infile + ".shard_" + str(shard) for shard in range(nshards)]
+
+    # ----
+    # UPDATE
+    # fold a delta file of raw APT vectors (e.g. from a new corpus batch) into the existing reduced counts and totals,
+    # then refilter, renormalise and recompute PPMI only where it can have changed
+    # run for minorder = maxorder = 1 first, as the filter stage uses the .reduce_1_1 row totals
+    # with updatetolerance = 0 the output is the same as rebuilding from raw counts which include the delta
+    # ----
+    def update(self):
+        if self.approxtotals:
+            print("Error: update needs exact column totals for every feature so cannot be used with approxtotals")
+            return
+        reduced = self.selectpos() + self.reducedstring
+        self.normalised = True
+        outfile = self.selectpos() + self.reducedstring + ".filtered" + self.weightingsuffix()
+        normfile = self.selectpos() + self.reducedstring + ".filtered.norm"
+        self.normalised = False
+
+        # every file which update rewrites is kept as .old until the update has finished and is put back if it fails,
+        # so that the update can simply be run again
+        # the reduced counts and their totals come last so that they are restored if the update is interrupted
+        # while the backups are being removed: the delta is then folded in again rather than twice
+        backups = [reduced + ".filtered", normfile, normfile + ".rtot", normfile + ".ctot", outfile,
+                   reduced, reduced + ".rtot", reduced + ".ctot"]
+        self.restorebackups(backups)
+
+        delta = self.load_delta()
+        self.folddelta(delta)
+        try:
+            for filename in backups:
+                if os.path.exists(filename):
+                    os.rename(filename, filename + ".old")
+            for filename in [reduced, reduced + ".rtot", reduced + ".ctot"]:
+                os.rename(filename + ".new", filename)
+
+            self.filter()
+            self.normalise()
+            self.maketotals()
+            self.revectorise_incremental(outfile)
+        except BaseException:
+            print("Update failed: restoring the previous files")
+            self.restorebackups(backups)
+            for filename in [normfile + ".changed", outfile + ".changed"]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            raise
+
+        for filename in backups:
+            if os.path.exists(filename + ".old"):
+                os.remove(filename + ".old")
+
+    # ---
+    # put back the files saved by an update which failed or was interrupted, and remove its partial output
+    # ---
+    def restorebackups(self, backups):
+        for filename in backups:
+            if os.path.exists(filename + ".old"):
+                print("Restoring " + filename + " from an unfinished update")
+                os.replace(filename + ".old", filename)
+            if os.path.exists(filename + ".new"):
+                os.remove(filename + ".new")
+
+    # ---
+    # load the vectors in self.deltafile for the current POS, keeping features within the order thresholds
+    # ---
+    def load_delta(self):
+        print("Loading delta vectors from: " + self.deltafile)
+        delta = {}
+        with open(self.deltafile) as instream:
+            for line in instream:
+                fields = line.rstrip().split("\t")
+                entry = fields[0]
+                if self.entrypos(entry) != self.pos:
+                    continue
+                vector = delta.setdefault(entry, {})
+                features = fields[1:]
+                while len(features) > 1:
+                    freq = float(features.pop())
+                    feat = features.pop()
+                    forder = self.getorder(feat)
+                    if forder >= self.minorder and forder <= self.maxorder:
+                        vector[feat] = vector.get(feat, 0.0) + freq
+        print("Loaded " + str(len(delta)) + " delta vectors")
+        return delta
+
+    # ---
+    # add the delta counts into the reduced vectors file and its row and column totals
+    # the new versions are written next to the current ones with a .new suffix, for update to move into place
+    # ---
+    def folddelta(self, delta):
+        from src.tools import outofcore
+
+        infile = self.selectpos() + self.reducedstring
+        rowdelta = {}
+        coldelta = {}
+        for entry in delta:
+            rowdelta[entry] = sum(delta[entry].values())
+            for feat in delta[entry]:
+                coldelta[feat] = coldelta.get(feat, 0.0) + delta[entry][feat]
+
+        def foldvector(entry, line):
+            vector = delta[entry]
+            fields = line.rstrip().split("\t")
+            features = fields[1:]
+            for index in range(0, len(features) - 1, 2):
+                if features[index] in vector:
+                    features[index + 1] = self.formatcount(float(features[index + 1]) + vector[features[index]])
+            for feat in vector:
+                if feat not in features[0::2]:
+                    features += [feat, self.formatcount(vector[feat])]
+            return self.join([entry] + features, "\t") + "\n"
+
+        newvectors = dict((entry, self.join([entry] + [self.join([feat, self.formatcount(delta[entry][feat])], "\t")
+                                                       for feat in delta[entry]], "\t") + "\n")
+                          for entry in delta if len(delta[entry]) > 0)
+        found = self.foldlines(infile, delta, foldvector, newvectors)
+        print("Folded " + str(len(found)) + " existing and " + str(len(set(newvectors) - found)) +
+              " new entries into " + infile)
+
+        def foldtotal(entry, line):
+            total = line.rstrip().split("\t")[1]
+            return entry + "\t" + str(float(total) + rowdelta[entry]) + "\n"
+
+        self.foldlines(infile + ".rtot", rowdelta, foldtotal,
+                       dict((entry, entry + "\t" + str(rowdelta[entry]) + "\n") for entry in newvectors), every=True)
+
+        coltotals = infile + ".ctot"
+        if self.spilltotals:
+            # keep .ctot sorted by merging the delta totals in as another run
+            outofcore.mergetotals([coltotals, outofcore.writetotals(coldelta, coltotals + ".run_delta")],
+                                  coltotals + ".new", keep=[coltotals])
+        else:
+            done = set()
+            with open(coltotals + ".new", "w") as outstream:
+                with open(coltotals) as instream:
+                    for line in instream:
+                        feat, total = line.rstrip().split("\t")
+                        if feat in coldelta:
+                            line = feat + "\t" + str(float(total) + coldelta[feat]) + "\n"
+                            done.add(feat)
+                        outstream.write(line)
+                for feat in coldelta:
+                    if feat not in done:
+                        outstream.write(feat + "\t" + str(coldelta[feat]) + "\n")
+        print("Updated totals for " + str(len(rowdelta)) + " entries and " + str(len(coldelta)) + " features")
+
+    # ---
+    # copy a file whose lines start with an entry to a .new file, replacing each line for an entry in changes
+    # with fold(entry, line), and adding the lines in extra for entries which are not in the file
+    # only the first line of an entry is folded unless every is set; a totals file needs every, since
+    # load_rowtotals keeps the last of several lines for an entry
+    # in lowmemory mode the file is sorted by entry and the extra lines are merged into place, otherwise they are appended
+    # returns the entries found in the file
+    # ---
+    def foldlines(self, infile, changes, fold, extra, every=False):
+        from src.tools import outofcore
+
+        found = set()
+        written = set()
+        pending = sorted(extra) if self.lowmemory else []
+        nextextra = 0
+        with open(infile + ".new", "w") as outstream:
+            with open(infile) as instream:
+                for line in instream:
+                    if not line.endswith("\n"):
+                        line += "\n"
+                    entry = outofcore.linekey(line).rstrip()
+                    while nextextra < len(pending) and pending[nextextra] < entry:
+                        if pending[nextextra] not in found:
+                            outstream.write(extra[pending[nextextra]])
+                            written.add(pending[nextextra])
+                        nextextra += 1
+                    if entry in changes and (every or entry not in found):
+                        found.add(entry)
+                        line = fold(entry, line)
+                    outstream.write(line)
+            for entry in (pending if self.lowmemory else extra):
+                if entry not in found and entry not in written:
+                    outstream.write(extra[entry])
+        return found
+
+    # ---
+    # write a count without a trailing .0 if it is a whole number, as in the raw vector files
+    # ---
+    def formatcount(self, count):
+        if count == int(count):
+            return str(int(count))
+        return str(count)
+
+    # ---
+    # recompute PPMI only for entries whose normalised vector changed or which have a feature whose column total,
+    # or whose path type total, moved by more than updatetolerance; copy the old output for every other entry
+    # ---
+    def revectorise_incremental(self, outfile):
+        from src.tools import outofcore
+
+        normfile = self.selectpos() + self.reducedstring + ".filtered.norm"
+        # a digest of each old line, strong enough that a different line is never taken for an unchanged one
+        def digest(line):
+            return hashlib.blake2b(line.encode("utf-8"), digest_size=20).digest()
+
+        oldlines = {}
+        with open(normfile + ".old") as instream:
+            for line in instream:
+                oldlines[outofcore.linekey(line)] = digest(line)
+
+        feattots = self.load_coltotals()
+        typetots = self.compute_typetotals(feattots)
+        oldtypetots = {}
+        movedfeatures = set()
+        with open(normfile + ".ctot.old") as instream:
+            for line in instream:
+                feat, total = line.rstrip().split("\t")
+                pathtype = self.getpathtype(feat)
+                oldtypetots[pathtype] = oldtypetots.get(pathtype, 0.0) + float(total)
+                if self.moved(float(total), feattots.get(feat, 0.0)):
+                    movedfeatures.add(feat)
+        movedtypes = set(pathtype for pathtype in typetots if self.moved(oldtypetots.get(pathtype, 0.0),
+                                                                         typetots[pathtype]))
+        print("Column totals moved past tolerance for " + str(len(movedfeatures)) + " features and " +
+              str(len(movedtypes)) + " path types")
+
+        changed = set()
+        entries = []
+        with open(normfile + ".changed", "w") as outstream:
+            with open(normfile) as instream:
+                for line in instream:
+                    entry = outofcore.linekey(line)
+                    entries.append(entry)
+                    features = line.rstrip().split("\t")[1::2]
+                    if oldlines.get(entry) != digest(line) or (self.gof_ppmi and movedtypes) or any(
+                                    feat in movedfeatures or self.getpathtype(feat) in movedtypes for feat in features):
+                        changed.add(entry)
+                        outstream.write(line)
+        print("Recomputing PPMI for " + str(len(changed)) + " of " + str(len(entries)) + " vectors, reusing " +
+              str(len(entries) - len(changed)))
+
+        vecs = self.load_vectors(normfile + ".changed")
+        ppmivecs = self.computeppmi(vecs, self.compute_nounpathtotals(vecs), feattots, typetots, self.load_rowtotals())
+        self.output(ppmivecs, outfile + ".changed")
+        os.remove(normfile + ".changed")
+
+        # reassemble the output in the order of the vectors file, as a full revectorise would
+        newstream, newoffsets = self.indexlines(outfile + ".changed")
+        oldstream, oldoffsets = self.indexlines(outfile + ".old")
+        with open(outfile, "wb") as outstream:
+            for entry in entries:
+                if entry in changed:
+                    instream, offsets = newstream, newoffsets
+                else:
+                    instream, offsets = oldstream, oldoffsets
+                if entry in offsets:
+                    instream.seek(offsets[entry])
+                    outstream.write(instream.readline())
+        newstream.close()
+        oldstream.close()
+        os.remove(outfile + ".changed")
+
+    # ---
+    # open a vectors file and find the byte offset of the first line for each entry
+    # ---
+    def indexlines(self, filename):
+        offsets = {}
+        instream = open(filename, "rb")
+        offset = 0
+        for line in instream:
+            offsets.setdefault(line.split(b"\t", 1)[0].rstrip().decode("utf-8"), offset)
+            offset += len(line)
+        return instream, offsets
+
+    # ---
+    # whether a total has changed by more than updatetolerance, relative to its old value
+    # ---
+    def moved(self, old, new):
+        if old == 0:
+            return new != 0
+        return abs(new - old) > self.updatetolerance * abs(old)
+
     # ---
     # use POS to determine which vectors/totals to supply to self.mostsalientvecs
     # ----
@@ -864,26 +1392,7 @@ class Composition:
     # ----
     def compose(self):
 
-        if self.normalised:
-            suffix = ".norm"
-        else:
-            suffix = ""
-        if self.pp_normal:
-            suffix += ".pnppmi"
-        elif self.gof_ppmi:
-            suffix += ".gof_ppmi"
-        elif self.smooth_ppmi:
-            suffix += ".smooth_ppmi"
-        else:
-            suffix += ".ppmi"
-        if self.ppmithreshold > 0:
-            suffix += "_" + str(self.ppmithreshold)
-        if self.saliency > 0:
-            if self.saliencyperpath:
-                suffix += ".spp_" + str(self.saliency)
-            else:
-                suffix += ".sal_" + str(self.saliency)
-        outfile = self.selectpos() + self.reducedstring + ".composed" + suffix
+        outfile = self.selectpos() + self.reducedstring + ".composed" + self.weightingsuffix()
 
         for pos in ["N", "J"]:
             self.pos = pos
@@ -1012,7 +1521,7 @@ class Composition:
             elif feature.startswith(":"):
                 newfeature = headPREFIX + feature
             else:
-                newfeature = headPREFIX + "\xc2\xbb" + feature
+                newfeature = headPREFIX + "»" + feature
             if not newfeature == "":
                 offsetvector[newfeature] = depvector[feature]
         # print "Features in original adj vector: "+str(len(adjvector.keys()))
@@ -1090,6 +1599,8 @@ class Composition:
             print("Stage: " + self.option)
             if self.option == "split":
                 self.splitpos()
+            elif self.option == "sort":
+                self.sortentries()
             elif self.option == "reduceorder":
                 self.reduceorder()
             elif self.option == "maketotals":
@@ -1108,6 +1619,8 @@ class Composition:
                 self.intersect()
             elif self.option == "rewrite":
                 self.rewrite()
+            elif self.option == "update":
+                self.update()
 
 
             else:
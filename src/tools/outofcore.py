@@ -0,0 +1,259 @@
+from __future__ import print_function
+__author__ = 'juliewe'
+# helpers for working with APT vector and totals files which are too big to hold in memory
+# sortfile : external sort of a tab-separated file by its first field
+# SortedTotals : merge-join lookups into a totals file sorted by its first field
+# FeatureSet : compact membership test for the features which survive a frequency threshold
+# CountMinSketch : bounded-memory estimates of feature totals
+# writetotals / mergetotals : external aggregation of totals via sorted run files
+
+import os
+import math
+import heapq
+import zlib
+import bisect
+from array import array
+
+
+# ---
+# the key of a line in any of our files is its first tab-separated field
+# ---
+def linekey(line):
+    return line.split("\t", 1)[0].rstrip("\n")
+
+
+# ----
+# sort infile by first field into outfile without holding more than runbytes of lines in memory
+# sorted runs are written next to outfile and then k-way merged
+# the sort is stable so repeated keys keep their original order
+# ----
+def sortfile(infile, outfile, runbytes):
+    runs = []
+    lines = []
+    size = 0
+    with open(infile) as instream:
+        for line in instream:
+            if not line.endswith("\n"):
+                line += "\n"
+            lines.append(line)
+            size += len(line)
+            if size >= runbytes:
+                runs.append(writerun(lines, outfile + ".run_" + str(len(runs))))
+                lines = []
+                size = 0
+    if lines or not runs:
+        runs.append(writerun(lines, outfile + ".run_" + str(len(runs))))
+    print("Merging " + str(len(runs)) + " sorted runs into " + outfile)
+    mergeruns(runs, outfile)
+    return outfile
+
+
+def writerun(lines, runfile):
+    lines.sort(key=linekey)
+    with open(runfile, "w") as outstream:
+        outstream.writelines(lines)
+    return runfile
+
+
+# ---
+# k-way merge of files already sorted by first field; the run files are removed afterwards
+# ---
+def mergeruns(runs, outfile):
+    instreams = [open(run) for run in runs]
+    with open(outfile, "w") as outstream:
+        outstream.writelines(heapq.merge(*instreams, key=linekey))
+    for instream in instreams:
+        instream.close()
+    for run in runs:
+        os.remove(run)
+
+
+# ---
+# write a dict of totals to runfile sorted by key
+# ---
+def writetotals(totals, runfile):
+    with open(runfile, "w") as outstream:
+        for key in sorted(totals):
+            outstream.write(key + "\t" + str(totals[key]) + "\n")
+    return runfile
+
+
+# ---
+# k-way merge of sorted runs of totals, adding together the totals for a key found in more than one run
+# the run files are removed afterwards, apart from any listed in keep
+# ---
+def mergetotals(runs, outfile, keep=()):
+    instreams = [open(run) for run in runs]
+    with open(outfile, "w") as outstream:
+        currentkey = None
+        currenttotal = 0.0
+        for line in heapq.merge(*instreams, key=linekey):
+            key, total = line.rstrip("\n").split("\t")
+            if key != currentkey:
+                if currentkey is not None:
+                    outstream.write(currentkey + "\t" + str(currenttotal) + "\n")
+                currentkey = key
+                currenttotal = 0.0
+            currenttotal += float(total)
+        if currentkey is not None:
+            outstream.write(currentkey + "\t" + str(currenttotal) + "\n")
+    for instream in instreams:
+        instream.close()
+    for run in runs:
+        if run not in keep:
+            os.remove(run)
+
+
+class SortedTotals:
+    """
+    Row totals read by merge join rather than loaded into a dict.
+    Lookups must be made in non-decreasing key order, which holds when the vectors being
+    processed are sorted in the same order as the totals file.
+    Lines with a total not above minimum are skipped, mirroring Composition.load_rowtotals.
+    """
+
+    def __init__(self, filename, minimum=None):
+        self.filename = filename
+        self.minimum = minimum
+        self.instream = open(filename)
+        self.lastkey = None
+        self.lastvalue = None
+        self.pending = self.readline()
+
+    def readline(self):
+        line = self.instream.readline()
+        if line == "":
+            return None
+        fields = line.rstrip().split("\t")
+        return fields[0], float(fields[1])
+
+    def get(self, key, default=None):
+        if self.lastkey is not None and key < self.lastkey:
+            raise ValueError("Lookup of " + key + " after " + self.lastkey + ": " + self.filename +
+                             " and the vectors must be sorted by entry (run the sort stage)")
+        if key != self.lastkey:
+            self.lastkey = key
+            self.lastvalue = None
+            while self.pending is not None and self.pending[0] < key:
+                self.pending = self.readline()
+            while self.pending is not None and self.pending[0] == key:
+                if self.minimum is None or self.pending[1] > self.minimum:
+                    self.lastvalue = self.pending[1]
+                self.pending = self.readline()
+        if self.lastvalue is None:
+            return default
+        return self.lastvalue
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def close(self):
+        self.instream.close()
+
+
+class FeatureSet:
+    """
+    Exact membership test for the features in a column totals file with a total above threshold.
+    The surviving features are sorted into a file on disk and found by binary search over an array
+    of line offsets; a bitset over two hashes of each survivor answers most misses without a seek.
+    Memory use is the bitset plus 8 bytes per surviving feature, whatever the vocabulary size.
+    """
+
+    def __init__(self, coltotals, threshold, runbytes, bits=1 << 27):
+        self.bits = bits
+        self.bitset = bytearray(bits // 8)
+        self.filename = coltotals + ".above_" + str(threshold)
+        unsorted = self.filename + ".unsorted"
+        with open(coltotals) as instream:
+            with open(unsorted, "w") as outstream:
+                for line in instream:
+                    fields = line.rstrip().split("\t")
+                    if float(fields[1]) > threshold:
+                        outstream.write(fields[0] + "\n")
+        sortfile(unsorted, self.filename, runbytes)
+        os.remove(unsorted)
+
+        self.offsets = array("q")
+        self.instream = open(self.filename, "rb")
+        offset = 0
+        for line in self.instream:
+            self.offsets.append(offset)
+            offset += len(line)
+            for position in self.positions(line.rstrip(b"\n")):
+                self.bitset[position >> 3] |= 1 << (position & 7)
+        print("Feature set " + self.filename + " holds " + str(len(self.offsets)) + " features")
+
+    def positions(self, key):
+        first = zlib.crc32(key)
+        return first % self.bits, zlib.crc32(key, first) % self.bits
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, feature):
+        key = feature.encode("utf-8")
+        for position in self.positions(key):
+            if not self.bitset[position >> 3] & (1 << (position & 7)):
+                return False
+        index = bisect.bisect_left(_OffsetKeys(self), key)
+        return index < len(self.offsets) and self.keyat(index) == key
+
+    def keyat(self, index):
+        self.instream.seek(self.offsets[index])
+        return self.instream.readline().rstrip(b"\n")
+
+    def close(self):
+        # the surviving features are only needed while the set is open
+        self.instream.close()
+        os.remove(self.filename)
+
+
+class _OffsetKeys:
+    # sequence view of the keys in a FeatureSet file so that bisect can search it on disk
+
+    def __init__(self, featureset):
+        self.featureset = featureset
+
+    def __len__(self):
+        return len(self.featureset)
+
+    def __getitem__(self, index):
+        return self.featureset.keyat(index)
+
+
+class CountMinSketch:
+    """
+    Count-min sketch over feature strings.
+    Estimates are never below the true total and exceed it by at most errorbound() with probability confidence().
+    Memory is 8 * width * depth bytes however many distinct features are added.
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.counts = array("d", [0.0]) * (width * depth)
+        self.total = 0.0
+
+    def positions(self, feature):
+        key = feature.encode("utf-8")
+        value = zlib.crc32(key)
+        for row in range(self.depth):
+            yield row * self.width + value % self.width
+            value = zlib.crc32(key, value)
+
+    def add(self, feature, count):
+        self.total += count
+        for position in self.positions(feature):
+            self.counts[position] += count
+
+    def estimate(self, feature):
+        return min(self.counts[position] for position in self.positions(feature))
+
+    def errorbound(self):
+        return math.e / self.width * self.total
+
+    def confidence(self):
+        return 1 - math.exp(-self.depth)
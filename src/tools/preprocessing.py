@@ -3,8 +3,22 @@ __author__ = 'juliewe'
 #includes tools for preprocessing
 #-> convertCONLL
 #: takes general CONLL format and converts it into APT input format
-
-import sys,gzip,os
+#-> convertdir
+#: converts every file in a directory, optionally in parallel e.g. python preprocessing.py convertdir dir 10 8
+#-> benchmark
+#: times sentence-at-a-time conversion against the original line-at-a-time conversion, writing a synthetic CoNLL file first if the file does not exist
+#-> balancedsplit
+#: splits a file into shards of whole sentences balanced by bytes or tokens, compressing in parallel e.g. python preprocessing.py balancedsplit file 16 8 tokens
+#-> showsentence
+#: prints one sentence from a block-compressed file using its index e.g. python preprocessing.py showsentence aptInput-file.gz sentence=1000
+#-> corpusstats
+#: histograms of sentence length, POS tags and dependency labels for a file, a block-compressed file or a directory, in parallel, written as JSON
+#: e.g. python preprocessing.py corpusstats dir 10 8
+#options can also be given as name=value, e.g. blocksize=1048576 makes convert, convertdir and balancedsplit write block-compressed output with a .idx index
+
+import sys,gzip,os,time,random,hashlib,heapq,bisect,io,json
+from collections import Counter
+from multiprocessing import Pool
 
 
 def configure(arguments):
@@ -12,6 +26,11 @@ def configure(arguments):
     parameters={}
     parameters['maxlength']=500
     parameters['lowercasing']=True
+    for argument in arguments[1:]:
+        if '=' in argument:
+            key,value=argument.split('=',1)
+            parameters[key]=int(value) if value.isdigit() else value
+    arguments=[argument for argument in arguments if '=' not in argument]
     if len(arguments)<3:
         print("Requires two arguments: option and filename")
         exit()
@@ -19,10 +38,14 @@ def configure(arguments):
         parameters["option"]=arguments[1]
         parameters["filename"]=arguments[2]
     if len(arguments)>3:
-        if parameters["option"]=="split":
+        if parameters["option"]=="split" or parameters["option"]=="balancedsplit":
             parameters["splits"]=int(arguments[3])
         else:
             parameters["linelength"]=int(arguments[3])
+    if len(arguments)>4:
+        parameters["workers"]=int(arguments[4])
+    if len(arguments)>5:
+        parameters["balance"]=arguments[5]
 
 
     return parameters
@@ -36,6 +59,154 @@ def getOutputName(filepath,prefix):
             outname+='/'+part
     return outname
 
+class SentenceStats(object):
+    #running statistics for a conversion or analysis
+    __slots__=('lines','sentences','currentmaxindex','maxlines','maxlines_sentpos','maxlines_linepos','maxlines_file',
+               'maxmaxindex','maxindex_sentpos','maxindex_linepos','maxindex_file')
+
+    def __init__(self):
+        self.lines=0
+        self.sentences=0
+        self.currentmaxindex=-1
+        self.maxlines=0
+        self.maxlines_sentpos=-1
+        self.maxlines_linepos=-1
+        self.maxlines_file=''
+        self.maxmaxindex=0
+        self.maxindex_sentpos=-1
+        self.maxindex_linepos=-1
+        self.maxindex_file=''
+
+#yield each sentence (lines up to and including the blank line which ends it) and its number of tokens
+def readsentences(instream):
+    block=[]
+    for line in instream:
+        block.append(line)
+        if not line.strip():
+            yield b''.join(block),len(block)-1
+            block=[]
+    if block:
+        yield b''.join(block),len(block)
+
+def readblock(job):
+    filename,offset,length=job
+    with open(filename,'rb') as instream:
+        instream.seek(offset)
+        return gzip.decompress(instream.read(length))
+
+class BlockWriter:
+    #gzip output written as independently compressed blocks (gzip members) which each end on a sentence boundary
+    #any gzip reader can read the whole file; the .idx sidecar gives the offset, compressed length, first sentence and
+    #number of sentences of each block so that BlockReader can seek to a sentence or decompress blocks in parallel
+    #callers must write whole sentences, saying how many each write contains
+    def __init__(self,filename,blocksize,pool=None,indexed=True):
+        self.filename=filename
+        self.blocksize=blocksize
+        self.pool=pool
+        self.outstream=open(filename,'wb')
+        self.index=open(filename+'.idx','w') if indexed else None
+        self.buffer=[]
+        self.buffered=0
+        self.sentences=0
+        self.offset=0
+        self.firstsentence=0
+        self.pending=[]
+
+    def write(self,data,sentences=1):
+        self.buffer.append(data)
+        self.buffered+=len(data)
+        self.sentences+=sentences
+        if self.buffered>=self.blocksize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data=b''.join(self.buffer)
+            if self.pool is None:
+                self.pending.append((gzip.compress(data),self.sentences))
+            else:
+                self.pending.append((self.pool.apply_async(gzip.compress,(data,)),self.sentences))
+            self.buffer=[]
+            self.buffered=0
+            self.sentences=0
+        while len(self.pending)>2:
+            self.writeblock()
+
+    def writeblock(self):
+        block,sentences=self.pending.pop(0)
+        if self.pool is not None:
+            block=block.get()
+        self.outstream.write(block)
+        if self.index is not None:
+            self.index.write(str(self.offset)+"\t"+str(len(block))+"\t"+str(self.firstsentence)+"\t"+str(sentences)+"\n")
+        self.offset+=len(block)
+        self.firstsentence+=sentences
+
+    def close(self):
+        self.flush()
+        while self.pending:
+            self.writeblock()
+        self.outstream.close()
+        if self.index is not None:
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+class BlockReader:
+    #random and parallel access to a file written by BlockWriter, using its .idx index
+    def __init__(self,filename):
+        self.filename=filename
+        self.offsets=[]
+        self.lengths=[]
+        self.firstsentences=[]
+        self.sentences=0
+        with open(filename+'.idx') as index:
+            for line in index:
+                offset,length,first,sentences=[int(field) for field in line.split('\t')]
+                self.offsets.append(offset)
+                self.lengths.append(length)
+                self.firstsentences.append(first)
+                self.sentences=first+sentences
+
+    def readblock(self,block):
+        return readblock((self.filename,self.offsets[block],self.lengths[block]))
+
+    #sentence number n (counting from 0) as bytes, decompressing only the block which holds it
+    def sentence(self,n):
+        if n<0 or n>=self.sentences:
+            raise IndexError("Sentence "+str(n)+" is not in "+self.filename+" which has "+str(self.sentences)+" sentences")
+        block=bisect.bisect_right(self.firstsentences,n)-1
+        for number,(sentence,length) in enumerate(readsentences(io.BytesIO(self.readblock(block)))):
+            if number==n-self.firstsentences[block]:
+                return sentence
+
+    #yield the decompressed blocks in order, decompressing up to workers blocks at a time
+    def blocks(self,workers=1):
+        jobs=[(self.filename,offset,length) for offset,length in zip(self.offsets,self.lengths)]
+        if workers>1:
+            pool=Pool(workers)
+            for data in pool.imap(readblock,jobs):
+                yield data
+            pool.close()
+            pool.join()
+        else:
+            for job in jobs:
+                yield readblock(job)
+
+class HashSink:
+    #output stream which only keeps a checksum of what is written to it, for benchmarking
+    def __init__(self):
+        self.md5=hashlib.md5()
+
+    def write(self,text):
+        if not isinstance(text,bytes):
+            text=text.encode('utf-8')
+        self.md5.update(text)
+
 class Converter:
 
     def __init__(self,parameters):
@@ -43,6 +214,10 @@ class Converter:
         self.linelength=self.parameters.get('linelength',10)
         self.maxlength=self.parameters.get('maxlength',500)
         self.lowercasing=self.parameters.get('lowercasing',False)
+        self.workers=self.parameters.get('workers',1)
+        self.balance=self.parameters.get('balance','bytes')
+        self.chunkbytes=self.parameters.get('chunkbytes',4*1048576)
+        self.blocksize=self.parameters.get('blocksize',0)
         self.prefix="aptInput-"
         if self.lowercasing: self.prefix+="lc-"
         if self.linelength==10:
@@ -52,6 +227,63 @@ class Converter:
             self.deppos=5
             self.labelpos=6
 
+    #convert a stream of CoNLL lines (bytes) a sentence at a time, writing APT input (bytes) to outstream if it is given
+    #lines whose number of fields is not linelength are sentence boundaries
+    def convertstream(self,instream,outstream=None):
+        stats=SentenceStats()
+        tabs=self.linelength-1
+        block=[]
+        for line in instream:
+            stats.lines+=1
+            if line.count(b'\t')==tabs:
+                block.append(line)
+            else:
+                self.endsentence(block,outstream,stats)
+                block=[]
+            if stats.lines%1000000==0:print("Processed "+str(stats.lines)+" lines with "+str(stats.sentences)+" sentences")
+        return stats
+
+    #process the lines of one sentence with a single decode, split and join
+    #the fields of all tokens are split into one flat list and each output column is taken as a strided slice of it
+    def endsentence(self,block,outstream,stats):
+        tokens=len(block)
+        if tokens>0:
+            step=self.linelength
+            end=tokens*step
+            fields=b''.join(block).decode('utf-8').replace('\n','\t').split('\t')
+            indexes=fields[0:end:step]
+            stats.currentmaxindex=int(indexes[-1])
+        if outstream is not None and stats.currentmaxindex<self.maxlength:
+            if tokens>0:
+                words=fields[1:end:step]
+                if self.lowercasing:
+                    words='\n'.join(words).lower().split('\n')
+                out=['\t']*(tokens*10)
+                out[0::10]=indexes
+                out[2::10]=words
+                out[3::10]=['/']*tokens
+                out[4::10]=fields[3:end:step]
+                out[6::10]=fields[self.deppos:end:step]
+                if self.labelpos==step-1:
+                    out[8::10]=[label.rstrip() for label in fields[self.labelpos:end:step]]
+                else:
+                    out[8::10]=fields[self.labelpos:end:step]
+                out[9::10]=['\n']*tokens
+                out.append('\n')
+                outstream.write(''.join(out).encode('utf-8'))
+            else:
+                outstream.write(b'\n')
+        stats.sentences+=1
+        if tokens>stats.maxlines:
+            stats.maxlines=tokens
+            stats.maxlines_sentpos=stats.sentences
+            stats.maxlines_linepos=stats.lines
+        if stats.currentmaxindex>stats.maxmaxindex:
+            stats.maxmaxindex=stats.currentmaxindex
+            stats.maxindex_sentpos=stats.sentences
+            stats.maxindex_linepos=stats.lines
+
+    #original line-at-a-time conversion, kept as the reference for benchmark
     def processline(self,line,outstream,data):
 
         fields=line.split('\t')
@@ -106,33 +338,90 @@ class Converter:
         return data
 
 
+    def report(self,stats):
+        print("Processed "+str(stats.lines)+" lines with "+str(stats.sentences)+" sentences")
+        print("Longest sentence by index: "+str(stats.maxmaxindex)+" tokens at sentence "+str(stats.maxindex_sentpos)+", line "+str(stats.maxindex_linepos)+stats.maxindex_file)
+        print("Longest sentence by lines: "+str(stats.maxlines)+" tokens at sentence "+str(stats.maxlines_sentpos)+", line "+str(stats.maxlines_linepos)+stats.maxlines_file)
+
+    #convert every file in a directory, self.workers at a time
+    #files whose output already exists are skipped - outputs are only given their final name once complete
     def convertdir(self):
         indir=self.parameters["filename"]
 
-        for datafile in [df for df in os.listdir(indir)]:
-            outfile=getOutputName(datafile,self.prefix)
-            self.convert(datafile,outfile)
-
+        jobs=[]
+        for datafile in sorted(os.listdir(indir)):
+            #skip earlier output, and the index sidecars and unfinished output of block-compressed files
+            if datafile.startswith("aptInput-") or datafile.startswith(".") or datafile.endswith(".idx") or datafile.endswith(".part"):
+                continue
+            inname=os.path.join(indir,datafile)
+            outname=getOutputName(inname,self.prefix)
+            if os.path.exists(outname):
+                print("Skipping "+inname+": "+outname+" already complete")
+            else:
+                jobs.append((inname,outname))
+
+        print("Converting "+str(len(jobs))+" files with "+str(self.workers)+" workers")
+        totals=SentenceStats()
+        totalbytes=0
+        start=time.time()
+        pool=Pool(self.workers)
+        for done,(inname,data,seconds) in enumerate(pool.imap_unordered(self.convertfile,jobs)):
+            size=os.path.getsize(inname)
+            totalbytes+=size
+            print("Completed %s (%d of %d) in %.1fs: %.2f MB/s, overall %.2f MB/s"%(inname,done+1,len(jobs),seconds,size/1048576.0/max(seconds,1e-6),totalbytes/1048576.0/max(time.time()-start,1e-6)))
+            self.mergedata(totals,data,inname)
+        pool.close()
+        pool.join()
+        self.report(totals)
+
+    #worker for convertdir
+    #a file which fails leaves no partial output behind, so that the next run converts it again
+    def convertfile(self,job):
+        inname,outname=job
+        start=time.time()
+        try:
+            data=self.convert(inname,outname+".part")
+            if self.blocksize>0:
+                os.rename(outname+".part.idx",outname+".idx")
+            os.rename(outname+".part",outname)
+        except BaseException:
+            for partial in [outname+".part",outname+".part.idx",outname+".idx"]:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            raise
+        return inname,data,time.time()-start
+
+    #add the statistics for one file into the running totals for a directory
+    def mergedata(self,totals,stats,inname):
+        totals.lines+=stats.lines
+        totals.sentences+=stats.sentences
+        if stats.maxlines>totals.maxlines:
+            totals.maxlines=stats.maxlines
+            totals.maxlines_sentpos=stats.maxlines_sentpos
+            totals.maxlines_linepos=stats.maxlines_linepos
+            totals.maxlines_file=" in "+inname
+        if stats.maxmaxindex>totals.maxmaxindex:
+            totals.maxmaxindex=stats.maxmaxindex
+            totals.maxindex_sentpos=stats.maxindex_sentpos
+            totals.maxindex_linepos=stats.maxindex_linepos
+            totals.maxindex_file=" in "+inname
 
     def convert(self, inname,outname):
 
 
         print("Converting "+inname+" and writing to "+outname)
         print("Lowercasing: ",self.lowercasing)
-        data=self.init_data()
-        data['writetooutput']=True
 
         with gzip.open(inname,'rb') as instream:
-            with gzip.open(outname,'wb') as outstream:
-
-                for line in instream:
-                    data['lines']+=1
-                    self.processline(line.rstrip(),outstream,data)
-                    if data['lines']%1000000==0:print("Processed "+str(data['lines'])+" lines with "+str(data['sentences'])+" sentences")
+            if self.blocksize>0:
+                outstream=BlockWriter(outname,self.blocksize)
+            else:
+                outstream=gzip.open(outname,'wb')
+            with outstream:
+                stats=self.convertstream(instream,outstream)
 
-        print("Processed "+str(data['lines'])+" lines with "+str(data['sentences'])+" sentences")
-        print("Longest sentence by index: "+str(data['maxmaxindex'])+" tokens at sentence "+str(data['maxindex_sentpos'])+", line "+str(data['maxindex_linepos']))
-        print("Longest sentence by lines: "+str(data['maxmaxindex'])+" tokens at sentence "+str(data['maxlines_sentpos'])+", line "+str(data['maxlines_linepos']))
+        self.report(stats)
+        return stats
 
 
     def analyse(self):
@@ -140,17 +429,56 @@ class Converter:
 
         print("Analysing "+inname+" with linelength "+str(self.linelength))
         with gzip.open(inname,'rb') as instream:
+            stats=self.convertstream(instream)
 
-            data = self.init_data()
-            for line in instream:
-                data['lines']+=1
-                if data['lines']%1000000==0:print("Processed "+str(data['lines'])+" lines with "+str(data['sentences'])+" sentences")
-                data=self.processline(line,'',data)
+        self.report(stats)
 
-        print("Processed "+str(data['lines'])+" lines with "+str(data['sentences'])+" sentences")
-        print("Longest sentence by index: "+str(data['maxmaxindex'])+" tokens at sentence "+str(data['maxindex_sentpos'])+", line "+str(data['maxindex_linepos']))
-        print("Longest sentence by lines: "+str(data['maxmaxindex'])+" tokens at sentence "+str(data['maxlines_sentpos'])+", line "+str(data['maxlines_linepos']))
 
+    #compare throughput of convertstream with the original processline on the same (decompressed) input
+    #both outputs are checksummed rather than compressed so that only the conversion is timed
+    def benchmark(self):
+        inname=self.parameters["filename"]
+        if not os.path.exists(inname):
+            self.makesynthetic(inname,self.parameters.get('sentences',200000))
+        with gzip.open(inname,'rb') as instream:
+            lines=instream.readlines()
+        size=sum(len(line) for line in lines)/1048576.0
+
+        start=time.time()
+        data=self.init_data()
+        data['writetooutput']=True
+        oldsink=HashSink()
+        for line in lines:
+            data['lines']+=1
+            self.processline(line.decode('utf-8').rstrip(),oldsink,data)
+        oldtime=time.time()-start
+
+        start=time.time()
+        newsink=HashSink()
+        self.convertstream(lines,newsink)
+        newtime=time.time()-start
+
+        print("Line-at-a-time: %.2fs (%.2f MB/s)"%(oldtime,size/oldtime))
+        print("Sentence-at-a-time: %.2fs (%.2f MB/s)"%(newtime,size/newtime))
+        print("Speedup: %.2fx, identical output: %s"%(oldtime/newtime,oldsink.md5.digest()==newsink.md5.digest()))
+
+    #write a gzipped CoNLL file of random sentences in the layout given by linelength
+    def makesynthetic(self,outname,sentences):
+        print("Writing "+str(sentences)+" synthetic sentences to "+outname)
+        tags=["NN","NNS","VB","VBD","JJ","DT","IN","RB","PRP"]
+        labels=["nsubj","dobj","amod","det","prep","pobj","advmod","root"]
+        rand=random.Random(0)
+        with gzip.open(outname,'wt') as outstream:
+            for sentence in range(sentences):
+                length=rand.randint(3,60)
+                rows=[]
+                for index in range(1,length+1):
+                    word="Word"+str(rand.randint(0,50000))
+                    fields=[str(index),word,word.lower(),rand.choice(tags),"_","_",str(rand.randint(0,length)),rand.choice(labels),"_","_"]
+                    if self.linelength==7:
+                        fields=fields[:5]+fields[6:8]
+                    rows.append("\t".join(fields)+"\n")
+                outstream.write("".join(rows)+"\n")
 
     def split(self):
         inname=self.parameters["filename"]
@@ -170,6 +498,143 @@ class Converter:
         for i in range(0,self.parameters["splits"]):
             outstreams[i].close()
 
+    #split into shards of whole sentences, giving each sentence to the shard with the least load so far (bytes or tokens)
+    #each shard is compressed in chunks by a pool of workers; every chunk is a separate gzip member, which gzip readers concatenate
+    #with blocksize set the chunks are that size and each shard gets a .idx index for BlockReader
+    def balancedsplit(self):
+        inname=self.parameters["filename"]
+        splits=self.parameters["splits"]
+        print("Splitting "+inname+" into "+str(splits)+" shards balanced by "+self.balance+" with "+str(self.workers)+" workers")
+        pool=Pool(self.workers)
+        if self.blocksize>0:
+            outstreams=[BlockWriter(getOutputName(inname,str(i)),self.blocksize,pool) for i in range(splits)]
+        else:
+            outstreams=[BlockWriter(getOutputName(inname,str(i)),self.chunkbytes,pool,indexed=False) for i in range(splits)]
+        loads=[(0,i) for i in range(splits)]
+        sizes=[0]*splits
+        sentences=[0]*splits
+        tokens=[0]*splits
+
+        with gzip.open(inname,'rb') as instream:
+            for sentence,length in readsentences(instream):
+                load,shard=heapq.heappop(loads)
+                outstreams[shard].write(sentence)
+                sizes[shard]+=len(sentence)
+                sentences[shard]+=1
+                tokens[shard]+=length
+                if self.balance=="tokens":
+                    heapq.heappush(loads,(load+length,shard))
+                else:
+                    heapq.heappush(loads,(load+len(sentence),shard))
+
+        for shard in range(splits):
+            outstreams[shard].close()
+            print("Shard "+str(shard)+": "+str(sentences[shard])+" sentences, "+str(tokens[shard])+" tokens, "+str(sizes[shard])+" bytes")
+        pool.close()
+        pool.join()
+
+    #map-reduce corpus statistics over the files in a directory, or over the blocks of block-compressed files
+    #histograms and totals are written as JSON to <filename>.stats.json
+    def corpusstats(self):
+        inname=self.parameters["filename"].rstrip('/')
+        if os.path.isdir(inname):
+            filenames=[os.path.join(inname,df) for df in sorted(os.listdir(inname)) if df.endswith('.gz') and not df.startswith("aptInput-")]
+        else:
+            filenames=[inname]
+        jobs=[]
+        for filename in filenames:
+            if os.path.exists(filename+'.idx'):
+                reader=BlockReader(filename)
+                jobs+=[(filename,offset,length) for offset,length in zip(reader.offsets,reader.lengths)]
+            else:
+                jobs.append((filename,0,-1))
+        totalbytes=sum(os.path.getsize(filename) for filename in filenames)
+        print("Analysing "+str(len(filenames))+" files as "+str(len(jobs))+" jobs with "+str(self.workers)+" workers")
+
+        start=time.time()
+        totals={'lines':0,'sentences':0,'tokens':0,'lengths':Counter(),'postags':Counter(),'labels':Counter()}
+        pool=Pool(self.workers)
+        for done,stats in enumerate(pool.imap_unordered(self.analysechunk,jobs)):
+            for key in totals:
+                totals[key]+=stats[key]
+            if (done+1)%100==0:print("Completed "+str(done+1)+" of "+str(len(jobs))+" jobs")
+        pool.close()
+        pool.join()
+        seconds=time.time()-start
+
+        lengths=sorted(totals['lengths'].items())
+        report={'files':len(filenames),
+                'lines':totals['lines'],
+                'sentences':totals['sentences'],
+                'tokens':totals['tokens'],
+                'longest_sentence':lengths[-1][0] if lengths else 0,
+                'sentence_length_percentiles':self.percentiles(lengths,[50,90,99,99.9]),
+                'sentence_lengths':dict((str(length),count) for length,count in lengths),
+                'pos_tags':dict(totals['postags'].most_common()),
+                'dependency_labels':dict(totals['labels'].most_common()),
+                'seconds':seconds,
+                'compressed_mb_per_second':totalbytes/1048576.0/max(seconds,1e-6)}
+        outname=inname+'.stats.json'
+        with open(outname,'w') as outstream:
+            json.dump(report,outstream,indent=1)
+        print("Processed "+str(report['lines'])+" lines with "+str(report['sentences'])+" sentences and "+str(report['tokens'])+" tokens")
+        print("Longest sentence: "+str(report['longest_sentence'])+" tokens, percentiles: "+str(report['sentence_length_percentiles']))
+        print("%.1fs, %.2f MB/s compressed; report written to %s"%(seconds,report['compressed_mb_per_second'],outname))
+
+    #statistics for a whole gzip file (length -1) or one block of a block-compressed file
+    #unlike analyse, runs of boundary lines do not count as empty sentences
+    #a whole file is streamed a line at a time, so only a block is ever held in memory
+    def analysechunk(self,job):
+        filename,offset,length=job
+        if length<0:
+            with gzip.open(filename,'rb') as instream:
+                return self.analyselines(instream)
+        else:
+            return self.analyselines(io.BytesIO(readblock(job)))
+
+    def analyselines(self,instream):
+        lengths=Counter()
+        postags=Counter()
+        labels=Counter()
+        lines=0
+        current=0
+        for line in instream:
+            lines+=1
+            fields=line.rstrip().split(b'\t')
+            if len(fields)==self.linelength:
+                current+=1
+                postags[fields[3]]+=1
+                labels[fields[self.labelpos]]+=1
+            elif current>0:
+                lengths[current]+=1
+                current=0
+        if current>0:
+            lengths[current]+=1
+        return {'lines':lines,
+                'sentences':sum(lengths.values()),
+                'tokens':sum(postags.values()),
+                'lengths':lengths,
+                'postags':Counter(dict((tag.decode('utf-8'),count) for tag,count in postags.items())),
+                'labels':Counter(dict((label.decode('utf-8'),count) for label,count in labels.items()))}
+
+    #sentence lengths below which the given percentages of sentences fall, from a sorted (length,count) histogram
+    def percentiles(self,lengths,percents):
+        total=sum(count for length,count in lengths)
+        results={}
+        for percent in percents:
+            needed=total*percent/100.0
+            sofar=0
+            for length,count in lengths:
+                sofar+=count
+                if sofar>=needed:
+                    results[str(percent)]=length
+                    break
+        return results
+
+    def showsentence(self):
+        reader=BlockReader(self.parameters["filename"])
+        print(reader.sentence(self.parameters.get("sentence",0)).decode('utf-8'))
+
 
 
     def run(self):
@@ -184,6 +649,14 @@ class Converter:
             self.analyse()
         elif self.parameters["option"]=="split":
             self.split()
+        elif self.parameters["option"]=="balancedsplit":
+            self.balancedsplit()
+        elif self.parameters["option"]=="showsentence":
+            self.showsentence()
+        elif self.parameters["option"]=="corpusstats":
+            self.corpusstats()
+        elif self.parameters["option"]=="benchmark":
+            self.benchmark()
         else:
             print("Unknown option: "+self.parameters["option"])
             exit()
@@ -1,14 +1,234 @@
 __author__ = 'juliewe'
 
-import configparser,sys,os,ast,subprocess,datetime
-import xml.etree.cElementTree as ET
+import configparser,sys,os,ast,subprocess,datetime,time,hashlib,gzip,json,threading,queue,http.client
+from urllib.parse import urlsplit,quote
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
 
 
 def current_time():
     return datetime.datetime.ctime(datetime.datetime.now())
 
+class Manifest:
+    """
+    Record of which documents in an output directory have been completely processed, kept in a .manifest file there.
+    Each line gives the stage, the input name and the size, mtime and md5 of the input, and is appended only once
+    the output for that input is complete, so a half-written output is never mistaken for a finished one.
+    A document is complete if it has a record whose size and mtime (or, if only the mtime has changed, md5) match the input.
+    A directory processed before manifests were kept has no records for a stage; the stage then seeds them from the
+    outputs already there which are complete, so that they are not processed again.
+    """
+
+    def __init__(self,directory):
+        self.directory=directory
+        self.filename=os.path.join(directory,'.manifest')
+        self.records={}
+        self.outstream=None
+        self.lock=threading.Lock()
+        if os.path.exists(self.filename):
+            with open(self.filename) as instream:
+                for line in instream:
+                    fields=line.rstrip('\n').split('\t')
+                    if len(fields)==5 and line.endswith('\n'): #ignore a line cut short by a crash
+                        self.records[(fields[0],fields[1])]=(int(fields[2]),fields[3],fields[4])
+
+    def signature(self,path,withhash=True):
+        status=os.stat(path)
+        digest=''
+        if withhash:
+            md5=hashlib.md5()
+            with open(path,'rb') as instream:
+                for chunk in iter(lambda:instream.read(1048576),b''):
+                    md5.update(chunk)
+            digest=md5.hexdigest()
+        return status.st_size,repr(status.st_mtime),digest
+
+    def complete(self,stage,name,inpath):
+        record=self.records.get((stage,name))
+        if record is None:
+            return False
+        size,mtime,digest=self.signature(inpath,withhash=False)
+        if size!=record[0]:
+            return False
+        return mtime==record[1] or self.signature(inpath)[2]==record[2]
+
+    def hasstage(self,stage):
+        return any(recordstage==stage for recordstage,name in self.records)
+
+    def record(self,stage,name,inpath):
+        size,mtime,digest=self.signature(inpath)
+        with self.lock:
+            if self.outstream is None:
+                os.makedirs(self.directory,exist_ok=True)
+                self.outstream=open(self.filename,'a')
+            self.outstream.write("%s\t%s\t%d\t%s\t%s\n" % (stage,name,size,mtime,digest))
+            self.outstream.flush()
+            self.records[(stage,name)]=(size,mtime,digest)
+
+    def close(self):
+        if self.outstream is not None:
+            self.outstream.close()
+            self.outstream=None
+
+class JobScheduler:
+    """
+    Runs external commands concurrently within a total thread and memory budget.
+    Jobs are started largest first (by input size) so that a big job is not left running alone at the end.
+    A job is started whenever its threads and memory fit in what is left of the budget, or when nothing else is running.
+    Each job's stdout and stderr go to its own log file and its exit status is recorded.
+    A job whose command cannot be started is recorded with status -1.
+    A job which fails, or whose check function returns False, is run again up to retries more times.
+    Alternatively several threads can each call runone, sharing the same budget.
+    """
+
+    def __init__(self,max_threads,max_memory=0,poll=1.0,retries=0):
+        self.max_threads=max_threads
+        self.max_memory=max_memory #MB, 0 for no limit
+        self.poll=poll
+        self.retries=retries
+        self.jobs=[]
+        #budget in use by jobs started with runone
+        self.condition=threading.Condition()
+        self.threads=0
+        self.memory=0
+
+    def add(self,name,command,size=0,threads=1,memory=0,logfile=os.devnull,cwd=None,check=None):
+        self.jobs.append(self._job(name,command,size,threads,memory,logfile,cwd,check))
+
+    def _job(self,name,command,size=0,threads=1,memory=0,logfile=os.devnull,cwd=None,check=None,retries=None):
+        return {'name':name,'command':command,'size':size,'threads':threads,'memory':memory,'logfile':logfile,'cwd':cwd,
+                'check':check,'attempts':0,'retries':self.retries if retries is None else retries}
+
+    def fits(self,job,threads,memory):
+        if threads==0:
+            return True
+        if threads+job['threads']>self.max_threads:
+            return False
+        return self.max_memory<=0 or memory+job['memory']<=self.max_memory
+
+    def _start(self,job):
+        #start a job, returning False if its command (or its log) could not be opened at all, e.g. it does not exist
+        job['attempts']+=1
+        job['start']=time.time()
+        job['log']=None
+        try:
+            job['log']=open(job['logfile'],'a' if job['attempts']>1 else 'w')
+            job['process']=subprocess.Popen(job['command'],stdout=job['log'],stderr=subprocess.STDOUT,cwd=job['cwd'])
+        except OSError as e:
+            if job['log'] is not None:
+                job['log'].write("Could not start %s: %s\n" % (str(job['command']),str(e)))
+                job['log'].close()
+            print("<%s> Could not start %s: %s" % (current_time(),job['name'],str(e)))
+            return False
+        return True
+
+    def _finish(self,job):
+        #the exit status of a job which has finished, -1 if it exited cleanly but its check failed
+        job['log'].close()
+        status=job['process'].returncode
+        if status==0 and job['check'] is not None and not job['check']():
+            status=-1 #finished but its output is incomplete
+        print("<%s> Finished %s with exit status %d in %.1fs, log in %s" % (
+        current_time(),job['name'],status,time.time()-job['start'],job['logfile']))
+        return status
+
+    def _retry(self,job,status):
+        if status!=0 and job['attempts']<=job['retries']:
+            print("<%s> Retrying %s (attempt %d of %d)" % (current_time(),job['name'],job['attempts']+1,job['retries']+1))
+            return True
+        return False
+
+    def run(self):
+        """
+        Run all the jobs added, returning a dict from job name to exit status
+        """
+        waiting=sorted(self.jobs,key=lambda job:job['size'],reverse=True)
+        running=[]
+        statuses={}
+        threads=0
+        memory=0
+        while waiting or running:
+            started=True
+            while waiting and started:
+                started=False
+                for job in waiting:
+                    if self.fits(job,threads,memory):
+                        waiting.remove(job)
+                        started=True
+                        if not self._start(job):
+                            statuses[job['name']]=-1 #not retried, as it would fail in the same way
+                            break
+                        threads+=job['threads']
+                        memory+=job['memory']
+                        running.append(job)
+                        print("<%s> Started %s (%d threads, %d MB in use): %s" % (current_time(),job['name'],threads,memory,str(job['command'])))
+                        break
+            if running:
+                time.sleep(self.poll)
+            for job in [job for job in running if job['process'].poll() is not None]:
+                running.remove(job)
+                threads-=job['threads']
+                memory-=job['memory']
+                status=self._finish(job)
+                if self._retry(job,status):
+                    waiting.insert(0,job)
+                else:
+                    statuses[job['name']]=status
+        failed=[name for name in statuses if statuses[name]!=0]
+        print("<%s> %d jobs complete, %d failed%s" % (current_time(),len(statuses),len(failed),(": "+", ".join(sorted(failed))) if failed else ""))
+        return statuses
+
+    def runone(self,name,command,size=0,threads=1,memory=0,logfile=os.devnull,cwd=None,check=None,retries=None):
+        """
+        Run one job in the calling thread once it fits in what is left of the budget shared by every caller of runone,
+        returning its exit status. retries overrides the scheduler's retries for this job.
+        """
+        job=self._job(name,command,size,threads,memory,logfile,cwd,check,retries)
+        while True:
+            with self.condition:
+                while not self.fits(job,self.threads,self.memory):
+                    self.condition.wait()
+                self.threads+=job['threads']
+                self.memory+=job['memory']
+                print("<%s> Started %s (%d threads, %d MB in use): %s" % (current_time(),job['name'],self.threads,self.memory,str(job['command'])))
+            try:
+                if not self._start(job):
+                    return -1
+                job['process'].wait()
+                status=self._finish(job)
+            finally:
+                with self.condition:
+                    self.threads-=job['threads']
+                    self.memory-=job['memory']
+                    self.condition.notify_all()
+            if not self._retry(job,status):
+                return status
+
 class PythonParser:
 
+    processes=1 #number of worker processes for the XML to CoNLL conversion
+    #preprocessing.Converter options for outputformat=apt, which writes gzipped APT input straight from the XML
+    lowercasing=True
+    maxlength=500
+    blocksize=0
+    #budget for running corenlp.sh on several subdirectories at once: each JVM uses java_threads threads and job_memory MB
+    #max_threads defaults to java_threads (one subdirectory at a time) and max_memory to 0 (no limit)
+    max_threads=0
+    max_memory=0
+    job_memory=0
+    #backend=server sends each document to a running CoreNLP server at server_url instead of launching corenlp.sh
+    #over server_connections keep-alive connections, with at most server_queue documents read ahead
+    backend='jvm'
+    server_url='http://localhost:9000'
+    server_connections=4
+    server_queue=0
+    server_timeout=600
+    #keep a .manifest of completed documents in each output directory and use it to decide what to (re)process
+    use_manifest=True
+    #pipeline=True overlaps the stages, passing subdirectories between them through queues of pipeline_queue
+    pipelined=False
+    pipeline_queue=2
+
     def __init__(self,configfile):
         self.config=configparser.RawConfigParser()
         self.config.read(configfile)
@@ -28,27 +248,64 @@ class PythonParser:
         #self.conll_dir=self.output_dir+'-conll'
         self.testinglevel=float(self.config.get('default','testinglevel'))
         self.mode=self.config.get('default','mode')  #no_overwrite for not overwriting output files which are non-empty
-
-    def _make_filelist_and_create_files(self, data_dir, filelistpath, output_dir):
+        self._configure_jobs()
+        self.lowercasing=self.config.getboolean('default','lowercasing',fallback=self.lowercasing)
+        self.maxlength=int(self.config.get('default','maxlength',fallback=self.maxlength))
+        self.blocksize=int(self.config.get('default','blocksize',fallback=self.blocksize))
+
+    def _configure_jobs(self):
+        self.processes=int(self.config.get('default','processes',fallback=self.processes))
+        self.max_threads=int(self.config.get('default','max_threads',fallback=self.max_threads)) or int(self.java_threads)
+        self.max_memory=int(self.config.get('default','max_memory',fallback=self.max_memory))
+        self.job_memory=int(self.config.get('default','job_memory',fallback=self.job_memory))
+        self.backend=self.config.get('default','backend',fallback=self.backend)
+        self.server_url=self.config.get('default','server_url',fallback=self.server_url)
+        self.server_connections=int(self.config.get('default','server_connections',fallback=self.server_connections))
+        self.server_queue=int(self.config.get('default','server_queue',fallback=self.server_queue)) or 2*self.server_connections
+        self.server_timeout=float(self.config.get('default','server_timeout',fallback=self.server_timeout))
+        self.use_manifest=self.config.getboolean('default','manifest',fallback=self.use_manifest)
+        self.pipelined=self.config.getboolean('default','pipeline',fallback=self.pipelined)
+        self.pipeline_queue=int(self.config.get('default','pipeline_queue',fallback=self.pipeline_queue))
+
+    def _manifest(self,directory):
+        if self.use_manifest:
+            return Manifest(directory)
+        return None
+
+    def _make_filelist_and_create_files(self, data_dir, filelistpath, output_dir, manifest=None):
 
     # 1. Create a list of files in a directory to be processed, which
     #    can be passed to stanford's "filelist" input argument.
     # 2. Pre-create each output file in an attempt to avoid cluster
     #    problems.
+    # Returns the number and total size of the files listed
+    # With a manifest, files are listed unless it records them as complete; otherwise unless their output is non-empty
 
+        files=0
+        size=0
+        seed=manifest is not None and self.mode!='overwrite' and not manifest.hasstage('stanford')
         with open(filelistpath, 'w') as filelist:
             for filename in os.listdir(data_dir):
                 if not filename.startswith("."):
                     #need to check whether the associated file exists in the output directory and whether size is greater than 0 so can restart after memory crash
                     filepath = os.path.join(data_dir, filename)
                     outpath=os.path.join(output_dir,filename+'.'+self.outext)
-                    if self.mode=='overwrite' or not os.path.exists(outpath) or os.path.getsize(outpath)==0:
+                    if manifest is not None:
+                        if seed and self._xml_closed(outpath):
+                            manifest.record('stanford',filename,filepath) #complete output from before the manifest was kept
+                        todo=self.mode=='overwrite' or not manifest.complete('stanford',filename,filepath)
+                    else:
+                        todo=self.mode=='overwrite' or not os.path.exists(outpath) or os.path.getsize(outpath)==0
+                    if todo:
                         filelist.write("%s\n" % filepath)
+                        files+=1
+                        size+=os.path.getsize(filepath)
                         with open(os.path.join(outpath),
                               'w'):
                             pass
                 if self.testinglevel>4:#only process one file
                     break
+        return files,size
 
  
 
@@ -57,6 +314,8 @@ class PythonParser:
     #Process directory of text with Stanford pipeline
     #options to perform:- tokenize,ssplit,pos,lemma,ner,parse
     #initialised via config file passed in via command line
+        if self.backend=='server':
+            return self.run_stanford_server()
         print("<%s> Starting Stanford pipeline. " % current_time())
         try:
             os.mkdir(self.output_dir)
@@ -65,39 +324,181 @@ class PythonParser:
 
         #change working directory to stanford
         os.chdir(self.stanford_dir)
+        log_dir=self.output_dir+'-logs'
+        try:
+            os.mkdir(log_dir)
+        except OSError:
+            pass
 
+        scheduler=JobScheduler(self.max_threads,self.max_memory)
+        filelists={}
         for data_sub_dir in [name for name in os.listdir(self.data_dir) if not name.startswith(".")]:
-
-            #setup output subdirectory
-            output_sub_dir=os.path.join(self.output_dir,data_sub_dir)
-            input_sub_dir=os.path.join(self.data_dir,data_sub_dir)
-            try:
-                os.mkdir(output_sub_dir)
-            except OSError:
-                pass #output directory already exists
-            #create list of files to be processed
-            filelist=os.path.join(self.stanford_dir,"%s-filelist.txt" %data_sub_dir)
-            self._make_filelist_and_create_files(input_sub_dir,filelist,output_sub_dir)
+            job=self._stanford_job(data_sub_dir)
             if self.testinglevel>3:exit()
-
-            #construct stanford java command
-            optionstring=self.options[0]
-            for option in self.options[1:]:
-                optionstring+=','+option
-
-            ext='.'+self.outext
-            stanford_cmd = ['./corenlp.sh',
-                            '-annotators',optionstring,
-                            '-filelist',filelist,
-                            '-outputDirectory',output_sub_dir,
-                            '-threads', str(self.java_threads),
-                            '-outputFormat','xml',
-                            '-outputExtension',ext]
-
-            print("Running: \n"+str(stanford_cmd))
-            subprocess.call(stanford_cmd)
-            print("<%s> Stanford complete for path: %s" %(current_time(),output_sub_dir))
+            if job is None:
+                continue
+            stanford_cmd,size,filelist,output_sub_dir=job
+            scheduler.add(data_sub_dir,stanford_cmd,size,int(self.java_threads),self.job_memory,os.path.join(log_dir,data_sub_dir+'.log'))
+            filelists[data_sub_dir]=(filelist,output_sub_dir)
+
+        statuses=scheduler.run()
+        if self.use_manifest:
+            for data_sub_dir,status in statuses.items():
+                self._record_stanford_outputs(filelists[data_sub_dir][0],filelists[data_sub_dir][1],status)
         print("<%s> All stanford complete." % current_time())
+        return statuses
+
+    def _stanford_job(self,data_sub_dir):
+        #set up the output subdirectory and filelist for one data subdirectory
+        #returns the corenlp.sh command, the size of the files listed, the filelist and the output subdirectory, or None if there is nothing to do
+        output_sub_dir=os.path.join(self.output_dir,data_sub_dir)
+        input_sub_dir=os.path.join(self.data_dir,data_sub_dir)
+        try:
+            os.mkdir(output_sub_dir)
+        except OSError:
+            pass #output directory already exists
+        #create list of files to be processed
+        filelist=os.path.join(self.stanford_dir,"%s-filelist.txt" %data_sub_dir)
+        files,size=self._make_filelist_and_create_files(input_sub_dir,filelist,output_sub_dir,self._manifest(output_sub_dir))
+        if self.testinglevel>3:
+            print("<%s> Testing level %s: stopping after writing %s" %(current_time(),self.testinglevel,filelist))
+            return None
+        if files==0:
+            print("<%s> Nothing to do for path: %s" %(current_time(),output_sub_dir))
+            return None
+
+        #construct stanford java command
+        optionstring=self.options[0]
+        for option in self.options[1:]:
+            optionstring+=','+option
+        stanford_cmd = ['./corenlp.sh',
+                        '-annotators',optionstring,
+                        '-filelist',filelist,
+                        '-outputDirectory',output_sub_dir,
+                        '-threads', str(self.java_threads),
+                        '-outputFormat','xml',
+                        '-outputExtension','.'+self.outext]
+        return stanford_cmd,size,filelist,output_sub_dir
+
+    def _record_stanford_outputs(self,filelist,output_sub_dir,status):
+        #a listed document is complete only if its XML output was closed, even after a clean exit
+        manifest=Manifest(output_sub_dir)
+        recorded=0
+        with open(filelist) as instream:
+            for line in instream:
+                filepath=line.rstrip("\n")
+                filename=os.path.basename(filepath)
+                outpath=os.path.join(output_sub_dir,filename+'.'+self.outext)
+                if self._xml_closed(outpath):
+                    manifest.record('stanford',filename,filepath)
+                    recorded+=1
+        manifest.close()
+        if status!=0:
+            print("<%s> %d documents complete in failed job for %s" % (current_time(),recorded,output_sub_dir))
+
+    def _xml_closed(self,outpath):
+        #whether an XML output ends with its root element, i.e. was not cut short
+        if not os.path.exists(outpath) or os.path.getsize(outpath)==0:
+            return False
+        with open(outpath,'rb') as instream:
+            instream.seek(max(0,os.path.getsize(outpath)-64))
+            return b'</root>' in instream.read()
+
+    def run_stanford_server(self,sub_dirs=None):
+    #Process directory of text (or only the subdirectories sub_dirs) with a CoreNLP server which is already running at server_url
+    #documents are read ahead into a bounded queue and annotated by server_connections threads, each with its own keep-alive connection
+    #outputs go to the same files as with corenlp.sh, so the XML conversion and restart behaviour are unchanged
+    #returns a dict from subdirectory to the number of documents which failed
+        print("<%s> Starting Stanford pipeline with server %s. " % (current_time(),self.server_url))
+        try:
+            os.mkdir(self.output_dir)
+        except OSError:
+            pass
+        properties=json.dumps({'annotators':",".join(self.options),'outputFormat':'xml'})
+        self.server_path="/?properties="+quote(properties)
+
+        documents=queue.Queue(self.server_queue)
+        failures={}
+        manifests={}
+        lock=threading.Lock()
+        workers=[threading.Thread(target=self._server_worker,args=(documents,failures,lock)) for i in range(self.server_connections)]
+        for worker in workers:
+            worker.start()
+        #the workers are always stopped, even if queueing fails part way, so that the run cannot hang
+        try:
+            if sub_dirs is None:
+                sub_dirs=[name for name in os.listdir(self.data_dir) if not name.startswith(".")]
+            for data_sub_dir in sub_dirs:
+                output_sub_dir=os.path.join(self.output_dir,data_sub_dir)
+                input_sub_dir=os.path.join(self.data_dir,data_sub_dir)
+                try:
+                    os.mkdir(output_sub_dir)
+                except OSError:
+                    pass #output directory already exists
+                filelist=os.path.join(self.output_dir,".%s-filelist.txt" %data_sub_dir)
+                manifests[data_sub_dir]=self._manifest(output_sub_dir)
+                files,size=self._make_filelist_and_create_files(input_sub_dir,filelist,output_sub_dir,manifests[data_sub_dir])
+                failures[data_sub_dir]=0
+                print("<%s> Queueing %d files (%d bytes) from %s" %(current_time(),files,size,input_sub_dir))
+                with open(filelist) as instream:
+                    for line in instream:
+                        filepath=line.rstrip("\n")
+                        documents.put((data_sub_dir,filepath,os.path.join(output_sub_dir,os.path.basename(filepath)+'.'+self.outext),manifests[data_sub_dir]))
+                os.remove(filelist)
+        finally:
+            for worker in workers:
+                documents.put(None)
+            for worker in workers:
+                worker.join()
+            for manifest in manifests.values():
+                if manifest is not None:
+                    manifest.close()
+        print("<%s> All stanford complete, %d documents failed." % (current_time(),sum(failures.values())))
+        return failures
+
+    def _server_worker(self,documents,failures,lock):
+        url=urlsplit(self.server_url)
+        connection=http.client.HTTPConnection(url.hostname,url.port or 80,timeout=self.server_timeout)
+        while True:
+            document=documents.get()
+            if document is None:
+                break
+            data_sub_dir,inpath,outpath,manifest=document
+            try:
+                with open(inpath,'rb') as instream:
+                    text=instream.read()
+                xml=self._annotate(connection,text)
+                with open(outpath,'wb') as outstream:
+                    outstream.write(xml)
+                if manifest is not None:
+                    manifest.record('stanford',os.path.basename(inpath),inpath)
+            except Exception as e:
+                connection.close()
+                try:
+                    with open(outpath,'w'):
+                        pass #left empty so that the document is retried on the next run
+                except OSError:
+                    pass #a worker must keep taking documents, or the queue fills and the run hangs
+                with lock:
+                    failures[data_sub_dir]+=1
+                print("<%s> Failed to annotate %s: %s: %s" % (current_time(),inpath,type(e).__name__,e))
+        connection.close()
+
+    def _annotate(self,connection,text):
+        #POST one document over a keep-alive connection, reconnecting once if the server has closed it
+        for attempt in range(2):
+            try:
+                connection.request('POST',self.server_path,body=text,headers={'Content-Type':'text/plain; charset=utf-8','Connection':'keep-alive'})
+                response=connection.getresponse()
+                body=response.read()
+            except (http.client.HTTPException,ConnectionError):
+                connection.close()
+                if attempt==1:
+                    raise
+                continue
+            if response.status!=200:
+                raise IOError("server returned %d %s: %s" % (response.status,response.reason,body[:200]))
+            return body
 
 ##################
 #
@@ -110,6 +511,7 @@ class PythonParser:
         directory of xml files produced by stanford_pipeline,
         convert text to CoNLL-style formatting:
         ID    FORM    LEMMA    POS
+        or, if outputformat is apt, to gzipped APT input as written by preprocessing.Converter.
         Jobs are run in parallel.
         """
         print("<%s> Starting XML conversion..." % current_time())
@@ -121,75 +523,216 @@ class PythonParser:
     def _process_xml_to_conll(self,data_sub_dir):
         """
         Given a directory of XML documents from stanford's output,
-        convert them to CoNLL style sentences. Jobs are not run in parallel.
-        """
-        print("<%s> Beginning formatting to CoNLL: %s" % (
-        current_time(), data_sub_dir))
-        # jobs = {}
-#        Parallel(n_jobs=processes)(delayed(_process_single_xml_to_conll)(
- ##           os.path.join(path_to_data, data_file))
-   #                                for data_file in os.listdir(path_to_data)
-    #                               if not (data_file.startswith(".") or
-     #                                      data_file.endswith(".conll")))
-
-        for data_file in [df for df in os.listdir(data_sub_dir) if not (df.startswith(".") or df.endswith(".conll"))]:
-            if self.outext.endswith('parsed'):
-                self._process_single_xml_with_deps_to_conll(os.path.join(data_sub_dir,data_file))
+        convert them to CoNLL style sentences. Jobs are run in a pool of self.processes processes.
+        Files which already have a non-empty output are skipped unless mode is overwrite.
+        For outputformat apt the Converter statistics for the directory are reported at the end.
+        """
+        print("<%s> Beginning formatting to %s: %s" % (
+        current_time(), self.outputformat, data_sub_dir))
+        paths=[os.path.join(data_sub_dir,df) for df in sorted(os.listdir(data_sub_dir))
+               if not (df.startswith(".") or df.startswith("aptInput-") or df.endswith((".conll",".part",".idx")))]
+        counts={'converted':0,'skipped':0,'failed':0}
+        stage=self.outputformat
+        manifest=self._manifest(data_sub_dir)
+        if manifest is not None and self.mode!='overwrite':
+            if not manifest.hasstage(stage):
+                #non-empty outputs from before the manifest was kept are taken as complete, as they were without it
+                for path in paths:
+                    outpath=self._conversion_output(path)
+                    if os.path.exists(outpath) and os.path.getsize(outpath)>0:
+                        manifest.record(stage,os.path.basename(path),path)
+            todo=[path for path in paths if not manifest.complete(stage,os.path.basename(path),path)]
+            counts['skipped']=len(paths)-len(todo)
+            paths=todo
+        if self.processes>1:
+            pool=Pool(self.processes)
+            results=pool.imap_unordered(self._convert_xml_to_conll,paths)
+        else:
+            pool=None
+            results=map(self._convert_xml_to_conll,paths)
+        converter=self._apt_converter() if self.outputformat=='apt' else None
+        if converter is not None:
+            from src.tools.preprocessing import SentenceStats
+            totals=SentenceStats()
+        for path,status,message,stats in results:
+            counts[status]+=1
+            if status=='failed':
+                print("<%s> Failed to convert %s: %s" % (current_time(),path,message))
+            if stats is not None:
+                converter.mergedata(totals,stats,path)
+            if status=='converted' and manifest is not None:
+                manifest.record(stage,os.path.basename(path),path)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if manifest is not None:
+            manifest.close()
+        print("<%s> All formatting complete: %d converted, %d skipped, %d failed." % (
+        current_time(),counts['converted'],counts['skipped'],counts['failed']))
+        if converter is not None:
+            converter.report(totals)
+        return counts
+
+    def _convert_xml_to_conll(self,path_to_file):
+        """
+        Convert a single file, returning its path, one of converted, skipped or failed, the reason for a failure
+        and the Converter statistics for outputformat apt (otherwise None).
+        Partial output from a failed file is removed so that it is retried on the next run.
+        Without a manifest, files with a non-empty output are skipped here unless mode is overwrite.
+        """
+        stats=None
+        outpath=self._conversion_output(path_to_file)
+        if self.outputformat=='apt':
+            partpaths=[outpath+".part",outpath+".part.idx"]
+        else:
+            partpaths=[outpath]
+        if not self.use_manifest and self.mode!='overwrite' and os.path.exists(outpath) and os.path.getsize(outpath)>0:
+            return path_to_file,'skipped','',stats
+        try:
+            if self.outputformat=='apt':
+                stats=self._process_single_xml_to_apt(path_to_file,outpath+".part")
+                if self.blocksize>0:
+                    os.rename(outpath+".part.idx",outpath+".idx")
+                os.rename(outpath+".part",outpath)
+            elif self.outext.endswith('parsed'):
+                self._process_single_xml_with_deps_to_conll(path_to_file)
             else:
-                self._process_single_xml__to_conll(os.path.join(data_sub_dir,data_file))
-        print("<%s> All formatting complete." % current_time())
+                self._process_single_xml__to_conll(path_to_file)
+        except Exception as e:
+            for partpath in partpaths:
+                if os.path.exists(partpath):
+                    os.remove(partpath)
+            return path_to_file,'failed',"%s: %s" % (type(e).__name__,e),None
+        return path_to_file,'converted','',stats
+
+    def _conversion_output(self,path_to_file):
+        if self.outputformat=='apt':
+            from src.tools.preprocessing import getOutputName
+            return getOutputName(path_to_file+".gz",self._apt_converter().prefix)
+        return path_to_file+".conll"
+
+    def _apt_converter(self):
+        from src.tools.preprocessing import Converter
+        return Converter({'linelength':7,'lowercasing':self.lowercasing,'maxlength':self.maxlength,'blocksize':self.blocksize})
+
+    def _process_single_xml_to_apt(self,path_to_file,outname):
+        """
+        Convert a single file from XML straight to gzipped APT input, without an intermediate CoNLL file.
+        Each sentence is formatted as 7 column CoNLL lines in memory and passed to Converter.endsentence,
+        so lowercasing, maxlength, blocksize and the statistics are exactly those of preprocessing.py convert
+        """
+        from src.tools.preprocessing import SentenceStats,BlockWriter
+        converter=self._apt_converter()
+        stats=SentenceStats()
+        if self.blocksize>0:
+            outstream=BlockWriter(outname,self.blocksize)
+        else:
+            outstream=gzip.open(outname,'wb')
+        with outstream:
+            for tokens,giddict,reldict in self._read_sentences(path_to_file):
+                block=[("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (i,word,lemma,pos,ner,giddict.get(str(i),''),reldict.get(str(i),''))).encode('utf-8')
+                       for i,(word,lemma,pos,ner) in enumerate(tokens,1)]
+                stats.lines+=len(block)+1
+                converter.endsentence(block,outstream,stats)
+        return stats
 
 
 
+    def _read_sentences(self,path_to_file):
+        """
+        Stream the sentences of a CoreNLP XML file in a single walk of the iterparse events.
+        Yields (tokens,giddict,reldict) per sentence where tokens is a list of (word,lemma,pos,ner)
+        and giddict/reldict map a dependent index to its governor index and relation.
+        As with findall, the fields are zipped (so a sentence without e.g. NER has no tokens)
+        and a later dependencies section overrides an earlier one for the same dependent.
+        Each sentence is cleared once read, leaving only an empty element behind, so memory use stays flat.
+        Only end events are requested since start events would double the work done per element.
+        """
+        words,lemmas,poses,ners=[],[],[],[]
+        giddict={}
+        reldict={}
+        for event, element in ET.iterparse(path_to_file, events=("end",)):
+            tag=element.tag
+            if tag=="word":
+                words.append(element.text)
+            elif tag=="lemma":
+                lemmas.append(element.text)
+            elif tag=="POS":
+                poses.append(element.text)
+            elif tag=="NER":
+                ners.append(element.text)
+            elif tag=="governor":
+                gid=element.attrib['idx']
+            elif tag=="dependent":
+                did=element.attrib['idx']
+            elif tag=="dep":
+                giddict[did]=gid
+                reldict[did]=element.attrib['type']
+            elif tag=="sentence":
+                yield list(zip(words,lemmas,poses,ners)),giddict,reldict
+                words,lemmas,poses,ners=[],[],[],[]
+                giddict={}
+                reldict={}
+                element.clear()
+
     def _process_single_xml_with_deps_to_conll(self,path_to_file):
         """
         Convert a single file from XML to CoNLL style.  With dependencies
         """
-        with open(path_to_file + ".conll", 'w') as outfile:
+        with open(path_to_file + ".conll", 'w', encoding='utf-8') as outfile:
+            for tokens,giddict,reldict in self._read_sentences(path_to_file):
+                lines=[self._get_string_with_deps(i,word,lemma,pos,ner,giddict.get(str(i),''),reldict.get(str(i),''))
+                       for i,(word,lemma,pos,ner) in enumerate(tokens,1)]
+                lines.append("\n")
+                outfile.write("".join(lines))
+
+    def _process_single_xml_with_deps_to_conll_findall(self,path_to_file):
+        """
+        Convert a single file from XML to CoNLL style.  With dependencies
+        Original conversion with a findall search per field, kept as the reference for benchmark_xml
+        """
+        with open(path_to_file + ".conll", 'w', encoding='utf-8') as outfile:
             #Create iterator over XML elements, don't store whole tree
-            try:
-                xmltree = ET.iterparse(path_to_file, events=("end",))
-                for _, element in xmltree:
-                    if element.tag == "sentence": #If we've read an entire sentence
-                        i = 1
-
-                        tuples=[(word,lemma,pos,ner) for word, lemma, pos, ner in zip(element.findall(".//word"),
-                                                         element.findall(".//lemma"),
-                                                         element.findall(".//POS"),
-                                                         element.findall(".//NER"))]
-
-                        dependencies=[dep for dep in element.findall('.//dep')]
-                        #print tuples
-                        #print dependencies
-                        giddict={}
-                        reldict={}
-                        for dep in dependencies:
-                            rel=dep.attrib['type']
-                            for child in dep:
-                                if child.tag=='governor':
-                                    gid=child.attrib['idx']
-                                if child.tag=='dependent':
-                                    did=child.attrib['idx']
-                            #print did,gid,rel
-                            giddict[did]=gid
-                            reldict[did]=rel
-
-
-
-                        for (word,lemma,pos,ner) in tuples:
-                            outfile.write(self._get_string_with_deps(
-                                i, word.text.encode('utf8'), lemma.text.encode('utf8'),
-                                pos.text, ner.text,giddict.get(str(i),''),reldict.get(str(i),'')))
-                            i += 1
-                        outfile.write("\n")
-                        #Clear this section of the XML tree
-                        element.clear()
-            except Exception:
-                pass #ignore this file
+            xmltree = ET.iterparse(path_to_file, events=("end",))
+            for _, element in xmltree:
+                if element.tag == "sentence": #If we've read an entire sentence
+                    i = 1
+
+                    tuples=[(word,lemma,pos,ner) for word, lemma, pos, ner in zip(element.findall(".//word"),
+                                                     element.findall(".//lemma"),
+                                                     element.findall(".//POS"),
+                                                     element.findall(".//NER"))]
+
+                    dependencies=[dep for dep in element.findall('.//dep')]
+                    #print tuples
+                    #print dependencies
+                    giddict={}
+                    reldict={}
+                    for dep in dependencies:
+                        rel=dep.attrib['type']
+                        for child in dep:
+                            if child.tag=='governor':
+                                gid=child.attrib['idx']
+                            if child.tag=='dependent':
+                                did=child.attrib['idx']
+                        #print did,gid,rel
+                        giddict[did]=gid
+                        reldict[did]=rel
+
+
+
+                    for (word,lemma,pos,ner) in tuples:
+                        outfile.write(self._get_string_with_deps(
+                            i, word.text, lemma.text,
+                            pos.text, ner.text,giddict.get(str(i),''),reldict.get(str(i),'')))
+                        i += 1
+                    outfile.write("\n")
+                    #Clear this section of the XML tree
+                    element.clear()
 
     def _get_string_with_deps(self,index, word,lemma,pos,ner,gov,rel):
         if self.outputformat=='conll_apt':
-            return "%s\t%s/%s\t%s\t%s" % (index,word,pos,gov,rel)
+            return "%s\t%s/%s\t%s\t%s\n" % (index,word,pos,gov,rel)
         else:
             return "%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (index,word,lemma,pos,ner,gov,rel)
 
@@ -198,39 +741,171 @@ class PythonParser:
         """
         Convert a single file from XML to CoNLL style.  No dependencies
         """
-        with open(path_to_file + ".conll", 'w') as outfile:
-            #Create iterator over XML elements, don't store whole tree
-            try:
-                xmltree = ET.iterparse(path_to_file, events=("end",))
-                for _, element in xmltree:
-                    if element.tag == "sentence": #If we've read an entire sentence
-                        i = 1
-                        #Output CoNLL style
-                        for word, lemma, pos, ner in zip(element.findall(".//word"),
-                                                         element.findall(".//lemma"),
-                                                         element.findall(".//POS"),
-                                                         element.findall(".//NER")):
-                            outfile.write("%s\t%s\t%s\t%s\t%s\n" % (
-                                i, word.text.encode('utf8'), lemma.text.encode('utf8'),
-                                pos.text, ner.text))
-                            i += 1
-                        outfile.write("\n")
-                        #Clear this section of the XML tree
-                        element.clear()
-            except:
-                pass #ignore this (probably empty) file
+        with open(path_to_file + ".conll", 'w', encoding='utf-8') as outfile:
+            for tokens,giddict,reldict in self._read_sentences(path_to_file):
+                lines=["%s\t%s\t%s\t%s\t%s\n" % (i,word,lemma,pos,ner) for i,(word,lemma,pos,ner) in enumerate(tokens,1)]
+                lines.append("\n")
+                outfile.write("".join(lines))
+
+    def benchmark_xml(self,path_to_file):
+        """
+        Time the findall and streaming conversions (with dependencies) of one XML file and check that their output is identical
+        """
+        start=time.time()
+        self._process_single_xml_with_deps_to_conll_findall(path_to_file)
+        oldtime=time.time()-start
+        os.rename(path_to_file+".conll",path_to_file+".conll.findall")
+        start=time.time()
+        self._process_single_xml_with_deps_to_conll(path_to_file)
+        newtime=time.time()-start
+        size=os.path.getsize(path_to_file)/1048576.0
+        with open(path_to_file+".conll.findall",'rb') as old, open(path_to_file+".conll",'rb') as new:
+            identical=hashlib.md5(old.read()).digest()==hashlib.md5(new.read()).digest()
+        os.remove(path_to_file+".conll.findall")
+        print("findall: %.2fs (%.2f MB/s)"%(oldtime,size/oldtime))
+        print("Streaming: %.2fs (%.2f MB/s)"%(newtime,size/newtime))
+        print("Speedup: %.2fx, identical output: %s"%(oldtime/newtime,identical))
 
     def stripxml(self):
         os.chdir(self.working_dir)
+        raw_dir=self.data_dir.replace("xml","raw")
+        self._strip_dir(self.data_dir,raw_dir)
+        self.data_dir=raw_dir
+
+    def _strip_dir(self,xml_dir,raw_dir):
+        #run the xml stripper on xml_dir, whose output goes to raw_dir, returning its exit status
+        #the stripper works on a whole directory, so it is skipped only if the manifest records every input as complete
         self.tags=ast.literal_eval(self.config.get('default','xmltags'))
-        strip_command=["java","-mx4g","-jar",self.config.get('default','xmlstripper_jar'),self.data_dir]+self.tags
-        print("<%s> Running xml stripper with command: %s" %(current_time(),str(strip_command)))
-        subprocess.call(strip_command)
-        print("<%s> XML stripping complete for path: %s" %(current_time(),self.data_dir))
-        self.data_dir=self.data_dir.replace("xml","raw")
+        strip_command=["java","-mx4g","-jar",self.config.get('default','xmlstripper_jar'),xml_dir]+self.tags
+        manifest=self._manifest(raw_dir)
+        inputs=[]
+        for root,dirs,files in os.walk(xml_dir):
+            dirs[:]=[name for name in dirs if not name.startswith(".")]
+            inputs+=[(os.path.relpath(os.path.join(root,name),xml_dir),os.path.join(root,name)) for name in files if not name.startswith(".")]
+        status=0
+        if manifest is not None and self.mode!='overwrite' and all(manifest.complete('stripxml',name,path) for name,path in inputs):
+            print("<%s> XML stripping already complete for path: %s" %(current_time(),xml_dir))
+        else:
+            print("<%s> Running xml stripper with command: %s" %(current_time(),str(strip_command)))
+            status=subprocess.call(strip_command,cwd=self.working_dir)
+            if status==0 and manifest is not None:
+                for name,path in inputs:
+                    manifest.record('stripxml',name,path)
+            print("<%s> XML stripping complete for path: %s with exit status %d" %(current_time(),xml_dir,status))
+        if manifest is not None:
+            manifest.close()
+        return status
+
+##################
+#
+#  Pipelined mode: each subdirectory passes through the stages in turn
+#
+##################
+    def run_pipelined(self):
+        """
+        Run the stages over one data subdirectory at a time, with a bounded queue of pipeline_queue subdirectories
+        in front of each stage, so that e.g. the XML of one subdirectory is converted while the next is being tagged.
+        The stanford stage runs up to max_threads/java_threads subdirectories at once, within max_memory as for run_stanford_pipeline
+        (or sends them to the server for backend=server); the other stages one at a time.
+        A subdirectory with any failed document goes no further until it is run again.
+        Wall time then approaches that of the slowest stage rather than the sum of all the stages.
+        """
+        print("<%s> Starting pipelined run." % current_time())
+        self.data_dir=os.path.abspath(self.data_dir)
+        self.output_dir=os.path.abspath(self.output_dir)
+        self.stanford_dir=os.path.abspath(self.stanford_dir)
+        self.working_dir=os.path.abspath(self.working_dir)
+        for directory in [self.output_dir,self.output_dir+'-logs']:
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+        items=sorted(name for name in os.listdir(self.data_dir) if not name.startswith("."))
+        if self.inputformat=='xml':
+            self.xml_dir=self.data_dir
+            self.data_dir=self.data_dir.replace("xml","raw")
+        #jobs started by the stage workers share one thread and memory budget
+        #the scheduler is passed to the stages rather than kept on self, which is pickled for the conversion pool
+        scheduler=JobScheduler(self.max_threads,self.max_memory)
+        failures=self._run_stages(items,self._pipeline_stages(scheduler))
+        print("<%s> Pipelined run complete, %d failed stages." % (current_time(),len(failures)))
+        return failures
+
+    def _pipeline_stages(self,scheduler):
+        #(name,function,workers) for each stage; a function returns False if the subdirectory should go no further
+        stages=[]
+        if self.inputformat=='xml':
+            stages.append(('strip',self._strip_sub_dir,1))
+        if len(self.options)>0:
+            stages.append(('stanford',lambda data_sub_dir:self._tag_sub_dir(data_sub_dir,scheduler),max(1,self.max_threads//int(self.java_threads))))
+        if self.outputformat.startswith('conll') or self.outputformat=='apt':
+            stages.append(('convert',self._convert_sub_dir,1))
+        return stages
+
+    def _strip_sub_dir(self,data_sub_dir):
+        return self._strip_dir(os.path.join(self.xml_dir,data_sub_dir),os.path.join(self.data_dir,data_sub_dir))==0
+
+    def _tag_sub_dir(self,data_sub_dir,scheduler):
+        #the documents completed in a failed subdirectory are recorded, and converted when it is tagged again
+        if self.backend=='server':
+            return self.run_stanford_server([data_sub_dir])[data_sub_dir]==0
+        job=self._stanford_job(data_sub_dir)
+        if job is None:
+            return self.testinglevel<=3
+        stanford_cmd,size,filelist,output_sub_dir=job
+        status=scheduler.runone(data_sub_dir,stanford_cmd,size,int(self.java_threads),self.job_memory,
+                                os.path.join(self.output_dir+'-logs',data_sub_dir+'.log'),self.stanford_dir)
+        if self.use_manifest:
+            self._record_stanford_outputs(filelist,output_sub_dir,status)
+        return status==0
+
+    def _convert_sub_dir(self,data_sub_dir):
+        return self._process_xml_to_conll(os.path.join(self.output_dir,data_sub_dir))['failed']==0
+
+    def _run_stages(self,items,stages):
+        """
+        Pass each item through the stages in order using one thread per stage worker and a bounded queue in front of each stage.
+        Returns a list of (stage,item) for the items which failed or were stopped.
+        """
+        queues=[queue.Queue(self.pipeline_queue) for stage in stages]
+        failures=[]
+        threads=[]
+        for index,(name,function,workers) in enumerate(stages):
+            threads.append([threading.Thread(target=self._stage_worker,args=(stages,queues,index,failures)) for worker in range(workers)])
+            for thread in threads[-1]:
+                thread.start()
+        for item in items:
+            queues[0].put(item)
+        #close each stage only once the stage before it has finished, so nothing is put on a closed queue
+        for index,(name,function,workers) in enumerate(stages):
+            for thread in threads[index]:
+                queues[index].put(None)
+            for thread in threads[index]:
+                thread.join()
+        return failures
+
+    def _stage_worker(self,stages,queues,index,failures):
+        name,function,workers=stages[index]
+        while True:
+            item=queues[index].get()
+            if item is None:
+                break
+            start=time.time()
+            try:
+                passed=function(item)!=False
+            except BaseException as e: #including SystemExit, so that the sentinels still reach the next stage
+                print("<%s> Stage %s failed for %s: %s: %s" % (current_time(),name,item,type(e).__name__,e))
+                passed=False
+            print("<%s> Stage %s done for %s in %.1fs" % (current_time(),name,item,time.time()-start))
+            if not passed:
+                failures.append((name,item))
+            elif index+1<len(stages):
+                queues[index+1].put(item)
 
     def runPipeline(self):
 
+        if self.pipelined:
+            return self.run_pipelined()
         if self.inputformat=='xml':
             self.stripxml()
         if len(self.options)>0:
@@ -238,7 +913,7 @@ class PythonParser:
 
         #should be able to use the conll flag in stanford and then clean up the output to something more like that expected by Robertson parser or APT software
         #but older version of the parser does not recognise conll flag
-        if self.outputformat.startswith('conll'):
+        if self.outputformat.startswith('conll') or self.outputformat=='apt':
             self.process_corpora_from_xml()
 
     def run(self):
@@ -247,4 +922,7 @@ class PythonParser:
 if __name__=='__main__':
 
     myPythonParser=PythonParser(sys.argv[1])
-    myPythonParser.run()
\ No newline at end of file
+    if len(sys.argv)>3 and sys.argv[2]=='benchmark':
+        myPythonParser.benchmark_xml(sys.argv[3])  #python runStanford.py config benchmark file.xml
+    else:
+        myPythonParser.run()
\ No newline at end of file
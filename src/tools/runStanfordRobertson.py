@@ -1,11 +1,17 @@
-import configparser,os,sys,subprocess
-from .runStanford import PythonParser, current_time
+import configparser,os,sys,subprocess,shutil,threading
+from .runStanford import PythonParser, JobScheduler, current_time
 
 __author__ = 'juliewe'
 #run the Stanford pipeline upto tagging and NER, convert to CONLL and then use ADR's dependency parser
 
 class ParsingPipeline(PythonParser):
 
+    #robertson_shards>0 splits the tagged CoNLL into that many shards, each parsed by its own JVM of robertson_memory MB,
+    #as many at a time as fit in max_threads and max_memory; a failed shard is retried up to robertson_retries times
+    robertson_shards=0
+    robertson_memory=16384
+    robertson_retries=2
+
     def __init__(self,configfile):
         self.config=configparser.RawConfigParser()
         self.config.read(configfile)
@@ -24,9 +30,15 @@ class ParsingPipeline(PythonParser):
         self.data_dir=self.data_dir+"-"+self.inputformat
         self.testinglevel=float(self.config.get('default','testinglevel'))
         self.mode=self.config.get('default','mode')  #no_overwrite for not overwriting output files which are non-empty
+        self._configure_jobs()
+        self.robertson_shards=int(self.config.get('default','robertson_shards',fallback=self.robertson_shards))
+        self.robertson_memory=int(self.config.get('default','robertson_memory',fallback=self.robertson_memory))
+        self.robertson_retries=int(self.config.get('default','robertson_retries',fallback=self.robertson_retries))
 
     def run_robertson_parser(self):
 
+        if self.robertson_shards>0:
+            return self.run_robertson_sharded()
         os.chdir(self.working_dir)
 
         robertson_command=["java","-mx16g","-jar",self.robertson_jar,self.output_dir]
@@ -34,8 +46,177 @@ class ParsingPipeline(PythonParser):
         subprocess.call(robertson_command)
         print("<%s> Robertson parser complete for path: %s" %(current_time(),self.output_dir))
 
+    def run_robertson_sharded(self,directory=None,shard_dir=None,scheduler=None):
+        """
+        Parse the tagged CoNLL files under output_dir (or directory) with several parser JVMs at once.
+        The sentences of all the files, in order, are split into robertson_shards shards of about equal size,
+        each in its own directory under output_dir-shards (or shard_dir). Once every shard is parsed, each shard's output is split
+        back into the files its sentences came from, so that the output for e.g. a.conll is a.conll+suffix as if it had been parsed alone.
+        With a scheduler, as in pipelined mode, the shards are run within the budget it shares with the other stages.
+        Returns the names of any shards which still failed after their retries (nothing is merged if there are any).
+        """
+        if directory is None:
+            os.chdir(self.working_dir)
+            directory=self.output_dir
+            cwd=None
+        else:
+            cwd=self.working_dir
+        if shard_dir is None:
+            shard_dir=directory+'-shards'
+        shards=self._make_robertson_shards(shard_dir,directory)
+        jobs=[(name,self._robertson_command(shard['dir']),shard['size'],os.path.join(shard_dir,name+'.log'),
+               lambda shard=shard:self._robertson_output(shard) is not None) for name,shard in sorted(shards.items())]
+        if scheduler is None:
+            scheduler=JobScheduler(self.max_threads,self.max_memory,retries=self.robertson_retries)
+            for name,robertson_command,size,logfile,check in jobs:
+                scheduler.add(name,robertson_command,size,1,self.robertson_memory,logfile,cwd,check)
+            statuses=scheduler.run()
+        else:
+            statuses=self._run_shared(scheduler,jobs,cwd)
+        failed=sorted(name for name in statuses if statuses[name]!=0)
+        if failed:
+            print("<%s> Robertson parser failed for shards %s, see the logs in %s" %(current_time(),", ".join(failed),shard_dir))
+            return failed
+        started=set()
+        for name in sorted(shards):
+            self._merge_robertson_shard(shards[name],started)
+        shutil.rmtree(shard_dir)
+        print("<%s> Robertson parser complete for path: %s" %(current_time(),directory))
+        return failed
+
+    def _robertson_command(self,directory):
+        return ["java","-mx%dm" % self.robertson_memory,"-jar",self.robertson_jar,directory]
+
+    def _run_shared(self,scheduler,jobs,cwd):
+        #run the jobs at once, each from its own thread, within the budget of a scheduler shared with other threads
+        statuses={}
+        def run(name,robertson_command,size,logfile,check):
+            statuses[name]=scheduler.runone(name,robertson_command,size,1,self.robertson_memory,logfile,cwd,check,self.robertson_retries)
+        threads=[threading.Thread(target=run,args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return statuses
+
+    def _make_robertson_shards(self,shard_dir,directory=None):
+        #split the sentences of every .conll file under output_dir (or directory), in sorted order, into shards balanced by bytes
+        #each shard remembers which files its sentences came from and how many sentences it took from each
+        sources=[]
+        for root,dirs,files in os.walk(directory or self.output_dir):
+            dirs.sort()
+            sources+=[os.path.join(root,name) for name in sorted(files) if name.endswith('.conll') and not name.startswith('.')]
+        total=sum(os.path.getsize(source) for source in sources)
+        shutil.rmtree(shard_dir,ignore_errors=True)
+        os.makedirs(shard_dir)
+        shards={}
+        shard=None
+        written=0
+        for source in sources:
+            with open(source,'rb') as instream:
+                for sentence in self._sentences(instream):
+                    #start the next shard once this one has its share of the bytes
+                    if shard is None or (written>=total*len(shards)/self.robertson_shards and len(shards)<self.robertson_shards):
+                        shard=self._new_robertson_shard(shard_dir,shards)
+                    written+=self._add_to_shard(shard,source,sentence)
+        for shard in shards.values():
+            shard['outstream'].close()
+        print("<%s> Split %d files (%d bytes) into %d shards in %s" %(current_time(),len(sources),total,len(shards),shard_dir))
+        return shards
+
+    def _add_to_shard(self,shard,source,sentence):
+        if not shard['segments'] or shard['segments'][-1][0]!=source:
+            shard['segments'].append([source,0])
+        shard['segments'][-1][1]+=1
+        data=b''.join(sentence)
+        shard['outstream'].write(data)
+        shard['size']+=len(data)
+        return len(data)
+
+    def _new_robertson_shard(self,shard_dir,shards):
+        name="shard_%03d" % len(shards)
+        directory=os.path.join(shard_dir,name)
+        os.mkdir(directory)
+        shards[name]={'dir':directory,'input':os.path.join(directory,'shard.conll'),'segments':[],'size':0}
+        shards[name]['outstream']=open(shards[name]['input'],'wb')
+        return shards[name]
+
+    def _robertson_output(self,shard):
+        #the parser's output for a shard is the file it added to the shard directory, which must have every sentence of the input
+        #returns the output file name or None
+        outputs=sorted(name for name in os.listdir(shard['dir']) if name!='shard.conll' and not name.startswith('.'))
+        if len(outputs)!=1:
+            return None
+        sentences=sum(count for source,count in shard['segments'])
+        if self._count_sentences(os.path.join(shard['dir'],outputs[0]))!=sentences:
+            return None
+        return outputs[0]
+
+    def _sentences(self,instream):
+        #the sentences of a CoNLL file, each as its lines up to and including the blank line which ends it
+        #blank lines before a sentence starts are skipped, so a run of blank lines ends just one sentence
+        #a last sentence without a blank line after it is given one
+        sentence=[]
+        for line in instream:
+            if line.strip():
+                sentence.append(line)
+            elif sentence:
+                sentence.append(line)
+                yield sentence
+                sentence=[]
+        if sentence:
+            if not sentence[-1].endswith(b'\n'):
+                sentence[-1]+=b'\n'
+            yield sentence+[b'\n']
+
+    def _count_sentences(self,filename):
+        with open(filename,'rb') as instream:
+            return sum(1 for sentence in self._sentences(instream))
+
+    def _merge_robertson_shard(self,shard,started):
+        #split the shard's output back into its source files, in order
+        #a file is truncated when first written (started holds those already written) and appended to when it continues from the previous shard
+        output=self._robertson_output(shard)
+        suffix=output[len('shard.conll'):] if output.startswith('shard.conll') else '.'+output
+        segments=shard['segments']
+        position=0
+        remaining=0
+        outstream=None
+        with open(os.path.join(shard['dir'],output),'rb') as instream:
+            for sentence in self._sentences(instream):
+                if outstream is None:
+                    source,remaining=segments[position]
+                    outstream=open(source+suffix,'ab' if source in started else 'wb')
+                    started.add(source)
+                outstream.write(b''.join(sentence))
+                remaining-=1
+                if remaining==0:
+                    outstream.close()
+                    outstream=None
+                    position+=1
+        if outstream is not None:
+            outstream.close()
+
+    def _pipeline_stages(self,scheduler):
+        #in pipelined mode each subdirectory is parsed as soon as it has been converted to CoNLL
+        stages=PythonParser._pipeline_stages(self,scheduler)
+        stages.append(('parse',lambda data_sub_dir:self._parse_sub_dir(data_sub_dir,scheduler),1))
+        return stages
+
+    def _parse_sub_dir(self,data_sub_dir,scheduler):
+        #parsed with the same robertson_memory and robertson_shards as run_robertson_parser, charged to the pipeline's budget
+        output_sub_dir=os.path.join(self.output_dir,data_sub_dir)
+        if self.robertson_shards>0:
+            return not self.run_robertson_sharded(output_sub_dir,os.path.join(self.output_dir+'-shards',data_sub_dir),scheduler)
+        status=scheduler.runone(data_sub_dir+'.parse',self._robertson_command(output_sub_dir),0,1,self.robertson_memory,
+                                os.path.join(self.output_dir+'-logs',data_sub_dir+'.parse.log'),self.working_dir)
+        print("<%s> Robertson parser finished for %s with exit status %d" %(current_time(),output_sub_dir,status))
+        return status==0
+
     def run(self):
         if self.inputformat!="sfd_parsed" and self.inputformat!="tagged":
+            if self.pipelined:
+                return self.runPipeline() #includes the parser as its last stage
             self.runPipeline()
         else:
             self.output_dir=self.data_dir
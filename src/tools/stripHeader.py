@@ -1,11 +1,17 @@
 __author__ = 'juliewe'
 #stripHeader.py is intended to strip the copyright header from the training documents in the given directory and place the result in a clean directory
+#fast=True in the default section of the config finds the header with a byte search of each memory-mapped file, processes files
+#in a pool of processes (processes=N) and can gzip the output (compress=True); files without the header marker are reported, not written
+#as in the line by line mode, \r\n and \r line endings are written as \n
 
-import configparser,sys,os,glob
+import configparser,sys,os,glob,mmap,gzip
+from multiprocessing import Pool
 
 class Guillotine:
 
     ENDHEADER=list("*END*THE SMALL PRINT!")
+    ENDHEADERBYTES=b"*END*THE SMALL PRINT!"
+    CHUNK=1<<20 #bytes of the body converted at a time when its line endings need normalising
 
     def __init__(self,config):
         self.config=config
@@ -17,6 +23,9 @@ class Guillotine:
             self.option='default'
         self.indir=os.path.join(self.parameters.get(self.option,'parent'),self.parameters.get('default','input'))
         self.outdir=os.path.join(self.parameters.get(self.option,'parent'),self.parameters.get('default','output'))
+        self.fast=self.parameters.getboolean('default','fast',fallback=False)
+        self.processes=self.parameters.getint('default','processes',fallback=1)
+        self.compress=self.parameters.getboolean('default','compress',fallback=False)
 
     def checkfiles(self):
 
@@ -55,9 +64,81 @@ class Guillotine:
 
 
 
+    #offset of the first byte after the line which starts with the header marker, or -1 if there is no such line
+    #lines end with \n, \r\n or \r, as for a file read in text mode
+    def findbody(self,data):
+        position=data.find(Guillotine.ENDHEADERBYTES)
+        while position>0 and data[position-1:position] not in (b"\n",b"\r"):
+            position=data.find(Guillotine.ENDHEADERBYTES,position+1)
+        if position<0:
+            return -1
+        newline=data.find(b"\n",position)
+        carriage=data.find(b"\r",position)
+        if carriage>=0 and (newline<0 or carriage<newline):
+            return carriage+2 if data[carriage+1:carriage+2]==b"\n" else carriage+1
+        if newline<0:
+            return len(data)
+        return newline+1
+
+    #write data from start to outstream without copying it, unless its line endings have to be converted to \n
+    #returns the number of bytes written
+    def writebody(self,data,start,outstream):
+        if data.find(b"\r",start)<0:
+            with memoryview(data) as view,view[start:] as body:
+                outstream.write(body)
+            return len(data)-start
+        written=0
+        while start<len(data):
+            end=min(start+Guillotine.CHUNK,len(data))
+            if data[end-1:end]==b"\r":
+                end+=1 #keep a \r\n together
+            chunk=data[start:end].replace(b"\r\n",b"\n").replace(b"\r",b"\n")
+            outstream.write(chunk)
+            written+=len(chunk)
+            start=end
+        return written
+
+    #worker for the fast mode: returns the input path and the number of bytes written, or -1 if the marker is missing
+    def fastcleanup(self,inpath):
+        filename=os.path.basename(inpath)
+        outpath=os.path.join(self.outpath,filename)
+        if os.path.getsize(inpath)==0:
+            return inpath,-1
+        with open(inpath,'rb') as instream:
+            with mmap.mmap(instream.fileno(),0,access=mmap.ACCESS_READ) as data:
+                start=self.findbody(data)
+                if start<0:
+                    return inpath,-1
+                if self.compress:
+                    with gzip.open(outpath+".gz",'wb') as outstream:
+                        return inpath,self.writebody(data,start,outstream)
+                else:
+                    with open(outpath,'wb') as outstream:
+                        return inpath,self.writebody(data,start,outstream)
+
+    def fastrun(self,files):
+        pool=Pool(self.processes)
+        missing=[]
+        written=0
+        for inpath,size in pool.imap_unordered(self.fastcleanup,files):
+            if size<0:
+                missing.append(inpath)
+            else:
+                written+=size
+        pool.close()
+        pool.join()
+        print("Stripped "+str(len(files)-len(missing))+" files, writing "+str(written)+" bytes to "+self.outpath)
+        if missing:
+            print("No header marker found in "+str(len(missing))+" files (not written):")
+            for inpath in sorted(missing):
+                print(inpath)
+        return missing
+
     def run(self):
         self.checkfiles()
         self.ensure_outpath()
+        if self.fast:
+            return self.fastrun(glob.glob(self.indir+"/*.TXT"))
         for f in glob.glob(self.indir+"/*.TXT"):
             self.cleanup(f)
 
@@ -0,0 +1,194 @@
+__author__ = 'juliewe'
+#extracts raw APT vectors from the aptInput- files written by preprocessing.Converter
+#the output is the vectors tsv read by composition.py (split etc): entry, then feature and count pairs
+#features are anchored paths through each sentence's dependency tree up to a given order, e.g. for "man" in "the man shot the gunman"
+#: ":man/N" (0th order), "_nsubj:shoot/V" (1st order), "_nsubj»dobj:gunman/N" (2nd order)
+#counting is bounded in memory: each worker spills (entry,feature) counts into per-shard run files whenever it holds maxpairs pairs
+#and each shard is then aggregated separately, so only one shard's vectors need to be held in memory at once
+#
+#python -m src.tools.vectorextraction inputfile_or_dir outputfile order=2 workers=8 shards=64 maxpairs=5000000 coarsepos=True
+
+import sys,os,gzip,zlib,time,shutil,io
+from multiprocessing import Pool
+
+from src.tools.preprocessing import BlockReader,readblock,readsentences
+
+PATHSEP="»"
+
+def configure(arguments):
+
+    parameters={}
+    parameters['order']=2
+    parameters['workers']=1
+    parameters['shards']=16
+    parameters['maxpairs']=5000000
+    parameters['coarsepos']=True
+    for argument in arguments[1:]:
+        if '=' in argument:
+            key,value=argument.split('=',1)
+            if value.isdigit():
+                parameters[key]=int(value)
+            elif value in ["True","False"]:
+                parameters[key]=value=="True"
+            else:
+                parameters[key]=value
+    arguments=[argument for argument in arguments if '=' not in argument]
+    if len(arguments)<3:
+        print("Requires two arguments: input file or directory and output file")
+        exit()
+    parameters["filename"]=arguments[1]
+    parameters["outfile"]=arguments[2]
+    return parameters
+
+class VectorExtractor:
+
+    def __init__(self,parameters):
+        self.parameters=parameters
+        self.filename=parameters["filename"].rstrip('/')
+        self.outfile=parameters["outfile"]
+        self.order=parameters.get('order',2)
+        self.workers=parameters.get('workers',1)
+        self.shards=parameters.get('shards',16)
+        self.maxpairs=parameters.get('maxpairs',5000000)
+        self.coarsepos=parameters.get('coarsepos',True)
+        self.workdir=self.outfile+".runs"
+
+    #one job per input file, or per block for block-compressed files
+    def makejobs(self):
+        if os.path.isdir(self.filename):
+            filenames=[os.path.join(self.filename,df) for df in sorted(os.listdir(self.filename)) if df.startswith("aptInput-") and df.endswith(".gz")]
+        else:
+            filenames=[self.filename]
+        jobs=[]
+        for filename in filenames:
+            if os.path.exists(filename+'.idx'):
+                reader=BlockReader(filename)
+                jobs+=[(filename,offset,length) for offset,length in zip(reader.offsets,reader.lengths)]
+            else:
+                jobs.append((filename,0,-1))
+        return jobs
+
+    #the token string for a word/POS field, with the POS tag reduced to its first letter if coarsepos
+    def token(self,field):
+        if self.coarsepos:
+            word,slash,pos=field.rpartition('/')
+            if slash:
+                return word+'/'+pos[:1].upper()
+        return field
+
+    #add the features of every token in one sentence to counts
+    #edges are followed in both directions: head to dependent is labelled rel and dependent to head _rel
+    #paths do not revisit a token, so e.g. amod»_amod back to the anchor is never produced
+    def addsentence(self,lines,counts):
+        tokens={}
+        edges={}
+        for line in lines:
+            fields=line.split('\t')
+            if len(fields)<4:
+                continue
+            tokens[fields[0]]=self.token(fields[1])
+            edges.setdefault(fields[0],[])
+        for line in lines:
+            fields=line.split('\t')
+            if len(fields)<4:
+                continue
+            index,head,rel=fields[0],fields[2],fields[3]
+            if head in tokens and head!=index:
+                edges[index].append(("_"+rel,head))
+                edges[head].append((rel,index))
+
+        for anchor in tokens:
+            entry=tokens[anchor]
+            key=(entry,":"+entry)
+            counts[key]=counts.get(key,0)+1
+            stack=[(anchor,"",(anchor,))] if self.order>0 else []
+            while stack:
+                node,path,visited=stack.pop()
+                for rel,target in edges[node]:
+                    if target in visited:
+                        continue
+                    newpath=path+PATHSEP+rel if path else rel
+                    key=(entry,newpath+":"+tokens[target])
+                    counts[key]=counts.get(key,0)+1
+                    if len(visited)<self.order:
+                        stack.append((target,newpath,visited+(target,)))
+
+    #worker: count the features in one file or block, spilling to the shard run files whenever maxpairs is reached
+    #a whole file is streamed a sentence at a time, so only a block is ever held in memory
+    def extractjob(self,numberedjob):
+        number,job=numberedjob
+        filename,offset,length=job
+        if length<0:
+            with gzip.open(filename,'rb') as instream:
+                return self.extractstream(instream,number)
+        else:
+            return self.extractstream(io.BytesIO(readblock(job)),number)
+
+    def extractstream(self,instream,number):
+        counts={}
+        spills=0
+        sentences=0
+        for sentence,tokens in readsentences(instream):
+            lines=sentence.decode('utf-8').split('\n')
+            self.addsentence([line.rstrip() for line in lines if line.strip()],counts)
+            sentences+=1
+            if len(counts)>=self.maxpairs:
+                self.spill(counts,number,spills)
+                counts={}
+                spills+=1
+        self.spill(counts,number,spills)
+        return sentences,spills+1
+
+    def spill(self,counts,number,spill):
+        outstreams=[open(os.path.join(self.workdir,str(shard),str(number)+"_"+str(spill)),'w',encoding='utf-8') for shard in range(self.shards)]
+        for (entry,feature),count in counts.items():
+            outstreams[zlib.crc32(entry.encode('utf-8'))%self.shards].write(entry+"\t"+feature+"\t"+str(count)+"\n")
+        for outstream in outstreams:
+            outstream.close()
+
+    #worker: add up the run files for one shard and write its vectors, sorted by entry
+    def aggregateshard(self,shard):
+        sharddir=os.path.join(self.workdir,str(shard))
+        vectors={}
+        for runfile in os.listdir(sharddir):
+            with open(os.path.join(sharddir,runfile),encoding='utf-8') as instream:
+                for line in instream:
+                    entry,feature,count=line.rstrip('\n').split('\t')
+                    vector=vectors.setdefault(entry,{})
+                    vector[feature]=vector.get(feature,0)+int(count)
+        outname=sharddir+".tsv"
+        with open(outname,'w',encoding='utf-8') as outstream:
+            for entry in sorted(vectors):
+                vector=vectors[entry]
+                outstream.write(entry+"".join(["\t"+feature+"\t"+str(vector[feature]) for feature in vector])+"\n")
+        return outname,len(vectors)
+
+    def run(self):
+        start=time.time()
+        jobs=self.makejobs()
+        print("Extracting order "+str(self.order)+" features from "+str(len(jobs))+" jobs with "+str(self.workers)+" workers into "+str(self.shards)+" shards")
+        for shard in range(self.shards):
+            os.makedirs(os.path.join(self.workdir,str(shard)),exist_ok=True)
+
+        pool=Pool(self.workers)
+        sentences=0
+        runs=0
+        for done,(jobsentences,jobruns) in enumerate(pool.imap_unordered(self.extractjob,list(enumerate(jobs)))):
+            sentences+=jobsentences
+            runs+=jobruns
+            print("Completed "+str(done+1)+" of "+str(len(jobs))+" jobs, "+str(sentences)+" sentences")
+        print("Aggregating "+str(runs)+" runs per shard")
+        entries=0
+        with open(self.outfile,'wb') as outstream:
+            for outname,shardentries in pool.imap(self.aggregateshard,range(self.shards)):
+                entries+=shardentries
+                with open(outname,'rb') as instream:
+                    shutil.copyfileobj(instream,outstream)
+        pool.close()
+        pool.join()
+        shutil.rmtree(self.workdir)
+        print("Wrote %d vectors from %d sentences to %s in %.1fs"%(entries,sentences,self.outfile,time.time()-start))
+
+if __name__=="__main__":
+    myExtractor=VectorExtractor(configure(sys.argv))
+    myExtractor.run()
@@ -1,32 +1,86 @@
 __author__ = 'juliewe'
 #17/6/2015
-import sys
+import sys,os,functools,itertools,json,math
+from multiprocessing import Pool
 from .conf import configure
-from nltk.corpus import wordnet as wn
-from nltk.corpus import wordnet_ic as wn_ic
+
+#nltk and its WordNet corpus are imported and parsed on first use rather than at import, so runs which never need them
+#(e.g. from a snapshot with synset tables) do not pay for them
+def wordnet():
+    from nltk.corpus import wordnet as wn
+    return wn
+
+#a synset read from a snapshot, with just the parts of nltk's Synset that Analyser uses
+class Sense:
+
+    def __init__(self,name,definition="",hyponyms=()):
+        self._name=name
+        self._definition=definition
+        self._hyponyms=hyponyms
+
+    def name(self):
+        return self._name
+
+    def definition(self):
+        return self._definition
+
+    def hyponyms(self):
+        return [Sense(name) for name in self._hyponyms]
+
+    def __eq__(self,other):
+        return isinstance(other,Sense) and self._name==other._name
+
+    def __hash__(self):
+        return hash(self._name)
+
+    def __repr__(self):
+        return "Sense('"+self._name+"')"
 
 
 class Analyser:
     k=10
-    posdict={'N':wn.NOUN,'J':wn.ADJ}
+    posdict={'N':'n','J':'a'} #nltk's wn.NOUN and wn.ADJ
     max=0
     synsetthresh=3
     totalthresh=0.3
     propthresh=0.4
     simthresh=0.1
     simmetric="path"
+    synsetcache=100000 #maximum number of (word,pos) synset lookups kept
+    simcache=1000000 #maximum number of (metric,synset,synset) similarities kept
+    workers=1 #processes for processfile, each with its own Analyser and caches
+    chunklines=1000 #lines of the thesaurus sent to a worker at a time
+    icfile='ic-semcor.dat' #only loaded for res, jcn and lin
 
 
     def __init__(self,parameters):
 
         self.parameters=parameters
         self.wn_sim=self.parameters.get("wn_sim",Analyser.simmetric)
-        self.ic=wn_ic.ic('ic-semcor.dat')
+        self.ic=None
         self.candidates={}
         self.synsetthresh=self.parameters.get("synset_thresh",Analyser.synsetthresh)
         self.totalthresh=self.parameters.get("total_thresh",Analyser.totalthresh)
         self.propthresh=self.parameters.get("prop_thresh",Analyser.propthresh)
         self.simthresh=self.parameters.get("sim_thresh",Analyser.simthresh)
+        #bounded LRU caches: the same frequent neighbours and synset pairs recur across many thesaurus lines
+        self.synsets=functools.lru_cache(maxsize=self.parameters.get("synset_cache",Analyser.synsetcache))(self.lookupsynsets)
+        self.similarity=functools.lru_cache(maxsize=self.parameters.get("sim_cache",Analyser.simcache))(self.computesim)
+        #optional precomputed hierarchy tables (see synsettables.py): each neighbour is then scored against all the entry's synsets in one call
+        self.tables=None
+        if self.parameters.get("synset_tables"):
+            from .synsettables import SynsetTables
+            self.tables=SynsetTables(self.parameters["synset_tables"])
+        #optional binary index of the thesaurus (see thesaurusindex.py), read instead of thesfile when set
+        self.index=None
+        if self.parameters.get("thesindex"):
+            from .thesaurusindex import ThesaurusIndex
+            self.index=ThesaurusIndex(self.parameters["thesindex"])
+        #optional snapshot of the synsets of the thesaurus' words (see makesnapshot), used instead of nltk's corpus when it exists
+        self.snapshot=None
+        self.senses={}
+        if self.parameters.get("wn_snapshot") and os.path.exists(self.parameters["wn_snapshot"]):
+            self.loadsnapshot(self.parameters["wn_snapshot"])
 
     def strippos(self,word):
         fields=word.split("/")
@@ -42,19 +96,45 @@ class Analyser:
         else:
             return 'X'
 
+    def lookupsynsets(self,word,pos):
+        if self.snapshot is not None and word in self.snapshot.get(pos,{}):
+            return self.snapshot[pos][word]
+        return wordnet().synsets(word,pos=pos)
+
+    def synsetbyname(self,name):
+        if name in self.senses:
+            return self.senses[name]
+        return wordnet().synset(name)
+
+    def informationcontent(self):
+        if self.ic is None:
+            from nltk.corpus import wordnet_ic as wn_ic
+            self.ic=wn_ic.ic(self.parameters.get("ic_file",Analyser.icfile))
+        return self.ic
+
     def findsim(self,s1,s2):
-        if self.wn_sim=="path":
+        return self.similarity(self.wn_sim,s1,s2)
+
+    def computesim(self,metric,s1,s2):
+        if self.tables is not None:
+            sim=self.tables.similarity(metric,[s1.name()],[s2.name()])[0,0]
+            return None if math.isnan(sim) else float(sim)
+        if isinstance(s1,Sense):
+            s1=wordnet().synset(s1.name())
+        if isinstance(s2,Sense):
+            s2=wordnet().synset(s2.name())
+        if metric=="path":
             return s1.path_similarity(s2)
-        elif self.wn_sim=="lch":
+        elif metric=="lch":
             return s1.lch_similarity(s2)
-        elif self.wn_sim=="wup":
+        elif metric=="wup":
             return s1.wup_similarity(s2)
-        elif self.wn_sim=="res":
-            return s1.res_similarity(s2,self.ic)
-        elif self.wn_sim=="jcn":
-            return s1.jcn_similarity(s2,self.ic)
-        elif self.wn_sim=="lin":
-            return s1.lin_similarity(s2,self.ic)
+        elif metric=="res":
+            return s1.res_similarity(s2,self.informationcontent())
+        elif metric=="jcn":
+            return s1.jcn_similarity(s2,self.informationcontent())
+        elif metric=="lin":
+            return s1.lin_similarity(s2,self.informationcontent())
 
 
     def updatedist(self,dist,synsets,neigh,sim,apos):
@@ -63,17 +143,23 @@ class Analyser:
         sofar=-1
         max=0
         try:
-            nsynsets=wn.synsets(neigh.lower(),pos=apos)
+            nsynsets=self.synsets(neigh.lower(),apos)
         except:
             #print "Cannot get synsets for neighbour "+neigh
             nsynsets=[]
 
-        for e in synsets:
-            for n in nsynsets:
-                wnsim=self.findsim(e,n)
-                if wnsim>max:
-                    max=wnsim
-                    sofar=e
+        if self.tables is not None:
+            i,j,best=self.tables.best(self.wn_sim,[e.name() for e in synsets],[n.name() for n in nsynsets])
+            if best>max:
+                max=best
+                sofar=synsets[i]
+        else:
+            for e in synsets:
+                for n in nsynsets:
+                    wnsim=self.findsim(e,n)
+                    if wnsim>max:
+                        max=wnsim
+                        sofar=e
 
         if max>0:
             dist[sofar]=dist.get(sofar,0)+max*sim
@@ -82,20 +168,30 @@ class Analyser:
 
     def processline(self,line):
         fields=line.split("\t")
-        entry=fields[0]
+        neighbours=self.parseneighbours(fields)
+        if neighbours is None:
+            return False
+        return self.processentry(fields[0],neighbours)
+
+    #the first k (neighbour,similarity) pairs of a thesaurus line's fields
+    #None if they end with a neighbour without a similarity, as such a line is rejected
+    def parseneighbours(self,fields):
+        neighs=fields[1:(Analyser.k*2+1)]
+        if len(neighs)%2==1:
+            return None
+        return list(zip(neighs[0::2],neighs[1::2]))
+
+    #neighbours are (neighbour,similarity) pairs, from parseneighbours or a ThesaurusIndex
+    def processentry(self,entry,neighbours):
         word=self.strippos(entry).lower()
         apos=self.posdict.get(self.getPOS(entry),'X')
         if apos==self.posdict.get('N','X'):
             try:
-                synsets=wn.synsets(word,pos=apos)
+                synsets=self.synsets(word,apos)
                 if len(synsets)>1:
                     print(word,apos,len(synsets))
-                    neighs=fields[1:(Analyser.k*2+1)]
-                    neighs.reverse()
                     sensedist={}
-                    while len(neighs)>0:
-                        neigh=neighs.pop()
-                        sim=neighs.pop()
+                    for neigh,sim in neighbours:
                         sensedist=self.updatedist(sensedist,synsets,self.strippos(neigh),float(sim),apos)
 
                     #print entry, sensedist
@@ -146,19 +242,114 @@ class Analyser:
         return False
 
 
+    #the thesaurus file's lines, or the rows of its binary index if thesindex is set
+    def thesaurus(self):
+        if self.index is not None:
+            yield from range(len(self.index))
+        else:
+            with open(self.parameters["thesdir"]+self.parameters["thesfile"]) as instream:
+                yield from instream
+
+    #the entry and neighbours of a line or index row
+    def readentry(self,item):
+        if self.index is not None:
+            return self.index.entry(item),self.index.neighbours(item,Analyser.k)
+        fields=item.rstrip().split("\t")
+        return fields[0],self.parseneighbours(fields)
+
+    #the line to write to the filtered file if a line or index row is selected, otherwise None
+    def processitem(self,item):
+        entry,neighbours=self.readentry(item)
+        if neighbours is not None and self.processentry(entry,neighbours):
+            return self.index.line(item) if self.index is not None else item.rstrip()
+        return None
+
     def processfile(self):
-        infile=self.parameters["thesdir"]+self.parameters["thesfile"]
-        outfile=infile+".filtered"
-        lines=0
+        if self.parameters.get("workers",Analyser.workers)>1:
+            return self.processfile_parallel()
+        outfile=self.parameters["thesdir"]+self.parameters["thesfile"]+".filtered"
+        items=self.thesaurus()
+        if Analyser.max>0:
+            items=itertools.islice(items,Analyser.max+1)
         with open(outfile,'w') as outstream:
-            with open(infile) as instream:
-                for line in instream:
-                    lines+=1
-                    line=line.rstrip()
-                    if self.processline(line):
-                        outstream.write(line+"\n")
-                    if Analyser.max>0 and lines>Analyser.max:
-                        break
+            for item in items:
+                line=self.processitem(item)
+                if line is not None:
+                    outstream.write(line+"\n")
+
+    #processfile split into chunks of lines (or index rows) analysed in worker processes
+    #filtered lines are written and candidates merged in input order, so the output is the same as processfile's
+    def processfile_parallel(self):
+        outfile=self.parameters["thesdir"]+self.parameters["thesfile"]+".filtered"
+        chunklines=self.parameters.get("chunklines",Analyser.chunklines)
+        self.workercaches={}
+        pool=Pool(self.parameters.get("workers",Analyser.workers),initializer=initworker,initargs=(self.parameters,))
+        items=self.thesaurus()
+        if Analyser.max>0:
+            items=itertools.islice(items,Analyser.max+1)
+        chunks=iter(lambda:list(itertools.islice(items,chunklines)),[])
+        with open(outfile,'w') as outstream:
+            for filtered,candidates,caches in pool.imap(analysechunk,chunks):
+                for line in filtered:
+                    outstream.write(line+"\n")
+                for entry,dist in candidates:
+                    self.candidates[entry]=dict((self.synsetbyname(name),value) for name,value in dist)
+                self.workercaches[caches[0]]=caches[1:]
+        pool.close()
+        pool.join()
+
+    #worker side of processfile_parallel: the filtered lines and candidates (with synsets as names) for a chunk, and this worker's cache statistics
+    def processchunk(self,items):
+        filtered=[]
+        candidates=[]
+        for item in items:
+            self.candidates={}
+            line=self.processitem(item)
+            if line is not None:
+                filtered.append(line)
+            for entry,dist in self.candidates.items():
+                candidates.append((entry,[(synset.name(),value) for synset,value in dist.items()]))
+        return filtered,candidates,(os.getpid(),tuple(self.synsets.cache_info()),tuple(self.similarity.cache_info()))
+
+    #writes the synsets of every noun entry and neighbour word in the thesaurus, with the definitions and hyponyms of the entries' synsets,
+    #so that later runs can skip loading nltk's WordNet corpus
+    def makesnapshot(self,filename):
+        wn=wordnet()
+        lookups={}
+        synsets={}
+        entries=set()
+        for item in self.thesaurus():
+            entry,neighbours=self.readentry(item)
+            apos=self.posdict.get(self.getPOS(entry),'X')
+            if apos!=self.posdict.get('N','X') or neighbours is None:
+                continue
+            words=lookups.setdefault(apos,{})
+            entry=self.strippos(entry).lower()
+            if entry not in entries:
+                entries.add(entry)
+                words[entry]=[]
+                for synset in wn.synsets(entry,pos=apos):
+                    words[entry].append(synset.name())
+                    synsets[synset.name()]=[synset.definition(),[hyp.name() for hyp in synset.hyponyms()]]
+            for neigh,sim in neighbours:
+                word=self.strippos(neigh).lower()
+                if word not in words:
+                    words[word]=[synset.name() for synset in wn.synsets(word,pos=apos)]
+        with open(filename,'w') as outstream:
+            json.dump({"lookups":lookups,"synsets":synsets},outstream)
+        print("Wrote snapshot of "+str(sum(len(words) for words in lookups.values()))+" words to "+filename)
+
+    def loadsnapshot(self,filename):
+        with open(filename) as instream:
+            snapshot=json.load(instream)
+        self.snapshot={}
+        for pos,words in snapshot["lookups"].items():
+            self.snapshot[pos]={}
+            for word,names in words.items():
+                for name in names:
+                    if name not in self.senses:
+                        self.senses[name]=Sense(name,*snapshot["synsets"].get(name,("",())))
+                self.snapshot[pos][word]=[self.senses[name] for name in names]
 
     def displaycandidates(self):
 
@@ -174,9 +365,34 @@ class Analyser:
                 print(hypstring)
             print("----")
 
+    def reportcaches(self):
+        #after processfile_parallel the statistics are summed over the workers' caches
+        infos=[(tuple(self.synsets.cache_info()),tuple(self.similarity.cache_info()))]+list(getattr(self,'workercaches',{}).values())
+        for index,name in enumerate(["Synset","Similarity"]):
+            hits=sum(info[index][0] for info in infos)
+            lookups=hits+sum(info[index][1] for info in infos)
+            entries=sum(info[index][3] for info in infos)
+            maxsize=infos[0][index][2]
+            print(name+" cache: "+str(hits)+" hits of "+str(lookups)+" lookups ("+("%.1f"%(100.0*hits/lookups) if lookups>0 else "0.0")+"%), "+str(entries)+" entries (at most "+str(maxsize)+" per process)")
+
     def run(self):
+        snapshot=self.parameters.get("wn_snapshot")
+        if snapshot and self.snapshot is None:
+            self.makesnapshot(snapshot)
+            self.loadsnapshot(snapshot)
         self.processfile()
         self.displaycandidates()
+        self.reportcaches()
+
+#each worker process builds its own Analyser, and so its own WordNet handle and caches, once
+_worker=None
+
+def initworker(parameters):
+    global _worker
+    _worker=Analyser(parameters)
+
+def analysechunk(lines):
+    return _worker.processchunk(lines)
 
 if __name__=="__main__":
     myAnalyser=Analyser(configure(sys.argv))
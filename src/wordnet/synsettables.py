@@ -0,0 +1,261 @@
+__author__ = 'juliewe'
+#array-backed tables of the WordNet noun and adjective hierarchies, so that Analyser can score one entry's synsets
+#against all of a neighbour's synsets in a single vectorised call instead of one nltk hypernym traversal per pair
+#
+#for each synset the tables hold its ancestors (including itself) sorted by id with their shortest hypernym distances,
+#its min and max depth, its information content from the IC file and the rank of its name
+#adjectives have no hypernyms, so as in nltk they get a simulated root above every synset at one more than its furthest ancestor
+#
+#python -m src.wordnet.synsettables export data/wordnet/synsets.npz [ic-semcor.dat]
+#python -m src.wordnet.synsettables check data/wordnet/synsets.npz [ic-semcor.dat] [pairs]
+
+import sys,math,random
+import numpy as np
+
+FAMILIES=['n','a'] #adjective satellites ('s') are in the 'a' tables, as they are in data.adj
+ROOT="*ROOT*"
+INF=1e300 #nltk's value for infinite information content and jcn similarity
+NOPATH=1<<30
+
+#builds the tables for one family from nltk's WordNet reader and an IC dictionary as returned by wordnet_ic.ic
+def buildfamily(wn,ic,family):
+    synsets=list(wn.all_synsets(family))
+    names=[synset.name() for synset in synsets]
+    ids=dict((name,i) for i,name in enumerate(names))
+    parents=[[ids[hyp.name()] for hyp in synset.hypernyms()+synset.instance_hypernyms()] for synset in synsets]
+    needroot=family!='n'
+
+    #shortest distance from each synset to each of its ancestors, as in nltk's _shortest_hypernym_paths
+    paths=[None]*len(synsets)
+    mindepth=[0]*len(synsets)
+    maxdepth=[0]*len(synsets)
+    def walk(i):
+        if paths[i] is None:
+            path={i:0}
+            for parent in parents[i]:
+                for ancestor,distance in walk(parent).items():
+                    if distance+1<path.get(ancestor,NOPATH):
+                        path[ancestor]=distance+1
+            if parents[i]:
+                mindepth[i]=1+min(mindepth[parent] for parent in parents[i])
+                maxdepth[i]=1+max(maxdepth[parent] for parent in parents[i])
+            paths[i]=path
+        return paths[i]
+    for i in range(len(synsets)):
+        walk(i)
+
+    poss=[synset.pos() for synset in synsets]
+    if needroot:
+        root=len(synsets)
+        for path in paths:
+            path[root]=max(path.values())+1
+        names.append(ROOT)
+        poss.append('')
+        paths.append({root:0})
+        mindepth.append(0)
+        maxdepth.append(0)
+
+    if family in ic:
+        icpos=ic[family]
+        values=[INF if icpos[synset.offset()]==0 else -math.log(icpos[synset.offset()]/icpos[0]) for synset in synsets]
+    else:
+        values=[float('nan')]*len(synsets)
+    if needroot:
+        values.append(float('nan'))
+
+    starts=[0]
+    ancestors=[]
+    distances=[]
+    for path in paths:
+        for ancestor in sorted(path):
+            ancestors.append(ancestor)
+            distances.append(path[ancestor])
+        starts.append(len(ancestors))
+    rank=np.empty(len(names),dtype=np.int64)
+    rank[np.argsort(np.array(names))]=np.arange(len(names))
+    #nltk's lch depth: the deepest synset of the part of speech, plus one for a simulated root
+    depth=max(maxdepth)+(1 if needroot else 0)
+
+    return {family+'_names':np.array(names),family+'_pos':np.array(poss),family+'_starts':np.array(starts,dtype=np.int64),
+            family+'_ancestors':np.array(ancestors,dtype=np.int32),family+'_distances':np.array(distances,dtype=np.int32),
+            family+'_mindepth':np.array(mindepth,dtype=np.int64),family+'_maxdepth':np.array(maxdepth,dtype=np.int64),
+            family+'_ic':np.array(values),family+'_rank':rank,family+'_depth':np.array(depth),family+'_hasic':np.array(family in ic)}
+
+def export(filename,icfile='ic-semcor.dat'):
+    from nltk.corpus import wordnet as wn
+    from nltk.corpus import wordnet_ic as wn_ic
+    ic=wn_ic.ic(icfile)
+    arrays={}
+    for family in FAMILIES:
+        arrays.update(buildfamily(wn,ic,family))
+        print("Exported "+str(len(arrays[family+'_names']))+" synsets and "+str(len(arrays[family+'_ancestors']))+" ancestors for "+family)
+    with open(filename,'wb') as outstream:
+        np.savez(outstream,**arrays)
+
+#the tables for one family
+class Taxonomy:
+
+    def __init__(self,data,family):
+        self.family=family
+        self.names=data[family+'_names']
+        self.pos=data[family+'_pos']
+        self.starts=data[family+'_starts']
+        self.ancestors=data[family+'_ancestors']
+        self.distances=data[family+'_distances']
+        self.mindepth=data[family+'_mindepth']
+        self.maxdepth=data[family+'_maxdepth']
+        self.ic=data[family+'_ic']
+        self.rank=data[family+'_rank']
+        self.depth=int(data[family+'_depth'])
+        self.hasic=bool(data[family+'_hasic'])
+        self.size=len(self.names)
+
+    #the ancestor lists of several synsets concatenated: the row each entry belongs to, the ancestors, their distances and where each row starts
+    def gather(self,ids):
+        counts=self.starts[ids+1]-self.starts[ids]
+        segments=np.cumsum(counts)-counts
+        rows=np.repeat(np.arange(len(ids)),counts)
+        positions=np.arange(counts.sum())-segments[rows]+self.starts[ids][rows]
+        return rows,self.ancestors[positions],self.distances[positions],segments
+
+    #shortest path lengths from each synset in ids to one of its ancestors, given a lookup of ids' distances to the ancestors of subsumers
+    def subsumerdistances(self,subsumers,distanceto):
+        rows,ancestors,distances,segments=self.gather(subsumers)
+        return np.minimum.reduceat(distanceto(rows,ancestors)+distances,segments)
+
+    #similarities between the synsets eids and nids, NaN where nltk returns None or raises
+    def score(self,metric,eids,nids):
+        sims=np.full((len(eids),len(nids)),np.nan)
+        if len(nids)==0:
+            return sims
+        if metric in ["res","jcn","lin"] and not self.hasic:
+            raise ValueError("No information content for part of speech "+self.family)
+        rows,ancestors,distances,segments=self.gather(nids)
+        keys=rows*self.size+ancestors
+        for i,e in enumerate(eids):
+            eancestors=self.ancestors[self.starts[e]:self.starts[e+1]]
+            edistances=self.distances[self.starts[e]:self.starts[e+1]]
+            at=np.minimum(np.searchsorted(eancestors,ancestors),len(eancestors)-1)
+            common=eancestors[at]==ancestors
+            samepos=self.pos[nids]==self.pos[e]
+
+            if metric in ["path","lch"]:
+                shortest=np.minimum.reduceat(np.where(common,edistances[at]+distances,NOPATH),segments)
+                found=shortest<NOPATH
+                if metric=="path":
+                    sims[i,found]=1.0/(shortest[found]+1)
+                elif self.depth>0:
+                    found&=samepos
+                    sims[i,found]=-np.log((shortest[found]+1)/(2.0*self.depth))
+
+            elif metric=="wup":
+                #nltk's lowest common hypernym by min depth, preferring e itself and then the first name
+                priority=np.where(common,self.mindepth[ancestors]*4*self.size+(ancestors==e)*2*self.size+(self.size-1-self.rank[ancestors]),-1)
+                best=np.maximum.reduceat(priority,segments)
+                found=best>=0
+                chosen=common&(priority==best[rows])
+                subsumers=ancestors[chosen]
+                subrows=rows[chosen]
+                len1=self.subsumerdistances(subsumers,lambda r,a:edistances[np.searchsorted(eancestors,a)])
+                len2=self.subsumerdistances(subsumers,lambda r,a:distances[np.searchsorted(keys,subrows[r]*self.size+a)])
+                depth=self.maxdepth[subsumers]+1
+                sims[i,found]=(2.0*depth)/((len1+depth)+(len2+depth))
+
+            else:
+                #the simulated root has no information content and, as in nltk, is not a subsumer
+                lcs=np.maximum.reduceat(np.where(common&~np.isnan(self.ic[ancestors]),self.ic[ancestors],-np.inf),segments)
+                lcs[lcs==-np.inf]=0
+                ic1=self.ic[e]
+                ic2=self.ic[nids]
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    if metric=="res":
+                        values=lcs
+                    elif metric=="jcn":
+                        difference=ic1+ic2-2*lcs
+                        values=np.where(difference==0,INF,1/difference)
+                        values=np.where((ic1==0)|(ic2==0),0,values)
+                        values=np.where(nids==e,INF,values)
+                    elif metric=="lin":
+                        values=np.where(ic1+ic2==0,np.nan,(2.0*lcs)/(ic1+ic2))
+                    else:
+                        raise ValueError("Unknown similarity metric "+metric)
+                sims[i,samepos]=values[samepos]
+        return sims
+
+class SynsetTables:
+
+    def __init__(self,filename):
+        data=np.load(filename)
+        self.taxonomies={}
+        self.ids={}
+        for family in FAMILIES:
+            taxonomy=Taxonomy(data,family)
+            self.taxonomies[family]=taxonomy
+            for i,name in enumerate(taxonomy.names.tolist()):
+                if name!=ROOT:
+                    self.ids[name]=(family,i)
+        data.close()
+
+    #similarities between two lists of synset names as an array, as computed by nltk's metric(names1[i],names2[j])
+    #NaN where nltk would return None or raise, e.g. for synsets of different parts of speech, and for synsets of different families,
+    #which Analyser never compares
+    def similarity(self,metric,names1,names2):
+        ids1=[self.ids[name] for name in names1]
+        ids2=[self.ids[name] for name in names2]
+        sims=np.full((len(ids1),len(ids2)),np.nan)
+        for family,taxonomy in self.taxonomies.items():
+            rows=[i for i,(f,e) in enumerate(ids1) if f==family]
+            columns=[j for j,(f,n) in enumerate(ids2) if f==family]
+            if rows and columns:
+                sims[np.ix_(rows,columns)]=taxonomy.score(metric,np.array([ids1[i][1] for i in rows]),np.array([ids2[j][1] for j in columns]))
+        return sims
+
+    #the position (i,j) and value of the first greatest similarity, scanning names1 then names2 as Analyser.updatedist does
+    def best(self,metric,names1,names2):
+        sims=self.similarity(metric,names1,names2)
+        if np.isnan(sims).any():
+            raise ValueError("No "+metric+" similarity for some synset pairs")
+        if sims.size==0:
+            return None,None,0
+        flat=int(np.argmax(sims))
+        return flat//sims.shape[1],flat%sims.shape[1],float(sims.flat[flat])
+
+#compares the tables against nltk on random pairs of synsets and pairs with a common hypernym
+def check(filename,icfile='ic-semcor.dat',pairs=1000):
+    from nltk.corpus import wordnet as wn
+    from nltk.corpus import wordnet_ic as wn_ic
+    ic=wn_ic.ic(icfile)
+    tables=SynsetTables(filename)
+    for family in FAMILIES:
+        synsets=list(wn.all_synsets(family))
+        samples=[(random.choice(synsets),random.choice(synsets)) for i in range(pairs)]
+        for synset in random.sample(synsets,min(pairs,len(synsets))):
+            hyponyms=[hyp for hypernym in synset.hypernyms() for hyp in hypernym.hyponyms()]
+            samples.append((synset,random.choice(hyponyms) if hyponyms else synset))
+        metrics=["path","lch","wup"]+(["res","jcn","lin"] if tables.taxonomies[family].hasic else [])
+        for metric in metrics:
+            worst=0
+            mismatched=0
+            for s1,s2 in samples:
+                try:
+                    if metric in ["res","jcn","lin"]:
+                        expected=getattr(s1,metric+"_similarity")(s2,ic)
+                    else:
+                        expected=getattr(s1,metric+"_similarity")(s2)
+                except Exception:
+                    expected=None
+                value=tables.similarity(metric,[s1.name()],[s2.name()])[0,0]
+                if expected is None or np.isnan(value):
+                    if not (expected is None and np.isnan(value)):
+                        mismatched+=1
+                else:
+                    worst=max(worst,abs(value-expected)/max(1.0,abs(expected)))
+            print(family+" "+metric+": largest relative difference "+str(worst)+", "+str(mismatched)+" of "+str(len(samples))+" pairs disagree on None")
+
+if __name__=="__main__":
+    if len(sys.argv)<3:
+        print("Usage: synsettables.py export|check tablesfile [icfile] [pairs]")
+    elif sys.argv[1]=="export":
+        export(sys.argv[2],*sys.argv[3:4])
+    elif sys.argv[1]=="check":
+        check(sys.argv[2],*(sys.argv[3:4]+[int(arg) for arg in sys.argv[4:5]]))
@@ -0,0 +1,115 @@
+__author__ = 'juliewe'
+#a compact binary form of a neighbours.strings thesaurus (entry, then neighbour and similarity pairs, tab separated)
+#so that the thesaurus need not be reparsed for every run and the neighbours of any entry can be read directly
+#
+#an index with base name base is five files:
+#base.vocab: every entry and neighbour string, one per line, numbered from 0
+#base.entries: the vocab id of each entry, in thesaurus order (int32)
+#base.offsets: where each entry's neighbours start in base.neighbours and base.sims, plus the total (int64)
+#base.neighbours: the vocab id of each neighbour, in thesaurus order (int32)
+#base.sims: the similarity of each neighbour (float32)
+#the arrays are in native byte order and are memory-mapped, so only the vocab and the row of each entry are held in memory
+#a thesaurus with a line ending in a neighbour without a similarity is refused, as Analyser rejects such lines
+#
+#python -m src.wordnet.thesaurusindex build neighbours.strings neighbours
+#python -m src.wordnet.thesaurusindex top neighbours man/N 10
+
+import sys,os,time
+from array import array
+import numpy as np
+
+FLUSH=1000000 #neighbours buffered before they are appended to the array files
+
+def build(infile,base):
+    start=time.time()
+    vocab={}
+    entries=array('i')
+    offsets=array('q',[0])
+    neighbours=array('i')
+    sims=array('f')
+    total=0
+    try:
+        with open(infile,encoding='utf-8') as instream,open(base+".neighbours",'wb') as neighbourstream,open(base+".sims",'wb') as simstream:
+            for number,line in enumerate(instream,1):
+                fields=line.rstrip().split('\t')
+                if len(fields)%2==0:
+                    raise ValueError("%s line %d: entry %s ends with a neighbour without a similarity"%(infile,number,fields[0]))
+                entries.append(vocab.setdefault(fields[0],len(vocab)))
+                for i in range(1,len(fields),2):
+                    neighbours.append(vocab.setdefault(fields[i],len(vocab)))
+                    sims.append(float(fields[i+1]))
+                total+=(len(fields)-1)//2
+                offsets.append(total)
+                if len(neighbours)>=FLUSH:
+                    neighbours.tofile(neighbourstream)
+                    sims.tofile(simstream)
+                    neighbours=array('i')
+                    sims=array('f')
+            neighbours.tofile(neighbourstream)
+            sims.tofile(simstream)
+    except ValueError:
+        for suffix in [".neighbours",".sims"]:
+            os.remove(base+suffix)
+        raise
+    with open(base+".entries",'wb') as outstream:
+        entries.tofile(outstream)
+    with open(base+".offsets",'wb') as outstream:
+        offsets.tofile(outstream)
+    words=[None]*len(vocab)
+    for word,wordid in vocab.items():
+        words[wordid]=word
+    with open(base+".vocab",'w',encoding='utf-8') as outstream:
+        for word in words:
+            outstream.write(word+"\n")
+    print("Indexed %d entries, %d neighbours and %d words from %s in %.1fs"%(len(entries),total,len(words),infile,time.time()-start))
+
+def readarray(filename,dtype):
+    #np.memmap cannot map an empty file
+    if os.path.getsize(filename)==0:
+        return np.zeros(0,dtype=dtype)
+    #a plain ndarray view of the map, as slicing an np.memmap is several times slower
+    return np.memmap(filename,dtype=dtype,mode='r').view(np.ndarray)
+
+class ThesaurusIndex:
+
+    def __init__(self,base):
+        with open(base+".vocab",encoding='utf-8') as instream:
+            self.vocab=instream.read().split("\n")[:-1]
+        self.entries=readarray(base+".entries",np.int32)
+        self.offsets=readarray(base+".offsets",np.int64)
+        self.neighbourids=readarray(base+".neighbours",np.int32)
+        self.sims=readarray(base+".sims",np.float32)
+        #row of each entry; if an entry occurs more than once, its last row
+        self.rows=dict((self.vocab[wordid],row) for row,wordid in enumerate(self.entries.tolist()))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def entry(self,row):
+        return self.vocab[int(self.entries[row])]
+
+    #the first k (all if k is None) (neighbour,similarity) pairs of a row
+    def neighbours(self,row,k=None):
+        start,stop=self.offsets[row:row+2].tolist()
+        if k is not None:
+            stop=min(stop,start+k)
+        return list(zip([self.vocab[wordid] for wordid in self.neighbourids[start:stop].tolist()],self.sims[start:stop].tolist()))
+
+    #the first k neighbours of an entry, e.g. top("man/N",10)
+    def top(self,entry,k=None):
+        return self.neighbours(self.rows[entry],k)
+
+    #a row as a thesaurus line, with each similarity written as the shortest string giving the same float32
+    def line(self,row):
+        start,stop=self.offsets[row:row+2].tolist()
+        return self.entry(row)+"".join(["\t"+self.vocab[wordid]+"\t"+str(sim) for wordid,sim in zip(self.neighbourids[start:stop].tolist(),self.sims[start:stop])])
+
+if __name__=="__main__":
+    if len(sys.argv)>3 and sys.argv[1]=="build":
+        build(sys.argv[2],sys.argv[3])
+    elif len(sys.argv)>3 and sys.argv[1]=="top":
+        index=ThesaurusIndex(sys.argv[2])
+        for neighbour,sim in index.top(sys.argv[3],int(sys.argv[4]) if len(sys.argv)>4 else None):
+            print(neighbour+"\t"+str(np.float32(sim)))
+    else:
+        print("Usage: thesaurusindex.py build thesaurusfile base | top base entry [k]")
@@ -0,0 +1,243 @@
+import os,random,shutil
+
+from src.tools.composition import Composition
+
+RELS=["amod","nsubj","_dobj","dobj","_amod","nn"]
+
+#raw APT vectors for nwords random entries, mostly nouns
+def makeraw(filename,seed=1,nwords=120,words=None):
+    rng=random.Random(seed)
+    if words is None:
+        words=["w%d/%s"%(i,rng.choice("NNNJV")) for i in range(nwords)]
+    with open(filename,"w") as outstream:
+        for word in words:
+            feats={}
+            for i in range(rng.randint(5,40)):
+                order=rng.choice([0,1,1,2])
+                target=rng.choice(words)
+                if order==0:
+                    feat=":"+target
+                elif order==1:
+                    feat=rng.choice(RELS)+":"+target
+                else:
+                    feat=rng.choice(RELS)+"\xbb"+rng.choice(RELS)+":"+target
+                feats[feat]=feats.get(feat,0)+rng.randint(1,20)
+            outstream.write(word+"".join(["\t%s\t%d"%item for item in feats.items()])+"\n")
+    return words
+
+def configure(directory,name,options,minorder,maxorder,**extra):
+    cfg=os.path.join(directory,name)
+    lines=["[default]","options="+repr(options),"filename="+os.path.join(directory,"raw.tsv"),"pos=N","weighting=ppmi",
+           "minorder="+str(minorder),"maxorder="+str(maxorder),"wthreshold=0.0","fthreshold=5","saliency=0","saliencyperpath=False",
+           "normalised="+str(extra.pop("normalised",False)),"filterfile=","comppairfile="]
+    lines+=[key+"="+str(value) for key,value in extra.items()]
+    with open(cfg,"w") as outstream:
+        outstream.write("\n".join(lines)+"\n")
+    return cfg
+
+def compose(directory,name,options,minorder,maxorder,**extra):
+    Composition(["config",configure(directory,name,options,minorder,maxorder,**extra)]).run()
+
+#the full pipeline, for orders 1 to 1 and then 0 to 2
+def pipeline(directory,**extra):
+    options=["split","reduceorder","maketotals","filter","normalise","maketotals","revectorise"]
+    if extra.get("lowmemory"):
+        options.insert(1,"sort")
+    compose(directory,"cfg11.cfg",options,1,1,**extra)
+    compose(directory,"cfg02.cfg",options,0,2,**extra)
+
+def load(filename):
+    vectors={}
+    with open(filename) as instream:
+        for line in instream:
+            fields=line.rstrip("\n").split("\t")
+            vectors[fields[0]]=dict((fields[i],float(fields[i+1])) for i in range(1,len(fields),2))
+    return vectors
+
+def assert_same_vectors(filename1,filename2):
+    vectors1=load(filename1)
+    vectors2=load(filename2)
+    assert set(vectors1)==set(vectors2)
+    for entry in vectors1:
+        assert set(vectors1[entry])==set(vectors2[entry]),entry
+        for feat in vectors1[entry]:
+            assert abs(vectors1[entry][feat]-vectors2[entry][feat])<=1e-9*max(1,abs(vectors1[entry][feat])),(entry,feat)
+
+PPMI="raw.tsv.nouns.reduce_0_2.filtered.norm.ppmi"
+
+def test_revectorise_sharded_matches_in_memory(tmp_path,monkeypatch):
+    directory=str(tmp_path)
+    makeraw(os.path.join(directory,"raw.tsv"))
+    pipeline(directory)
+    shutil.copy(os.path.join(directory,PPMI),os.path.join(directory,"inmemory.ppmi"))
+
+    monkeypatch.setattr(Composition,"memoryfactor",100)
+    compose(directory,"sharded.cfg",["revectorise"],0,2,normalised=True,memorybudget=1)
+    assert_same_vectors(os.path.join(directory,"inmemory.ppmi"),os.path.join(directory,PPMI))
+    assert not [filename for filename in os.listdir(directory) if ".shard_" in filename]
+
+def test_revectorise_sharded_removes_shards_on_failure(tmp_path,monkeypatch):
+    directory=str(tmp_path)
+    makeraw(os.path.join(directory,"raw.tsv"))
+    pipeline(directory)
+
+    def fail(*args):
+        raise RuntimeError("shard failed")
+    monkeypatch.setattr(Composition,"memoryfactor",100)
+    monkeypatch.setattr(Composition,"computeppmi",fail)
+    try:
+        compose(directory,"sharded.cfg",["revectorise"],0,2,normalised=True,memorybudget=1)
+    except RuntimeError:
+        pass
+    assert not [filename for filename in os.listdir(directory) if ".shard_" in filename]
+
+def test_revectorise_sharded_removes_shards_when_partition_fails(tmp_path,monkeypatch):
+    directory=str(tmp_path)
+    makeraw(os.path.join(directory,"raw.tsv"))
+    pipeline(directory)
+
+    #the vectors are partitioned, then partitioning the row totals fails part way
+    partition=Composition.partition
+    def fail(self,infile,nshards):
+        if infile.endswith(".rtot"):
+            open(infile+".shard_0","w").close()
+            raise OSError("disk full")
+        return partition(self,infile,nshards)
+    monkeypatch.setattr(Composition,"memoryfactor",100)
+    monkeypatch.setattr(Composition,"partition",fail)
+    try:
+        compose(directory,"sharded.cfg",["revectorise"],0,2,normalised=True,memorybudget=1)
+    except OSError:
+        pass
+    assert not [filename for filename in os.listdir(directory) if ".shard_" in filename]
+
+def test_lowmemory_matches_default(tmp_path):
+    default=tmp_path/"default"
+    lowmemory=tmp_path/"lowmemory"
+    for directory,extra in [(default,{}),(lowmemory,{"lowmemory":True})]:
+        directory.mkdir()
+        makeraw(str(directory/"raw.tsv"))
+        pipeline(str(directory),**extra)
+    assert_same_vectors(str(default/PPMI),str(lowmemory/PPMI))
+    assert not [filename for filename in os.listdir(str(lowmemory)) if ".above_" in filename]
+
+def readraw(filename):
+    return load(filename)
+
+def writeraw(filename,vectors):
+    with open(filename,"w") as outstream:
+        for entry,vector in vectors.items():
+            outstream.write(entry+"".join(["\t%s\t%d"%item for item in vector.items()])+"\n")
+
+#raw vectors, a delta with some of the same entries and a new entry which sorts before all of them, and their sum
+def makedelta(directory,seed=2):
+    words=makeraw(os.path.join(directory,"raw.tsv"))
+    makeraw(os.path.join(directory,"delta.tsv"),seed=seed,words=words[:30]+["aaa/N"])
+    vectors=readraw(os.path.join(directory,"raw.tsv"))
+    for entry,vector in readraw(os.path.join(directory,"delta.tsv")).items():
+        total=vectors.setdefault(entry,{})
+        for feat,count in vector.items():
+            total[feat]=total.get(feat,0)+count
+    return vectors
+
+def update(directory,**extra):
+    compose(directory,"update11.cfg",["update"],1,1,deltafile=os.path.join(directory,"delta.tsv"),**extra)
+    compose(directory,"update02.cfg",["update"],0,2,deltafile=os.path.join(directory,"delta.tsv"),**extra)
+
+def test_update_matches_rebuild(tmp_path):
+    for extra in [{},{"lowmemory":True},{"lowmemory":True,"spilltotals":True}]:
+        updated=tmp_path/("updated"+str(len(extra)))
+        rebuilt=tmp_path/("rebuilt"+str(len(extra)))
+        updated.mkdir()
+        rebuilt.mkdir()
+        vectors=makedelta(str(updated))
+        pipeline(str(updated),**extra)
+        update(str(updated),**extra)
+        writeraw(str(rebuilt/"raw.tsv"),vectors)
+        pipeline(str(rebuilt),**extra)
+        assert "aaa/N" in load(str(updated/PPMI))
+        assert_same_vectors(str(rebuilt/PPMI),str(updated/PPMI))
+
+def test_update_restores_files_on_failure(tmp_path,monkeypatch):
+    directory=str(tmp_path)
+    makedelta(directory)
+    pipeline(directory,lowmemory=True)
+    before=dict((filename,open(os.path.join(directory,filename)).read()) for filename in os.listdir(directory))
+
+    def fail(*args):
+        raise RuntimeError("update failed")
+    with monkeypatch.context() as patch:
+        patch.setattr(Composition,"computeppmi",fail)
+        try:
+            compose(directory,"update11.cfg",["update"],1,1,deltafile=os.path.join(directory,"delta.tsv"),lowmemory=True)
+        except RuntimeError:
+            pass
+    after=dict((filename,open(os.path.join(directory,filename)).read()) for filename in os.listdir(directory) if not filename.endswith(".cfg"))
+    assert after==dict((filename,text) for filename,text in before.items() if not filename.endswith(".cfg"))
+
+    update(directory,lowmemory=True)
+    assert "aaa/N" in load(os.path.join(directory,PPMI))
+    assert not [filename for filename in os.listdir(directory) if filename.endswith(".old") or filename.endswith(".new")]
+
+#path steps are joined with '»', as in the features vectorextraction writes
+def test_path_features_split_on_separator(tmp_path):
+    composer=Composition(["config",configure(str(tmp_path),"cfg.cfg",["split"],0,2)])
+    assert [composer.getorder(feat) for feat in [":man/N","_nsubj:shot/V","_nsubj»dobj:gunman/N","amod»_dobj»nsubj:man/N"]]==[0,1,2,3]
+    assert composer.splitfeature("_nsubj»dobj:gunman/N")==("_nsubj","dobj")
+    assert composer.splitfeature("amod»_dobj»nsubj:man/N")==("amod","_dobj»nsubj")
+    assert composer.offsetVector({"_nsubj»dobj:gunman/N":1,"det:the/D":2,":man/N":3},"nsubj")=={"dobj:gunman/N":1,"nsubj»det:the/D":2,"nsubj:man/N":3}
+
+def loadtotals(filename):
+    with open(filename) as instream:
+        return dict((line.split("\t")[0],float(line.split("\t")[1])) for line in instream)
+
+TOTALS="raw.tsv.nouns.reduce_0_2"
+
+def test_sketch_never_undercounts():
+    from src.tools.outofcore import CountMinSketch
+    rng=random.Random(3)
+    sketch=CountMinSketch(16,3)
+    totals={}
+    for i in range(2000):
+        feat="f%d"%rng.randint(0,300)
+        count=rng.randint(1,20)
+        sketch.add(feat,count)
+        totals[feat]=totals.get(feat,0)+count
+    assert len(sketch.counts)==16*3
+    assert all(sketch.estimate(feat)>=total for feat,total in totals.items())
+    assert sketch.total==sum(totals.values())
+
+def test_approxtotals_keeps_exact_totals_above_filterfreq(tmp_path):
+    #a narrow sketch, so that many features collide and are only found to be at or below fthreshold once counted exactly
+    exact=tmp_path/"exact"
+    approx=tmp_path/"approx"
+    for directory,extra in [(exact,{}),(approx,{"approxtotals":True,"sketchwidth":64,"sketchdepth":2})]:
+        directory.mkdir()
+        makeraw(str(directory/"raw.tsv"))
+        compose(str(directory),"totals.cfg",["split","reduceorder","maketotals"],0,2,**extra)
+    coltotals=loadtotals(str(exact/(TOTALS+".ctot")))
+    assert loadtotals(str(approx/(TOTALS+".ctot")))==dict((feat,total) for feat,total in coltotals.items() if total>5)
+    assert loadtotals(str(approx/(TOTALS+".rtot")))==loadtotals(str(exact/(TOTALS+".rtot")))
+
+def test_spilltotals_matches_in_memory(tmp_path,monkeypatch):
+    from src.tools import outofcore
+    inmemory=tmp_path/"inmemory"
+    spilled=tmp_path/"spilled"
+    #a 1MB budget at 20000 bytes a feature spills every 52 features
+    monkeypatch.setattr(Composition,"bytesperfeature",20000)
+    merged=[]
+    mergetotals=outofcore.mergetotals
+    def countruns(runs,outfile,keep=()):
+        merged.append(len(runs))
+        return mergetotals(runs,outfile,keep)
+    monkeypatch.setattr(outofcore,"mergetotals",countruns)
+    for directory,extra in [(inmemory,{}),(spilled,{"spilltotals":True,"memorybudget":1})]:
+        directory.mkdir()
+        makeraw(str(directory/"raw.tsv"))
+        compose(str(directory),"totals.cfg",["split","reduceorder","maketotals"],0,2,**extra)
+    assert len(merged)==1 and merged[0]>5
+    assert loadtotals(str(spilled/(TOTALS+".ctot")))==loadtotals(str(inmemory/(TOTALS+".ctot")))
+    assert loadtotals(str(spilled/(TOTALS+".rtot")))==loadtotals(str(inmemory/(TOTALS+".rtot")))
+    features=[line.split("\t")[0] for line in open(str(spilled/(TOTALS+".ctot")))]
+    assert features==sorted(features)
+    assert not [filename for filename in os.listdir(str(spilled)) if ".run_" in filename]
@@ -0,0 +1,108 @@
+import os,gzip,zlib
+
+import pytest
+
+from src.tools.preprocessing import Converter,BlockReader,BlockWriter,configure,readsentences
+
+SENTENCE=("1\tThe\tthe\tDT\tDT\t_\t2\tdet\t_\t_\n"
+          "2\tman\tman\tNN\tNN\t_\t3\tnsubj\t_\t_\n"
+          "3\tran\trun\tVBD\tVBD\t_\t0\troot\t_\t_\n\n")
+
+def writeconll(filename,sentences=3):
+    with gzip.open(filename,"wb") as outstream:
+        outstream.write((SENTENCE*sentences).encode("utf-8"))
+
+def convertdir(directory,*options):
+    Converter(configure(["preprocessing.py","convertdir",directory,"10","2"]+list(options))).run()
+
+def test_convertdir_skips_sidecars(tmp_path):
+    writeconll(str(tmp_path/"a.conll.gz"))
+    (tmp_path/"a.conll.gz.idx").write_bytes(b"\x00"*16)
+    (tmp_path/"b.conll.gz.part").write_bytes(b"")
+    convertdir(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path)))==["a.conll.gz","a.conll.gz.idx","aptInput-lc-a.conll.gz","b.conll.gz.part"]
+
+def test_convertdir_removes_partial_output(tmp_path):
+    writeconll(str(tmp_path/"a.conll.gz"))
+    #truncated partway through, after some output has been written
+    data=gzip.compress("".join([SENTENCE.replace("man","man%d"%i) for i in range(20000)]).encode("utf-8"))
+    with open(str(tmp_path/"b.conll.gz"),"wb") as outstream:
+        outstream.write(data[:len(data)//2])
+    with pytest.raises(Exception):
+        convertdir(str(tmp_path),"blocksize=1024")
+    assert not [filename for filename in os.listdir(str(tmp_path)) if filename.startswith("aptInput-lc-b")]
+
+    os.remove(str(tmp_path/"b.conll.gz"))
+    convertdir(str(tmp_path),"blocksize=1024")
+    assert "aptInput-lc-a.conll.gz" in os.listdir(str(tmp_path))
+
+def test_analysechunk_streams_whole_file(tmp_path):
+    filename=str(tmp_path/"a.conll.gz")
+    writeconll(filename,sentences=5)
+    converter=Converter(configure(["preprocessing.py","corpusstats",filename,"10","1"]))
+    stats=converter.analysechunk((filename,0,-1))
+    assert (stats['lines'],stats['sentences'],stats['tokens'])==(20,5,15)
+    assert stats['lengths']=={3:5}
+    assert stats['postags']=={'DT':5,'NN':5,'VBD':5}
+
+#sentences of 1 to 7 tokens, each different, with words of different lengths
+def writecorpus(filename,sentences=300):
+    corpus=[]
+    for i in range(sentences):
+        corpus.append("".join(["%d\tw%s\tw\tNN\tNN\t_\t0\troot\t_\t_\n"%(token+1,str(i)*(token%3+1)) for token in range(i%7+1)])+"\n")
+    with gzip.open(filename,"wb") as outstream:
+        outstream.write("".join(corpus).encode("utf-8"))
+    return [sentence.encode("utf-8") for sentence in corpus]
+
+#the number of gzip members in a file
+def members(filename):
+    with open(filename,"rb") as instream:
+        data=instream.read()
+    count=0
+    while data:
+        decompressor=zlib.decompressobj(16+zlib.MAX_WBITS)
+        decompressor.decompress(data)
+        data=decompressor.unused_data
+        count+=1
+    return count
+
+@pytest.mark.parametrize("balance,options",[("bytes",["chunkbytes=512"]),("tokens",["chunkbytes=512"]),("bytes",["blocksize=512"])])
+def test_balancedsplit(tmp_path,balance,options):
+    filename=str(tmp_path/"corpus.gz")
+    corpus=writecorpus(filename)
+    Converter(configure(["preprocessing.py","balancedsplit",filename,"3","2",balance]+options)).run()
+    shards=[]
+    for shard in range(3):
+        assert members(str(tmp_path/("%dcorpus.gz"%shard)))>1
+        with gzip.open(str(tmp_path/("%dcorpus.gz"%shard)),"rb") as instream:
+            shards.append(list(readsentences(instream)))
+    #every sentence goes whole to one shard, in input order within the shard
+    assert sorted(sentence for shard in shards for sentence,length in shard)==sorted(corpus)
+    for shard in shards:
+        assert [corpus.index(sentence) for sentence,length in shard]==sorted(corpus.index(sentence) for sentence,length in shard)
+    #each sentence goes to the least loaded shard, so loads differ by at most the largest sentence
+    if balance=="tokens":
+        loads=[sum(length for sentence,length in shard) for shard in shards]
+        assert max(loads)-min(loads)<=7
+    else:
+        loads=[sum(len(sentence) for sentence,length in shard) for shard in shards]
+        assert max(loads)-min(loads)<=max(len(sentence) for sentence in corpus)
+
+def test_blockreader_sentence(tmp_path,capsys):
+    filename=str(tmp_path/"corpus.gz")
+    with BlockWriter(filename,512) as outstream:
+        for sentence in writecorpus(str(tmp_path/"input.gz")):
+            outstream.write(sentence)
+    with gzip.open(filename,"rb") as instream:
+        sequential=[sentence for sentence,length in readsentences(instream)]
+    reader=BlockReader(filename)
+    assert len(reader.offsets)>2 and reader.sentences==len(sequential)
+    #the first sentence, the first and last of a block in the middle, and the last sentence
+    middle=len(reader.offsets)//2
+    for n in [0,reader.firstsentences[middle],reader.firstsentences[middle+1]-1,len(sequential)-1]:
+        assert reader.sentence(n)==sequential[n]
+    with pytest.raises(IndexError):
+        reader.sentence(len(sequential))
+    capsys.readouterr()
+    Converter(configure(["preprocessing.py","showsentence",filename,"sentence=%d"%(len(sequential)-1)])).run()
+    assert capsys.readouterr().out==sequential[-1].decode("utf-8")+"\n"
@@ -0,0 +1,190 @@
+import sys,stat,threading
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+
+import pytest
+
+from src.tools.runStanford import JobScheduler,PythonParser
+
+XML=("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<root><document><sentences><sentence id=\"1\"><tokens>"
+     "<token id=\"1\"><word>Men</word><lemma>man</lemma><POS>NNS</POS><NER>O</NER></token>"
+     "<token id=\"2\"><word>ran</word><lemma>run</lemma><POS>VBD</POS><NER>O</NER></token></tokens>"
+     "<dependencies type=\"basic-dependencies\"><dep type=\"nsubj\"><governor idx=\"2\">ran</governor><dependent idx=\"1\">Men</dependent></dep>"
+     "</dependencies></sentence></sentences></document></root>\n")
+
+#a stand-in for corenlp.sh which writes the canned XML for every file in its filelist
+#a file whose text contains FAIL makes it exit with status 1 after the others are written
+#and one whose text contains TRUNCATE gets only the start of the XML, although the exit status is still 0
+STUB="""#!%s
+import sys,os
+args=sys.argv[1:]
+options=dict(zip(args[0::2],args[1::2]))
+status=0
+for line in open(options['-filelist']):
+    path=line.rstrip('\\n')
+    text=open(path).read()
+    if 'FAIL' in text:
+        status=1
+        continue
+    with open(os.path.join(options['-outputDirectory'],os.path.basename(path)+options['-outputExtension']),'w') as outstream:
+        outstream.write(%r[:60] if 'TRUNCATE' in text else %r)
+print('annotated')
+sys.exit(status)
+""" % (sys.executable,XML,XML)
+
+#a corpus of two subdirectories of raw text, a stanford directory holding the stub and a config for them
+def makeparser(tmp_path,**extra):
+    stanford_dir=tmp_path/"stanford"
+    stanford_dir.mkdir()
+    stub=stanford_dir/"corenlp.sh"
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode|stat.S_IEXEC)
+    for sub_dir,texts in [("a",["Men ran.","Men ran."]),("b",["Men ran."])]:
+        (tmp_path/"corpus-raw"/sub_dir).mkdir(parents=True)
+        for i,text in enumerate(texts):
+            (tmp_path/"corpus-raw"/sub_dir/("doc%d.txt"%i)).write_text(text)
+    options={"whereami":"here","java_threads":1,"options":["tokenize","ssplit","pos","lemma","parse"],"outextension":"xml",
+             "outputformat":"conll","inputformat":"raw","testinglevel":0,"mode":"no_overwrite"}
+    options.update(extra)
+    lines=["[default]"]+["%s=%s"%item for item in options.items()]
+    lines+=["[here]","stanford_dir="+str(stanford_dir),"data_dir="+str(tmp_path/"corpus"),"working_dir="+str(tmp_path)]
+    (tmp_path/"parser.cfg").write_text("\n".join(lines)+"\n")
+    return PythonParser(str(tmp_path/"parser.cfg"))
+
+def test_stanford_pipeline_does_not_record_truncated_output(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path)
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("TRUNCATE")
+    assert parser.run_stanford_pipeline()=={"a":0,"b":0}
+    assert "doc1.txt" not in (tmp_path/"corpus-xml"/"a"/".manifest").read_text()
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("Men ran.")
+    assert parser.run_stanford_pipeline()=={"a":0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc1.txt.xml").read_text()==XML
+
+#output written before manifests were kept: complete XML and non-empty conversions are not redone, truncated XML is
+def test_manifest_seeded_from_existing_output(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path)
+    old=XML.replace("<root>","<root><!-- old -->")
+    for name,text in [("a/doc0.txt.xml",old),("a/doc0.txt.xml.conll","old\n"),("a/doc1.txt.xml",XML[:60]),("b/doc0.txt.xml",old)]:
+        (tmp_path/"corpus-xml"/name).parent.mkdir(parents=True,exist_ok=True)
+        (tmp_path/"corpus-xml"/name).write_text(text)
+    assert parser.run_stanford_pipeline()=={"a":0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc0.txt.xml").read_text()==old
+    assert (tmp_path/"corpus-xml"/"a"/"doc1.txt.xml").read_text()==XML
+    assert parser._process_xml_to_conll(str(tmp_path/"corpus-xml"/"a"))=={'converted':1,'skipped':1,'failed':0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc0.txt.xml.conll").read_text()=="old\n"
+
+def test_scheduler_records_job_which_cannot_start(tmp_path):
+    scheduler=JobScheduler(2,poll=0.01)
+    scheduler.add("missing",[str(tmp_path/"no-such-command")],logfile=str(tmp_path/"missing.log"))
+    scheduler.add("true",[sys.executable,"-c","pass"],logfile=str(tmp_path/"true.log"))
+    statuses=scheduler.run()
+    assert statuses=={"missing":-1,"true":0}
+    assert "Could not start" in (tmp_path/"missing.log").read_text()
+    assert scheduler.jobs[0]['log'].closed and scheduler.jobs[1]['log'].closed
+
+def test_stanford_pipeline_with_stub(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path,max_threads=2)
+    assert parser.run_stanford_pipeline()=={"a":0,"b":0}
+    for name in ["a/doc0.txt.xml","a/doc1.txt.xml","b/doc0.txt.xml"]:
+        assert (tmp_path/"corpus-xml"/name).read_text()==XML
+    assert (tmp_path/"corpus-xml-logs"/"a.log").read_text()=="annotated\n"
+
+    #everything is recorded as complete, so a second run has nothing to do
+    assert parser.run_stanford_pipeline()=={}
+
+def test_stanford_pipeline_records_only_complete_documents(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path)
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("FAIL")
+    assert parser.run_stanford_pipeline()=={"a":1,"b":0}
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("Men ran.")
+    assert parser.run_stanford_pipeline()=={"a":0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc1.txt.xml").read_text()==XML
+
+#a stand-in for a CoreNLP server which returns the canned XML for any document, or a 500 if its text contains FAIL
+class CannedHandler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+
+    def do_POST(self):
+        text=self.rfile.read(int(self.headers['Content-Length']))
+        status,body=(500,b"failed") if b"FAIL" in text else (200,XML.encode("utf-8"))
+        self.send_response(status)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd=ThreadingHTTPServer(("127.0.0.1",0),CannedHandler)
+    thread=threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%d"%httpd.server_address[1]
+    httpd.shutdown()
+    thread.join()
+    httpd.server_close()
+
+def test_server_backend(tmp_path,server):
+    parser=makeparser(tmp_path,backend="server",server_url=server,server_connections=2,server_queue=1)
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("FAIL")
+    assert parser.run_stanford_pipeline()=={"a":1,"b":0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc0.txt.xml").read_text()==XML
+    assert (tmp_path/"corpus-xml"/"a"/"doc1.txt.xml").read_text()==""
+
+    #only the failed document is sent again
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("Men ran.")
+    assert parser.run_stanford_pipeline()=={"a":0,"b":0}
+    assert (tmp_path/"corpus-xml"/"a"/"doc1.txt.xml").read_text()==XML
+
+def test_server_backend_stops_workers_when_queueing_fails(tmp_path,server,monkeypatch):
+    parser=makeparser(tmp_path,backend="server",server_url=server,server_connections=2,server_queue=1)
+    def fail(*args):
+        raise OSError("cannot list")
+    monkeypatch.setattr(parser,"_make_filelist_and_create_files",fail)
+    errors=[]
+    def run():
+        try:
+            parser.run_stanford_pipeline()
+        except OSError as e:
+            errors.append(e)
+    thread=threading.Thread(target=run,daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive() and len(errors)==1
+
+CONLL="1\tMen\tman\tNNS\tO\t2\tnsubj\n2\tran\trun\tVBD\tO\t\t\n\n"
+
+def test_pipelined_run_with_stub(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path,pipeline=True,outextension="parsed",max_threads=2,job_memory=100,max_memory=100)
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("FAIL")
+    parser.run()
+    assert (tmp_path/"corpus-parsed"/"b"/"doc0.txt.parsed.conll").read_text()==CONLL
+    assert not (tmp_path/"corpus-parsed"/"a"/"doc0.txt.parsed.conll").exists()
+    assert parser.run_pipelined()==[("stanford","a")]
+
+    (tmp_path/"corpus-raw"/"a"/"doc1.txt").write_text("Men ran.")
+    assert parser.run_pipelined()==[]
+    assert (tmp_path/"corpus-parsed"/"a"/"doc1.txt.parsed.conll").read_text()==CONLL
+
+#the conversion pool pickles the parser, so nothing unpicklable may be left on it by the pipelined run
+def test_pipelined_run_with_conversion_pool(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path,pipeline=True,outextension="parsed",max_threads=2,processes=2)
+    assert parser.run_pipelined()==[]
+    for name in ["a/doc0.txt.parsed.conll","a/doc1.txt.parsed.conll","b/doc0.txt.parsed.conll"]:
+        assert (tmp_path/"corpus-parsed"/name).read_text()==CONLL
+
+def test_pipelined_run_with_server(tmp_path,server):
+    parser=makeparser(tmp_path,pipeline=True,outextension="parsed",backend="server",server_url=server)
+    assert parser.run_pipelined()==[]
+    assert (tmp_path/"corpus-parsed"/"a"/"doc1.txt.parsed.conll").read_text()==CONLL
+
+def test_pipelined_testing_level_stops_each_item(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parser=makeparser(tmp_path,pipeline=True,testinglevel=4)
+    assert sorted(parser.run_pipelined())==[("stanford","a"),("stanford","b")]
@@ -0,0 +1,101 @@
+import os,sys,stat
+
+import pytest
+
+from src.tools.runStanfordRobertson import ParsingPipeline
+
+def makepipeline(tmp_path,shards):
+    lines=["[default]","whereami=here","robertson_jar=robertson.jar","java_threads=1","inputformat=tagged","testinglevel=0",
+           "mode=no_overwrite","robertson_shards=%d"%shards,"[here]","stanford_dir="+str(tmp_path),
+           "data_dir="+str(tmp_path/"corpus"),"working_dir="+str(tmp_path)]
+    (tmp_path/"parser.cfg").write_text("\n".join(lines)+"\n")
+    pipeline=ParsingPipeline(str(tmp_path/"parser.cfg"))
+    pipeline.output_dir=str(tmp_path/"corpus-tagged")
+    os.mkdir(pipeline.output_dir)
+    return pipeline
+
+#shard the files, "parse" each shard by copying it and merge the output back
+def roundtrip(pipeline,tmp_path):
+    shards=pipeline._make_robertson_shards(str(tmp_path/"shards"))
+    for shard in shards.values():
+        with open(shard['input'],'rb') as instream,open(shard['input']+".parsed",'wb') as outstream:
+            outstream.write(instream.read())
+    started=set()
+    for name in sorted(shards):
+        pipeline._merge_robertson_shard(shards[name],started)
+    return shards
+
+def test_consecutive_blank_lines_end_one_sentence(tmp_path):
+    pipeline=makepipeline(tmp_path,1)
+    source=str(tmp_path/"corpus-tagged"/"a.conll")
+    with open(source,'wb') as outstream:
+        outstream.write(b"1\tA\n2\tB\n\n\n1\tC\n\n")
+    shards=roundtrip(pipeline,tmp_path)
+    assert [shard['segments'] for shard in shards.values()]==[[[source,2]]]
+    assert pipeline._count_sentences(source)==2
+    with open(source+".parsed",'rb') as instream:
+        assert instream.read()==b"1\tA\n2\tB\n\n1\tC\n\n"
+
+def test_shards_split_back_into_files(tmp_path):
+    pipeline=makepipeline(tmp_path,3)
+    texts={"a.conll":b"\n1\tA\n\n\n\n1\tB\n2\tC\n\n1\tD",
+           "b.conll":b"".join(b"1\tW%d\n2\tX\n\n"%i for i in range(20)),
+           "c.conll":b"1\tE\n\n\n"}
+    for name,text in texts.items():
+        with open(str(tmp_path/"corpus-tagged"/name),'wb') as outstream:
+            outstream.write(text)
+    shards=roundtrip(pipeline,tmp_path)
+    assert len(shards)==3
+    assert sum(count for shard in shards.values() for source,count in shard['segments'])==3+20+1
+    expected={"a.conll":b"1\tA\n\n1\tB\n2\tC\n\n1\tD\n\n","b.conll":texts["b.conll"],"c.conll":b"1\tE\n\n"}
+    for name,text in expected.items():
+        with open(str(tmp_path/"corpus-tagged"/(name+".parsed")),'rb') as instream:
+            assert instream.read()==text
+
+#a stand-in for java -jar robertson.jar directory, which "parses" every .conll file in the directory by copying it
+#and appends its arguments to java.log in the working directory
+JAVA="""#!%s
+import sys,os
+with open('java.log','a') as log:
+    log.write(' '.join(sys.argv[1:])+'\\n')
+directory=sys.argv[-1]
+for name in os.listdir(directory):
+    if name.endswith('.conll'):
+        with open(os.path.join(directory,name),'rb') as instream,open(os.path.join(directory,name+'.parsed'),'wb') as outstream:
+            outstream.write(instream.read())
+""" % sys.executable
+
+def makepipelined(tmp_path,monkeypatch,shards):
+    from test_runStanford import STUB
+    bin_dir=tmp_path/"bin"
+    bin_dir.mkdir()
+    (tmp_path/"stanford").mkdir()
+    for path,text in [(bin_dir/"java",JAVA),(tmp_path/"stanford"/"corenlp.sh",STUB)]:
+        path.write_text(text)
+        path.chmod(path.stat().st_mode|stat.S_IEXEC)
+    monkeypatch.setenv("PATH",str(bin_dir)+os.pathsep+os.environ["PATH"])
+    for sub_dir,texts in [("a",["Men ran.","Men ran."]),("b",["Men ran."])]:
+        (tmp_path/"corpus-raw"/sub_dir).mkdir(parents=True)
+        for i,text in enumerate(texts):
+            (tmp_path/"corpus-raw"/sub_dir/("doc%d.txt"%i)).write_text(text)
+    lines=["[default]","whereami=here","robertson_jar=robertson.jar","java_threads=1","inputformat=raw","testinglevel=0",
+           "mode=no_overwrite","pipeline=True","max_threads=2","max_memory=2000","job_memory=1000",
+           "robertson_memory=1000","robertson_shards=%d"%shards,
+           "[here]","stanford_dir="+str(tmp_path/"stanford"),"data_dir="+str(tmp_path/"corpus"),"working_dir="+str(tmp_path)]
+    (tmp_path/"parser.cfg").write_text("\n".join(lines)+"\n")
+    monkeypatch.chdir(tmp_path)
+    return ParsingPipeline(str(tmp_path/"parser.cfg"))
+
+@pytest.mark.parametrize("shards",[0,2])
+def test_pipelined_parse_uses_robertson_settings(tmp_path,monkeypatch,shards):
+    pipeline=makepipelined(tmp_path,monkeypatch,shards)
+    assert pipeline.run()==[]
+    calls=(tmp_path/"java.log").read_text().splitlines()
+    assert calls and all(call.startswith("-mx1000m -jar robertson.jar ") for call in calls)
+    assert len(calls)=={0:2,2:3}[shards] #b has a single sentence, so it makes only one shard
+    for name in ["a/doc0.txt.tagged.conll","a/doc1.txt.tagged.conll","b/doc0.txt.tagged.conll"]:
+        tagged=tmp_path/"corpus-tagged"/name
+        assert os.path.getsize(str(tagged))>0
+        assert (tmp_path/"corpus-tagged"/(name+".parsed")).read_bytes()==tagged.read_bytes()
+    if shards:
+        assert not os.listdir(str(tmp_path/"corpus-tagged-shards"))
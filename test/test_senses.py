@@ -0,0 +1,68 @@
+import json,random
+
+import numpy as np
+
+from src.wordnet.senses import Analyser
+from src.wordnet.synsettables import FAMILIES,buildfamily
+
+#a snapshot in which bank/N has a river and a money sense, each close to one of its neighbours
+SNAPSHOT={"lookups":{"n":{"bank":["bank.n.01","bank.n.02"],"shore":["shore.n.01"],"cash":["cash.n.01"]}},
+          "synsets":{"bank.n.01":["sloping land",[]],"bank.n.02":["a financial institution",[]]}}
+SIMS={("bank.n.01","shore.n.01"):0.5,("bank.n.02","cash.n.01"):0.5}
+
+def makeanalyser(tmp_path):
+    (tmp_path/"snapshot.json").write_text(json.dumps(SNAPSHOT))
+    analyser=Analyser({"wn_snapshot":str(tmp_path/"snapshot.json")})
+    analyser.similarity=lambda metric,s1,s2:SIMS.get((s1.name(),s2.name()),0.0)
+    return analyser
+
+def test_processline_selects_paired_line(tmp_path):
+    analyser=makeanalyser(tmp_path)
+    assert analyser.processline("bank/N\tshore/N\t0.5\tcash/N\t0.5\n")
+    assert sorted(synset.name() for synset in analyser.candidates["bank/N"])==["bank.n.01","bank.n.02"]
+
+def test_processline_rejects_unpaired_field(tmp_path):
+    analyser=makeanalyser(tmp_path)
+    assert analyser.parseneighbours(["bank/N","shore/N","0.5","cash/N"]) is None
+    assert not analyser.processline("bank/N\tshore/N\t0.5\tcash/N\n")
+    assert analyser.candidates=={}
+    #only the first k pairs are read, so a field after them does not matter
+    fields=["bank/N"]+["shore/N","0.5","cash/N","0.5"]*(Analyser.k//2)+["fox/N"]
+    assert len(analyser.parseneighbours(fields))==Analyser.k
+
+#a thesaurus over the synsets of test_synsettables' taxonomy, with synset tables and a snapshot so that no WordNet data is needed
+WORDS={"dog":["dog.n.01","car.n.01"],"thing":["animal.n.01","artifact.n.01"],"pet":["cat.n.01","robot_dog.n.01"],
+       "cat":["cat.n.01"],"car":["car.n.01"],"fido":["fido.n.01"],"robot":["robot_dog.n.01"],"animal":["animal.n.01"],"artifact":["artifact.n.01"]}
+
+def makethesaurus(tmp_path,lines=200):
+    from test_synsettables import IC,Reader
+    arrays={}
+    for family in FAMILIES:
+        arrays.update(buildfamily(Reader(),IC,family))
+    with open(str(tmp_path/"synsets.npz"),"wb") as outstream:
+        np.savez(outstream,**arrays)
+    (tmp_path/"snapshot.json").write_text(json.dumps({"lookups":{"n":WORDS},"synsets":{}}))
+    rng=random.Random(4)
+    words=sorted(WORDS)
+    with open(str(tmp_path/"neighbours.strings"),"w") as outstream:
+        for i in range(lines):
+            neighbours=["%s/N\t%.3f"%(rng.choice(words),rng.random()) for j in range(rng.randint(0,12))]
+            outstream.write("\t".join([rng.choice(words)+"/"+rng.choice("NNNJ")]+neighbours)+"\n")
+
+def filtered(tmp_path,**extra):
+    parameters={"thesdir":str(tmp_path)+"/","thesfile":"neighbours.strings","wn_snapshot":str(tmp_path/"snapshot.json"),
+                "synset_tables":str(tmp_path/"synsets.npz"),"sim_thresh":0.5}
+    parameters.update(extra)
+    analyser=Analyser(parameters)
+    analyser.processfile()
+    candidates=dict((entry,dict((synset.name(),value) for synset,value in dist.items())) for entry,dist in analyser.candidates.items())
+    return (tmp_path/"neighbours.strings.filtered").read_text(),candidates
+
+def test_processfile_parallel_matches_serial(tmp_path):
+    makethesaurus(tmp_path)
+    serial=filtered(tmp_path)
+    assert 0<len(serial[0].splitlines())<200 and serial[1]
+    assert filtered(tmp_path,workers=2,chunklines=7)==serial
+    #caches which hold a single lookup or similarity only change how often they are computed
+    assert filtered(tmp_path,synset_cache=1,sim_cache=1)==serial
+    assert filtered(tmp_path,synset_cache=0,sim_cache=0,workers=3,chunklines=1)==serial
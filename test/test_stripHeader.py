@@ -0,0 +1,35 @@
+import os,gzip
+
+import pytest
+
+from src.tools.stripHeader import Guillotine
+
+HEADER="The Project Gutenberg Etext\nSMALL PRINT\n*END*THE SMALL PRINT! FOR PUBLIC DOMAIN ETEXTS*Ver.04.29.93*END*\n"
+BODY="CHAPTER I\n\nIt was a dark night.\n\nThe end.\n"
+
+def makeguillotine(tmp_path,fast,compress=False):
+    (tmp_path/"strip.cfg").write_text("[default]\nparent=%s\ninput=in\noutput=%s\nfast=%s\ncompress=%s\n"%(tmp_path,"fast" if fast else "slow",fast,compress))
+    guillotine=Guillotine(["stripHeader.py",str(tmp_path/"strip.cfg")])
+    guillotine.ensure_outpath()
+    return guillotine
+
+@pytest.mark.parametrize("newline",["\n","\r\n","\r"])
+def test_fast_mode_matches_line_mode(tmp_path,monkeypatch,newline):
+    monkeypatch.setattr(Guillotine,"CHUNK",7)
+    os.mkdir(str(tmp_path/"in"))
+    inpath=str(tmp_path/"in"/"DOC.TXT")
+    with open(inpath,"wb") as outstream:
+        outstream.write((HEADER+BODY).replace("\n",newline).encode("utf-8"))
+    makeguillotine(tmp_path,False).cleanup(inpath)
+    assert makeguillotine(tmp_path,True).fastcleanup(inpath)==(inpath,len(BODY))
+    with open(str(tmp_path/"slow"/"in"/"DOC.TXT"),"rb") as slow,open(str(tmp_path/"fast"/"in"/"DOC.TXT"),"rb") as fast:
+        assert slow.read()==fast.read()==BODY.encode("utf-8")
+
+def test_fast_mode_compresses_and_reports_missing_marker(tmp_path):
+    os.mkdir(str(tmp_path/"in"))
+    (tmp_path/"in"/"DOC.TXT").write_bytes((HEADER+BODY).encode("utf-8"))
+    (tmp_path/"in"/"NOHEADER.TXT").write_bytes(BODY.encode("utf-8"))
+    guillotine=makeguillotine(tmp_path,True,compress=True)
+    assert guillotine.run()==[str(tmp_path/"in"/"NOHEADER.TXT")]
+    with gzip.open(str(tmp_path/"fast"/"in"/"DOC.TXT.gz"),"rb") as instream:
+        assert instream.read()==BODY.encode("utf-8")
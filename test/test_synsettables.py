@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+import pytest
+from nltk.corpus.reader.wordnet import Synset,WordNetCorpusReader
+
+from src.wordnet.synsettables import FAMILIES,SynsetTables,buildfamily
+
+#a small taxonomy: name, offset, hypernyms and instance hypernyms, with robot_dog under two parents and fido an instance of dog
+#adjectives have no hypernyms, and nice.s.01 is a satellite, which is in the 'a' family but not the 'a' part of speech
+TAXONOMY=[("entity.n.01",1,[],[]),
+          ("animal.n.01",2,["entity.n.01"],[]),
+          ("artifact.n.01",3,["entity.n.01"],[]),
+          ("dog.n.01",4,["animal.n.01"],[]),
+          ("cat.n.01",5,["animal.n.01"],[]),
+          ("robot_dog.n.01",6,["dog.n.01","artifact.n.01"],[]),
+          ("car.n.01",7,["artifact.n.01"],[]),
+          ("fido.n.01",8,[],["dog.n.01"]),
+          ("good.a.01",1,[],[]),
+          ("bad.a.01",2,[],[]),
+          ("nice.s.01",3,[],[])]
+IC={'n':{0:100.0,1:100.0,2:40.0,3:50.0,4:15.0,5:20.0,6:3.0,7:25.0,8:1.0},'a':{0:30.0,1:10.0,2:12.0,3:8.0}}
+METRICS=["path","lch","wup","res","jcn","lin"]
+
+#just enough of nltk's WordNetCorpusReader for its Synset similarity methods to run over TAXONOMY
+class Reader:
+
+    def __init__(self):
+        self._max_depth={}
+        self.synsets={}
+        for name,offset,hypernyms,instances in TAXONOMY:
+            synset=Synset(self)
+            synset._name=name
+            synset._pos=name.split(".")[1]
+            synset._offset=offset
+            self.synsets[name]=synset
+        for name,offset,hypernyms,instances in TAXONOMY:
+            for symbol,parents in [("@",hypernyms),("@i",instances)]:
+                for parent in parents:
+                    self.synsets[name]._pointers[symbol].add((self.synsets[parent]._pos,self.synsets[parent]._offset))
+
+    def synset_from_pos_and_offset(self,pos,offset):
+        return [synset for synset in self.synsets.values() if synset._pos==pos and synset._offset==offset][0]
+
+    def all_synsets(self,pos):
+        return [synset for synset in self.synsets.values() if synset._pos==pos or (pos=='a' and synset._pos=='s')]
+
+    def get_version(self):
+        return "3.0"
+
+    _compute_max_depth=WordNetCorpusReader._compute_max_depth
+
+def nltksimilarity(metric,s1,s2):
+    try:
+        if metric in ["res","jcn","lin"]:
+            return getattr(s1,metric+"_similarity")(s2,IC)
+        return getattr(s1,metric+"_similarity")(s2)
+    except Exception:
+        return None
+
+@pytest.fixture
+def tables(tmp_path):
+    reader=Reader()
+    arrays={}
+    for family in FAMILIES:
+        arrays.update(buildfamily(reader,IC,family))
+    with open(str(tmp_path/"synsets.npz"),"wb") as outstream:
+        np.savez(outstream,**arrays)
+    return reader,SynsetTables(str(tmp_path/"synsets.npz"))
+
+@pytest.mark.parametrize("metric",METRICS)
+def test_score_matches_nltk(tables,metric):
+    reader,synsettables=tables
+    names=[name for name,offset,hypernyms,instances in TAXONOMY]
+    sims=synsettables.similarity(metric,names,names)
+    for i,name1 in enumerate(names):
+        for j,name2 in enumerate(names):
+            if synsettables.ids[name1][0]!=synsettables.ids[name2][0]:
+                assert math.isnan(sims[i,j])
+                continue
+            expected=nltksimilarity(metric,reader.synsets[name1],reader.synsets[name2])
+            if expected is None:
+                assert math.isnan(sims[i,j]),(name1,name2)
+            else:
+                assert abs(sims[i,j]-expected)<=1e-9*max(1.0,abs(expected)),(name1,name2)
+
+@pytest.mark.parametrize("metric",METRICS)
+def test_best_is_first_greatest_nltk_similarity(tables,metric):
+    reader,synsettables=tables
+    #the scan of Analyser.updatedist without tables, keeping the first of equal similarities
+    def scan(names1,names2):
+        best=(None,None,0)
+        for i,name1 in enumerate(names1):
+            for j,name2 in enumerate(names2):
+                sim=nltksimilarity(metric,reader.synsets[name1],reader.synsets[name2])
+                if best[0] is None or sim>best[2]:
+                    best=(i,j,sim)
+        return best
+    for names1,names2 in [(["dog.n.01","car.n.01"],["cat.n.01","robot_dog.n.01"]),
+                          (["entity.n.01"],["fido.n.01","cat.n.01"]),
+                          (["cat.n.01","dog.n.01"],["dog.n.01","cat.n.01"]),
+                          (["good.a.01"],["bad.a.01","good.a.01"])]:
+        i,j,sim=synsettables.best(metric,names1,names2)
+        expected=scan(names1,names2)
+        assert (i,j)==expected[:2],(names1,names2)
+        assert abs(sim-expected[2])<=1e-9*max(1.0,abs(expected[2]))
+    assert synsettables.best(metric,["dog.n.01"],[])==(None,None,0)
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+import pytest
+
+from src.wordnet.thesaurusindex import ThesaurusIndex,build
+
+LINES=["man/N\twoman/N\t0.5\tboy/N\t0.25\n",
+       "dog/N\tcat/N\t0.75\n",
+       "cat/N\n",
+       "fox/N\tdog/N\t0.125\tcat/N\t0.0625\n"]
+
+def test_build(tmp_path):
+    (tmp_path/"neighbours.strings").write_text("".join(LINES))
+    base=str(tmp_path/"neighbours")
+    build(str(tmp_path/"neighbours.strings"),base)
+    index=ThesaurusIndex(base)
+    assert len(index)==4
+    assert index.top("man/N")==[("woman/N",0.5),("boy/N",0.25)]
+    assert index.top("dog/N")==[("cat/N",0.75)]
+    assert index.top("cat/N")==[]
+    assert index.top("fox/N",1)==[("dog/N",0.125)]
+    assert [index.line(row)+"\n" for row in range(len(index))]==LINES
+    assert isinstance(index.sims,np.ndarray) and index.sims.dtype==np.float32
+
+def test_build_refuses_unpaired_field(tmp_path):
+    #Analyser rejects a line whose neighbours end without a similarity, so the index refuses it rather than keep part of it
+    (tmp_path/"neighbours.strings").write_text(LINES[0]+"dog/N\tcat/N\t0.75\tfox/N\n"+LINES[3])
+    with pytest.raises(ValueError,match="line 2: entry dog/N"):
+        build(str(tmp_path/"neighbours.strings"),str(tmp_path/"neighbours"))
+    assert os.listdir(str(tmp_path))==["neighbours.strings"]
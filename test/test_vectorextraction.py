@@ -0,0 +1,27 @@
+import gzip
+
+from src.tools.vectorextraction import VectorExtractor,configure
+
+SENTENCE="1\tthe/DT\t2\tdet\n2\tman/NN\t3\tnsubj\n3\tshot/VBD\t0\troot\n4\tthe/DT\t5\tdet\n5\tgunman/NN\t3\tdobj\n\n"
+
+def extract(tmp_path,order,sentences=2):
+    infile=str(tmp_path/"aptInput-a.gz")
+    with gzip.open(infile,"wb") as outstream:
+        outstream.write((SENTENCE*sentences).encode("utf-8"))
+    outfile=str(tmp_path/("vectors%d.tsv"%order))
+    VectorExtractor(configure(["vectorextraction.py",infile,outfile,"order=%d"%order,"shards=2"])).run()
+    vectors={}
+    with open(outfile,encoding="utf-8") as instream:
+        for line in instream:
+            fields=line.rstrip("\n").split("\t")
+            vectors[fields[0]]=dict((fields[i],int(fields[i+1])) for i in range(1,len(fields),2))
+    return vectors
+
+def test_order_two(tmp_path):
+    vectors=extract(tmp_path,2)
+    assert vectors["man/N"]=={":man/N":2,"det:the/D":2,"_nsubj:shot/V":2,"_nsubj»dobj:gunman/N":2}
+    assert vectors["the/D"][":the/D"]==4
+
+def test_order_zero_has_only_the_entry(tmp_path):
+    vectors=extract(tmp_path,0)
+    assert vectors=={"the/D":{":the/D":4},"man/N":{":man/N":2},"shot/V":{":shot/V":2},"gunman/N":{":gunman/N":2}}